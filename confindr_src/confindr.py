@@ -1,7 +1,11 @@
 #!/usr/bin/env python
-from confindr_src.methods import check_acceptable_xmx, check_for_databases_and_download, check_valid_base_fraction, \
-    dependency_check, find_paired_reads, find_unpaired_reads, find_contamination, get_version, write_output
+from confindr_src.methods import allocate_sample_threads, append_report_row, check_acceptable_xmx, \
+    check_for_databases_and_download, check_valid_base_fraction, dependency_check, find_paired_reads, \
+    find_unpaired_reads, find_contamination, fingerprint_files, get_version, physical_memory_xmx, \
+    read_database_download_date, sort_report, split_xmx, write_output, KmaSharedMemory, PileupPool, RunManifest
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
+import importlib.util
 import subprocess
 import traceback
 import argparse
@@ -10,6 +14,127 @@ import shutil
 import os
 
 
+def result_parameters(args):
+    """
+    Picks out the parameters that can change the results for a sample, so a sample only counts as finished by a
+    previous run if it was analysed the same way. Parameters that only affect speed (threads, memory, etc.) are left
+    out.
+    :param args: Parsed command line arguments
+    :return: Dictionary of the parameters
+    """
+    return dict(quality_cutoff=args.quality_cutoff,
+                base_cutoff=args.base_cutoff,
+                base_fraction_cutoff=args.base_fraction_cutoff,
+                error_cutoff=args.error_cutoff,
+                forward_id=args.forward_id,
+                reverse_id=args.reverse_id,
+                data_type=args.data_type,
+                cgmlst=args.cgmlst,
+                rmlst=args.rmlst,
+                fasta=args.fasta,
+                cross_details=args.cross_details,
+                min_matching_hashes=args.min_matching_hashes,
+                mapper=args.mapper,
+                max_depth=args.max_depth,
+                bam_qualities=args.bam_qualities)
+
+
+def find_sample_name(fastq, forward_id):
+    """
+    Works out the name of a sample from its read files.
+    :param fastq: List with either the forward and reverse reads, or just the unpaired reads, for the sample
+    :param forward_id: Identifier that marks reads as being in the forward direction for paired reads
+    :return: Name of the sample, as used in the report
+    """
+    if len(fastq) == 1:
+        return os.path.split(fastq[0])[-1].split('.')[0]
+    return os.path.split(fastq[0])[-1].split(forward_id)[0]
+
+
+def analyse_sample(fastq, args, threads, xmx, pileup_pool=None, manifest=None, kma_shm=None):
+    """
+    Runs ConFindr on a single sample, adding a line to the report noting the failure if anything goes wrong.
+    :param fastq: List with either the forward and reverse reads, or just the unpaired reads, for the sample
+    :param args: Parsed command line arguments
+    :param threads: Number of threads this sample is allowed to use
+    :param xmx: Memory request for BBTools, or None to let BBTools decide
+    :param pileup_pool: PileupPool shared by all the samples in the run
+    :param manifest: RunManifest to skip samples that have already been finished, and record newly finished ones in
+    :param kma_shm: KmaSharedMemory shared by all the samples in the run, or None to have kma load databases from disk
+    """
+    sample_name = find_sample_name(fastq=fastq,
+                                   forward_id=args.forward_id)
+    output_report = os.path.join(args.output_name, 'confindr_report.csv')
+    if manifest is not None:
+        fingerprint = fingerprint_files(fastq)
+        parameters = result_parameters(args)
+        database_version = read_database_download_date(args.databases)
+        report_row = manifest.finished_report_row(sample_name=sample_name,
+                                                  fingerprint=fingerprint,
+                                                  parameters=parameters,
+                                                  database_version=database_version)
+        if report_row is not None:
+            logging.info('Sample {} was already analysed by a previous run, skipping...'.format(sample_name))
+            append_report_row(output_report=output_report,
+                              report_row=report_row)
+            return
+    logging.info('Beginning analysis of sample {}...'.format(sample_name))
+    try:
+        report_row = find_contamination(pair=fastq,
+                                        forward_id=args.forward_id,
+                                        threads=threads,
+                                        output_folder=args.output_name,
+                                        databases_folder=args.databases,
+                                        keep_files=args.keep_files,
+                                        quality_cutoff=args.quality_cutoff,
+                                        base_cutoff=args.base_cutoff,
+                                        base_fraction_cutoff=args.base_fraction_cutoff,
+                                        cgmlst_db=args.cgmlst,
+                                        xmx=xmx,
+                                        tmpdir=args.tmp,
+                                        data_type=args.data_type,
+                                        use_rmlst=args.rmlst,
+                                        cross_details=args.cross_details,
+                                        min_matching_hashes=args.min_matching_hashes,
+                                        fasta=args.fasta,
+                                        debug=args.verbosity,
+                                        bam_qualities=args.bam_qualities,
+                                        pileup_pool=pileup_pool,
+                                        stream_reads=args.stream_reads,
+                                        intermediate_format=args.intermediate_format,
+                                        speculative_bait=args.speculative_bait,
+                                        cache_dir=args.cache_dir,
+                                        mapper=args.mapper,
+                                        kma_shm=kma_shm,
+                                        max_depth=args.max_depth)
+    except subprocess.CalledProcessError:
+        # If something unforeseen goes wrong, traceback will be printed to screen.
+        # We then add the sample to the report with a note that it failed.
+        multi_positions = 0
+        genus = 'Error processing sample'
+        write_output(output_report=output_report,
+                     sample_name=sample_name,
+                     multi_positions=multi_positions,
+                     genus=genus,
+                     percent_contam='ND',
+                     contam_stddev='ND',
+                     total_gene_length=0,
+                     database_download_date='ND')
+        logging.warning('Encountered error when attempting to run ConFindr on sample '
+                        '{sample}. Skipping...'.format(sample=sample_name))
+        logging.warning('Error encountered was:\n{}'.format(traceback.format_exc()))
+        if args.keep_files is False:
+            shutil.rmtree(os.path.join(args.output_name, sample_name))
+    else:
+        # Only finished samples are recorded, so any that failed are tried again by the next run
+        if manifest is not None:
+            manifest.record(sample_name=sample_name,
+                            fingerprint=fingerprint,
+                            parameters=parameters,
+                            database_version=database_version,
+                            report_row=report_row)
+
+
 def confindr(args):
     # Check for dependencies.
     all_dependencies_present = True
@@ -41,6 +166,11 @@ def confindr(args):
         if valid_xmx is False:
             quit(code=1)
 
+    if args.mapper == 'mappy' and importlib.util.find_spec('mappy') is None:
+        logging.error('ERROR: mappy is not installed. Install it with pip install mappy, or use bbmap instead. '
+                      'Quitting...')
+        quit(code=1)
+
     # Don't yet have cgmlst support with Nanopore reads - don't let user do this.
     if args.cgmlst and args.data_type == 'Nanopore':
         logging.error('ERROR: cgMLST schemes not yet supported for Nanopore reads. Quitting...')
@@ -56,13 +186,14 @@ def confindr(args):
     # Make the output directory.
     if not os.path.isdir(args.output_name):
         os.makedirs(args.output_name)
-    # Remove any reports created by previous iterations of ConFindr
+    # Remove any reports created by previous iterations of ConFindr. When resuming, the rows for samples that were
+    # already finished are added back as the run gets to them.
+    manifest = RunManifest(manifest_file=os.path.join(args.output_name, 'confindr_manifest.json'),
+                           resume=args.resume)
     try:
         os.remove(os.path.join(args.output_name, 'confindr_report.csv'))
     except FileNotFoundError:
         pass
-    # Set the minimum number of matching hashes
-    min_matching_hashes = args.min_matching_hashes
     # Check if databases necessary to run are present, and download them if they aren't
     check_for_databases_and_download(database_location=args.databases)
 
@@ -76,50 +207,57 @@ def confindr(args):
                                          find_fasta=args.fasta)
     # Consolidate read lists
     reads = sorted(paired_reads + unpaired_reads)
-    # Process paired reads, one sample at a time.
-    for fastq in reads:
-        if len(fastq) == 1:
-            sample_name = os.path.split(fastq[0])[-1].split('.')[0]
+    # Split the thread (and memory) budget between the samples that will be analysed at once.
+    parallel_samples, sample_threads = allocate_sample_threads(threads=args.threads,
+                                                               parallel_samples=args.parallel_samples,
+                                                               num_samples=len(reads))
+    xmx = args.Xmx
+    if parallel_samples > 1:
+        if xmx is None:
+            xmx = physical_memory_xmx()
+        if xmx is not None:
+            xmx = split_xmx(xmx, parallel_samples)
+        logging.info('Analysing {parallel} samples at a time with {threads} threads each...'
+                     .format(parallel=parallel_samples,
+                             threads=sample_threads))
+    # The pileup workers are started once for the whole run, before any sample threads, and shared by all samples.
+    # Pileup tasks from samples running at the same time queue up for the same workers, so together they never use
+    # more than the total thread budget.
+    # KMA databases are kept in shared memory between samples for the whole run, and removed once all samples are done
+    kma_shm = KmaSharedMemory() if args.kma_shm else None
+    with PileupPool(processes=args.threads,
+                    samples=parallel_samples) as pileup_pool:
+        if parallel_samples == 1:
+            # Process reads one sample at a time.
+            for fastq in reads:
+                analyse_sample(fastq=fastq,
+                               args=args,
+                               threads=sample_threads,
+                               xmx=xmx,
+                               pileup_pool=pileup_pool,
+                               manifest=manifest,
+                               kma_shm=kma_shm)
         else:
-            sample_name = os.path.split(fastq[0])[-1].split(args.forward_id)[0]
-        logging.info('Beginning analysis of sample {}...'.format(sample_name))
-        try:
-            find_contamination(pair=fastq,
-                               forward_id=args.forward_id,
-                               threads=args.threads,
-                               output_folder=args.output_name,
-                               databases_folder=args.databases,
-                               keep_files=args.keep_files,
-                               quality_cutoff=args.quality_cutoff,
-                               base_cutoff=args.base_cutoff,
-                               base_fraction_cutoff=args.base_fraction_cutoff,
-                               cgmlst_db=args.cgmlst,
-                               xmx=args.Xmx,
-                               tmpdir=args.tmp,
-                               data_type=args.data_type,
-                               use_rmlst=args.rmlst,
-                               cross_details=args.cross_details,
-                               min_matching_hashes=min_matching_hashes,
-                               fasta=args.fasta,
-                               debug=args.verbosity)
-        except subprocess.CalledProcessError:
-            # If something unforeseen goes wrong, traceback will be printed to screen.
-            # We then add the sample to the report with a note that it failed.
-            multi_positions = 0
-            genus = 'Error processing sample'
-            write_output(output_report=os.path.join(args.output_name, 'confindr_report.csv'),
-                         sample_name=sample_name,
-                         multi_positions=multi_positions,
-                         genus=genus,
-                         percent_contam='ND',
-                         contam_stddev='ND',
-                         total_gene_length=0,
-                         database_download_date='ND')
-            logging.warning('Encountered error when attempting to run ConFindr on sample '
-                            '{sample}. Skipping...'.format(sample=sample_name))
-            logging.warning('Error encountered was:\n{}'.format(traceback.format_exc()))
-            if args.keep_files is False:
-                shutil.rmtree(os.path.join(args.output_name, sample_name))
+            # The heavy lifting for each sample happens in external programs and worker processes, so threads are
+            # enough to keep several samples going at once.
+            with ThreadPoolExecutor(max_workers=parallel_samples) as executor:
+                futures = [executor.submit(analyse_sample,
+                                           fastq=fastq,
+                                           args=args,
+                                           threads=sample_threads,
+                                           xmx=xmx,
+                                           pileup_pool=pileup_pool,
+                                           manifest=manifest,
+                                           kma_shm=kma_shm)
+                           for fastq in reads]
+                for future in futures:
+                    future.result()
+            # Rows were added as samples finished, so put them back in the same order as a serial run would
+            sort_report(output_report=os.path.join(args.output_name, 'confindr_report.csv'),
+                        sample_names=[find_sample_name(fastq=fastq,
+                                                       forward_id=args.forward_id) for fastq in reads])
+    if kma_shm is not None:
+        kma_shm.close()
     if args.keep_files is False and args.tmp is not None:
         shutil.rmtree(args.tmp)
     logging.info('Contamination detection complete!')
@@ -153,6 +291,12 @@ def main():
                         type=int,
                         default=cpu_count,
                         help='Number of threads to run analysis with.')
+    parser.add_argument('-p', '--parallel_samples',
+                        type=int,
+                        default=1,
+                        help='Number of samples to analyse at once. The threads specified with -t (and the memory '
+                             'specified with -Xmx, or available on the machine) are split evenly between these samples.'
+                             ' Set to 0 to pick a value automatically. Default is 1.')
     parser.add_argument('-tmp', '--tmp',
                         type=str,
                         help='If your ConFindr databases are in a location you don\'t have write access to, '
@@ -182,6 +326,12 @@ def main():
                         default=1.0,
                         help='Value to use for the calculated error cutoff when setting the base cutoff value. '
                              'Default is 1.0%')
+    parser.add_argument('-md', '--max_depth',
+                        type=int,
+                        default=None,
+                        help='Cap the mean depth of each gene at this value by subsampling reads before looking for '
+                             'SNVs. Very deep samples are much faster to analyse, and depths of around 100 are enough '
+                             'for a reliable answer. By default, all reads are used.')
     parser.add_argument('-fid', '--forward_id',
                         type=str,
                         default='_R1',
@@ -225,6 +375,54 @@ def main():
                         action='store_true',
                         help='Continue ConFindr analyses on samples with two or more genera identified. Default is '
                              'False')
+    parser.add_argument('-bq', '--bam_qualities',
+                        default=False,
+                        action='store_true',
+                        help='Take base qualities from the mapped reads in the BAM file instead of loading the trimmed '
+                             'FASTQ files into memory. Faster and uses less memory, with the same results.')
+    parser.add_argument('-sr', '--stream_reads',
+                        default=False,
+                        action='store_true',
+                        help='Pipe baited Illumina reads straight into quality trimming instead of writing them to '
+                             'disk, and leave the trimmed reads uncompressed. Saves I/O and compression time on slow '
+                             'storage, at the cost of more disk space for the trimmed reads.')
+    parser.add_argument('-if', '--intermediate_format',
+                        choices=['gzip', 'gzip1', 'bgzf', 'plain'],
+                        default=None,
+                        help='Format to write baited and trimmed reads in while analysing a sample. gzip1 is gzip at '
+                             'the fastest compression level, and plain is uncompressed. Default is plain when using '
+                             '--stream_reads, and gzip otherwise.')
+    parser.add_argument('-sb', '--speculative_bait',
+                        default=False,
+                        action='store_true',
+                        help='Start extracting core genes while checking for cross-species contamination, using the '
+                             'database for the genus most common in the report so far, and extract them again if that '
+                             'turns out to be the wrong database. Gets results for each sample back sooner when most '
+                             'samples in a run are of the same genus.')
+    parser.add_argument('--resume',
+                        default=False,
+                        action='store_true',
+                        help='Skip samples that were already analysed by a previous run into the same output folder, '
+                             'as long as their reads, the parameters that affect results, and the databases are '
+                             'unchanged. Their results are carried over into the new report.')
+    parser.add_argument('-cd', '--cache_dir',
+                        type=str,
+                        help='Folder to cache results in, which can be shared between runs. Samples with reads '
+                             'identical to ones already analysed with the same parameters and databases get their '
+                             'results from the cache instead of being analysed again. BBMap indexes of the alleles '
+                             'found in samples are also kept here, in bbmap_index. Not used by default.')
+    parser.add_argument('-mp', '--mapper',
+                        choices=['bbmap', 'mappy'],
+                        default='bbmap',
+                        help='Mapper to map Illumina reads to the core gene alleles with. mappy (the python bindings '
+                             'for minimap2, installed separately with pip install mappy) maps within ConFindr, '
+                             'avoiding starting Java and sorting a BAM file for each sample. Default is bbmap.')
+    parser.add_argument('-shm', '--kma_shm',
+                        default=False,
+                        action='store_true',
+                        help='Keep the KMA databases used in shared memory for the whole run, instead of KMA loading '
+                             'them from disk for every sample. They are removed from shared memory when the run '
+                             'finishes.')
     parser.add_argument('-m', '--min_matching_hashes',
                         default=150,
                         type=int,
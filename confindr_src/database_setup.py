@@ -1,11 +1,19 @@
 #!/usr/bin/env python
-from confindr_src.methods import download_cgmlst_derived_data, download_mash_sketch, index
+from confindr_src.methods import download_cgmlst_derived_data, download_mash_sketch, open_rmlst_index, \
+    prebuild_genus_databases
+from concurrent.futures import ThreadPoolExecutor
 from rauth import OAuth1Session
 from Bio import SeqIO
+import multiprocessing
+import threading
+import requests
 import argparse
+import hashlib
 import datetime
 import logging
 import shutil
+import json
+import time
 import glob
 import csv
 import re
@@ -53,31 +61,88 @@ class RmlstRest(object):
                                 self.consumer_secret,
                                 access_token=self.session_token,
                                 access_token_secret=self.session_secret)
-        r = session.get(self.loci)
+        # rauth can't sign requests without params with newer versions of requests, so always give it some
+        r = session.get(self.loci, params=dict())
         if r.status_code == 200 or r.status_code == 201:
             if re.search('json', r.headers['content-type'], flags=0):
                 decoded = r.json()
             else:
                 decoded = r.text
-            # Extract all the URLs in the decoded dictionary under the key 'loci'
-            for locus_url in decoded['loci']:
-                output_file = os.path.join(self.output_folder, '{}.tfa'.format(os.path.split(locus_url)[1]))
-                logging.info('Downloading {}...'.format(os.path.split(locus_url)[1]))
-                with open(output_file, 'w') as f:
-                    download = session.get(locus_url + '/alleles_fasta')
-                    if download.status_code == 200 or download.status_code == 201:
-                        if re.search('json', download.headers['content-type'], flags=0):
-                            decoded = download.json()
-                        else:
-                            decoded = download.text
-                        with open(output_file, 'w') as locus_fasta:
-                            locus_fasta.write(decoded)
-                
+            # Download the loci a few at a time. Loci downloaded by an earlier attempt are checked against the
+            # checksums recorded for them, and only downloaded again if they don't match.
+            if os.path.isfile(self.checksum_file):
+                with open(self.checksum_file) as f:
+                    self.checksums = json.load(f)
+            with ThreadPoolExecutor(max_workers=self.download_threads) as executor:
+                downloaded = list(executor.map(self.download_locus, decoded['loci']))
+            if not all(downloaded):
+                logging.error('ERROR: Could not download {} of the rMLST loci. Run confindr_database_setup again with '
+                              '--resume to download the rest of them.'.format(downloaded.count(False)))
+                quit(code=1)
         else:
             logging.error('ERROR: Could not find URLs for rMLST download, they may have moved. Please open an issue '
                           'at https://github.com/OLC-Bioinformatics/ConFindr/issues and we\'ll get things sorted out.')
             quit(code=1)
 
+    def download_locus(self, locus_url):
+        """
+        Downloads the FASTA file of one locus, unless it was already downloaded. Failed downloads are tried again a few
+        times, waiting longer each time.
+        :param locus_url: URL of the locus, from the list of loci
+        :return: True if the locus was downloaded, otherwise False
+        """
+        locus = os.path.split(locus_url)[1]
+        output_file = os.path.join(self.output_folder, '{}.tfa'.format(locus))
+        if locus in self.checksums and os.path.isfile(output_file) and \
+                self.checksums[locus] == file_checksum(output_file):
+            logging.info('Already downloaded {}'.format(locus))
+            return True
+        for attempt in range(self.retries):
+            logging.info('Downloading {}...'.format(locus))
+            try:
+                download = self.thread_session().get(locus_url + '/alleles_fasta',
+                                                     params=dict(),
+                                                     timeout=self.timeout)
+                problem = 'status code {}'.format(download.status_code)
+            except requests.RequestException as e:
+                download = None
+                problem = str(e)
+            if download is not None and (download.status_code == 200 or download.status_code == 201):
+                # Write to a temporary file and rename it, so a locus is only ever there if it was fully downloaded
+                tmp_output_file = output_file + '.tmp'
+                with open(tmp_output_file, 'w') as locus_fasta:
+                    locus_fasta.write(download.text)
+                os.replace(tmp_output_file, output_file)
+                self.record_checksum(locus, file_checksum(output_file))
+                return True
+            if attempt < self.retries - 1:
+                wait = self.backoff * 2 ** attempt
+                logging.warning('WARNING: Could not download {} ({}), trying again in {} seconds...'
+                                .format(locus, problem, wait))
+                time.sleep(wait)
+            else:
+                logging.error('ERROR: Could not download {} ({}).'.format(locus, problem))
+        return False
+
+    def thread_session(self):
+        """
+        Each download thread keeps its own session, so connections to the server are reused between loci.
+        """
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = OAuth1Session(self.consumer_key,
+                                                  self.consumer_secret,
+                                                  access_token=self.session_token,
+                                                  access_token_secret=self.session_secret)
+        return self.sessions.session
+
+    def record_checksum(self, locus, checksum):
+        with self.lock:
+            self.checksums[locus] = checksum
+            tmp_checksum_file = self.checksum_file + '.tmp'
+            with open(tmp_checksum_file, 'w') as f:
+                json.dump(self.checksums, f, indent=2, sort_keys=True)
+            os.replace(tmp_checksum_file, self.checksum_file)
+
     def download_profile(self):
         profile_file = os.path.join(self.output_folder, 'profiles.txt')
         session = OAuth1Session(self.consumer_key,
@@ -125,7 +190,7 @@ class RmlstRest(object):
             self.access_token = r.json()['oauth_token']
             self.access_secret = r.json()['oauth_token_secret']
 
-    def __init__(self, consumer_secret_file, output_folder):
+    def __init__(self, consumer_secret_file, output_folder, download_threads=4, retries=5, backoff=2, timeout=300):
         self.test_rest_url = 'http://rest.pubmlst.org/db/pubmlst_rmlst_seqdef'
         self.test_web_url = 'http://pubmlst.org/cgi-bin/bigsdb/bigsdb.pl?db=pubmlst_rmlst_seqdef'
         self.request_token_url = self.test_rest_url + '/oauth/get_request_token'
@@ -156,6 +221,26 @@ class RmlstRest(object):
         self.request_secret = str()
         self.access_token = str()
         self.access_secret = str()
+        # Settings for downloading the loci
+        self.download_threads = download_threads
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # Size and SHA-1 of each locus downloaded so far, so an interrupted download can be resumed
+        self.checksum_file = os.path.join(self.output_folder, 'loci_checksums.json')
+        self.checksums = dict()
+        self.lock = threading.Lock()
+        self.sessions = threading.local()
+
+
+def file_checksum(file_name):
+    """
+    :param file_name: Path to a file
+    :return: List of the size and SHA-1 of the file
+    """
+    with open(file_name, 'rb') as f:
+        contents = f.read()
+    return [len(contents), hashlib.sha1(contents).hexdigest()]
 
 
 def create_gene_allele_file(profiles_file, gene_allele_file):
@@ -190,10 +275,27 @@ def create_gene_allele_file(profiles_file, gene_allele_file):
     return genera
 
 
-def setup_confindr_database(output_folder, consumer_secret, index_databases=False):
+def remove_rmlst_databases(output_folder):
+    """
+    Removes everything made from a previous rMLST download - the genus-specific databases and their indexes, locks and
+    logs, the combined sequence index and the parsed gene/allele map - so that a resumed download can't leave them
+    behind, out of date with the new rMLST sequences. The cgMLST-derived databases are left alone.
+    :param output_folder: Path to the ConFindr database folder
+    """
+    stale_files = glob.glob(os.path.join(output_folder, '*_db.fasta*'))
+    stale_files += glob.glob(os.path.join(output_folder, '*_db_kma*'))
+    stale_files += [os.path.join(output_folder, 'rMLST_combined.fasta.idx'),
+                    os.path.join(output_folder, 'gene_allele.txt.pickle')]
+    for stale_file in stale_files:
+        if os.path.isfile(stale_file):
+            os.remove(stale_file)
+
+
+def setup_confindr_database(output_folder, consumer_secret, index_databases=False, processes=1, download_threads=4):
     # Go through the REST API in order to get profiles downloaded.
     rmlst_rest = RmlstRest(consumer_secret_file=consumer_secret,
-                           output_folder=output_folder)
+                           output_folder=output_folder,
+                           download_threads=download_threads)
     rmlst_rest.get_request_token()
     rmlst_rest.get_access_token()
     rmlst_rest.get_session_token()
@@ -201,6 +303,9 @@ def setup_confindr_database(output_folder, consumer_secret, index_databases=Fals
     rmlst_rest.download_loci()
     rmlst_rest.download_profile()
 
+    # Databases left from an earlier download (kept when resuming) would otherwise be reused with the new sequences.
+    remove_rmlst_databases(output_folder)
+
     # With the sequences downloaded, make a file of all rMLST sequences combined.
     logging.info('Combining rMLST files...')
     with open(os.path.join(output_folder, 'rMLST_combined.fasta'), 'w') as f:
@@ -221,15 +326,22 @@ def setup_confindr_database(output_folder, consumer_secret, index_databases=Fals
             except OSError:
                 logging.warning('WARNING: Could not delete {}. This won\'t affect ConFindr performance, but '
                                 ' you may want to delete it to save on disk space.'.format(locus_file))
+    # The loci are gone, so there's nothing left to resume
+    if os.path.isfile(rmlst_rest.checksum_file):
+        os.remove(rmlst_rest.checksum_file)
+
+    # Index the combined file once here, rather than scanning all of it each time a genus-specific database is made.
+    logging.info('Indexing rMLST sequences...')
+    open_rmlst_index(output_folder).close()
 
     logging.info('Assigning alleles to genera...')
     # Parse profiles so that we know what alleles are found with each genus.
     genera = create_gene_allele_file(profiles_file=os.path.join(output_folder, 'profiles.txt'),
                                      gene_allele_file=os.path.join(output_folder, 'gene_allele.txt'))
     if index_databases:
-        index(output_folder=output_folder,
-              genera=sorted(list(genera)),
-              cgderived=False)
+        prebuild_genus_databases(output_folder=output_folder,
+                                 genera=sorted(list(genera)),
+                                 processes=processes)
 
 
 def main():
@@ -250,11 +362,45 @@ def main():
                         help='Enable this option if you are installing the databases to a drive that will be read-only '
                              'after the installation. The script will create and index all the necessary genus-specific'
                              ' database files. Note that this is very slow for the rMLST database.')
+    parser.add_argument('-p', '--prebuild_genera',
+                        type=str,
+                        help='Set up and index the genus-specific databases of an existing ConFindr database folder, '
+                             'without downloading anything. Give either all, to build databases for every genus in '
+                             'the rMLST profiles, or a comma-separated list of genera. Databases are built in parallel,'
+                             ' and ones that already exist are skipped.')
+    parser.add_argument('-t', '--threads',
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of genus-specific databases to build at once with --index_databases or '
+                             '--prebuild_genera. Defaults to the number of cores on your machine.')
+    parser.add_argument('-r', '--resume',
+                        action='store_true',
+                        help='Keep what is already in the output folder instead of deleting it, and carry on with an '
+                             'rMLST download that was interrupted. Loci that were fully downloaded are not downloaded '
+                             'again. Any genus-specific rMLST databases already in the folder are removed and have to '
+                             'be built again.')
+    parser.add_argument('-d', '--download_threads',
+                        type=int,
+                        default=4,
+                        help='Number of rMLST loci to download at once. Defaults to 4.')
     args = parser.parse_args()
-    if os.path.isdir(args.output_folder):
+    if args.prebuild_genera is not None:
+        if not os.path.isfile(os.path.join(args.output_folder, 'gene_allele.txt')) or \
+                not os.path.isfile(os.path.join(args.output_folder, 'rMLST_combined.fasta')):
+            logging.error('ERROR: Could not find the rMLST database in {}. Run confindr_database_setup with a secret '
+                          'file to download it first.'.format(args.output_folder))
+            quit(code=1)
+        genera = None if args.prebuild_genera == 'all' else args.prebuild_genera.split(',')
+        prebuild_genus_databases(output_folder=args.output_folder,
+                                 genera=genera,
+                                 processes=args.threads)
+        logging.info('Done building genus-specific databases!')
+        return
+    if os.path.isdir(args.output_folder) and not args.resume:
         logging.info('Removing old databases...')
         shutil.rmtree(args.output_folder)
-    os.makedirs(args.output_folder)
+    if not os.path.isdir(args.output_folder):
+        os.makedirs(args.output_folder)
     download_cgmlst_derived_data(args.output_folder)
     if args.secret_file is None:
         logging.warning('WARNING: Without an rMLST secret file, data will only be downloaded for Escherichia, '
@@ -265,7 +411,9 @@ def main():
     else:
         setup_confindr_database(output_folder=args.output_folder,
                                 consumer_secret=args.secret_file,
-                                index_databases=args.index_databases)
+                                index_databases=args.index_databases,
+                                processes=args.threads,
+                                download_threads=args.download_threads)
     download_mash_sketch(args.output_folder)
     current_year = datetime.datetime.utcnow().year
     current_month = datetime.datetime.utcnow().month
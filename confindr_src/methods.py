@@ -1,24 +1,95 @@
 #!/usr/bin/env python
-from confindr_src.wrappers import bbtools, mash
+from concurrent.futures import ThreadPoolExecutor
+from confindr_src.wrappers import bbtools, kma, mash
 from Bio import SeqIO
 from pysam.utils import SamtoolsError
-from itertools import chain
-from statistics import mean
+from array import array
 import multiprocessing
 import urllib.request
 import pkg_resources
 import numpy as np
 import subprocess
+import threading
+import hashlib
+import atexit
 import logging
+import fcntl
 import shutil
+import tempfile
 import tarfile
+import sqlite3
+import pickle
+import zlib
 import pysam
+import json
 import glob
 import gzip
 import math
 import csv
 import os
 
+try:
+    import mappy
+except ImportError:
+    mappy = None
+
+# The compiled pileup kernel is only there if Cython was installed when ConFindr was built
+try:
+    from confindr_src import pileup_kernel
+except ImportError:
+    pileup_kernel = None
+
+# Samples may be analysed concurrently (see confindr --parallel_samples), so appends to the shared report are serialised
+report_lock = threading.Lock()
+
+# Complement of each base, for reverse complementing reads
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+# File extension, and extra arguments for BBTools, for each of the formats intermediate reads can be written in. BGZF is
+# gzip compatible, so everything reading gzipped reads can read it too.
+INTERMEDIATE_FORMATS = {'gzip': ('.fastq.gz', dict()),
+                        'gzip1': ('.fastq.gz', dict(ziplevel=1)),
+                        'bgzf': ('.fastq.gz', dict(bgzip='t')),
+                        'plain': ('.fastq', dict())}
+
+# Reads with any of these flags (unmapped, secondary, QC fail, duplicate) are left out of pileups by pysam
+PILEUP_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# Genus to allele maps loaded by load_gene_allele_map, keyed by the path, modification time and size of gene_allele.txt
+gene_allele_maps = dict()
+
+# Pileup contexts (the keyword arguments to read_contig shared by every gene of a sample) loaded by a pileup worker
+worker_pileup_contexts = dict()
+# Number of pileup contexts kept loaded. PileupPool sets this in its workers to the number of samples sharing them
+worker_pileup_context_limit = 4
+# Reads kept by subsample_read_names for the genes a pileup worker has seen, so every window of a gene doesn't have to
+# fetch all of the gene's reads again. Keyed by the BAM file, its modification time, the gene and max_depth
+worker_keep_reads = dict()
+# The keyword arguments in a pileup context that are used to count the bases of a gene, and to call its SNVs
+COUNT_ARGUMENTS = ('bamfile_name', 'reference_fasta', 'fastq_records', 'quality_cutoff', 'fasta', 'max_depth')
+SNV_CALL_ARGUMENTS = ('base_cutoff', 'base_fraction_cutoff', 'fasta', 'error_cutoff')
+
+# Bases are counted in this order in the per-gene pileup arrays. Any other base in a read is counted as an N
+BASES = 'ACGTN'
+BASE_INDEX = {base: index for index, base in enumerate(BASES)}
+UNKNOWN_BASE = BASE_INDEX['N']
+# Categories that characterise_read sorts the bases of each pileup column into
+BASE_CATEGORIES = ('congruent_SNV', 'congruent_ref', 'forward_SNV_reverse_SNV1', 'reverse_SNV_forward_SNV1',
+                   'forward_SNV_reverse_ref', 'reverse_SNV_forward_ref', 'forward_SNV_reverse_UM_QF',
+                   'forward_ref_reverse_UM_QF', 'forward_quality_filtered', 'reverse_SNV_forward_UM_QF',
+                   'reverse_ref_forward_UM_QF', 'reverse_quality_filtered')
+CONGRUENT_SNV, CONGRUENT_REF, FORWARD_SNV_REVERSE_SNV1, REVERSE_SNV_FORWARD_SNV1, FORWARD_SNV_REVERSE_REF, \
+    REVERSE_SNV_FORWARD_REF, FORWARD_SNV_REVERSE_UM_QF, FORWARD_REF_REVERSE_UM_QF, FORWARD_QUALITY_FILTERED, \
+    REVERSE_SNV_FORWARD_UM_QF, REVERSE_REF_FORWARD_UM_QF, REVERSE_QUALITY_FILTERED = range(len(BASE_CATEGORIES))
+# Quality filtered bases don't count towards the coverage of a position
+UNFILTERED_CATEGORIES = [index for index, category in enumerate(BASE_CATEGORIES) if 'filtered' not in category]
+# The types of reads that SNVs are summarised for in the report, and the categories that contribute to each
+READ_TYPES = ('congruent', 'forward', 'reverse', 'paired')
+READ_TYPE_CATEGORIES = ([CONGRUENT_SNV],
+                        [index for index, category in enumerate(BASE_CATEGORIES) if category.startswith('forward_SNV')],
+                        [index for index, category in enumerate(BASE_CATEGORIES) if category.startswith('reverse_SNV')],
+                        UNFILTERED_CATEGORIES)
+
 
 def download_mash_sketch(output_folder):
     logging.info('Downloading mash refseq sketch...')
@@ -67,7 +138,45 @@ def index(output_folder, genera, cgderived=False):
                                               database_folder=output_folder,
                                               allele_list=allele_list)
         # Perform the necessary samtools and KMA indexing
-        index_databases(sample_database=sample_database)
+        if os.path.isfile(sample_database):
+            index_databases(sample_database=sample_database)
+
+
+def prebuild_genus_databases(output_folder, genera=None, processes=1):
+    """
+    Sets up and indexes the rMLST genus-specific databases for many genera at once, spread over a pool of processes,
+    so that samples of those genera don't have to wait for their database to be built the first time they're seen.
+    Databases that already exist are left as they are.
+    :param output_folder: Path to folder where gene_allele.txt and rMLST_combined.fasta are stored.
+    :param genera: List of genera to build databases for. If None, builds databases for every genus in gene_allele.txt
+    :param processes: Number of genera to build at once.
+    """
+    known_genera = load_gene_allele_map(os.path.join(output_folder, 'gene_allele.txt'))
+    if genera is None:
+        genera = list(known_genera)
+    else:
+        for genus in genera:
+            if genus not in known_genera:
+                logging.warning('WARNING: {} is not in the rMLST profiles, so no database can be made for it.'
+                                .format(genus))
+        genera = [genus for genus in genera if genus in known_genera]
+    logging.info('Building databases for {} genera...'.format(len(genera)))
+    with multiprocessing.Pool(processes=processes) as pool:
+        for genus in pool.imap_unordered(prebuild_genus_task, [(output_folder, genus) for genus in genera]):
+            logging.info('Finished database for {}'.format(genus))
+
+
+def prebuild_genus_task(job):
+    """
+    Builds the database for one genus in a prebuild_genus_databases worker.
+    :param job: Tuple of the database folder and genus
+    :return: The genus
+    """
+    output_folder, genus = job
+    index(output_folder=output_folder,
+          genera=[genus],
+          cgderived=False)
+    return genus
 
 
 def run_cmd(cmd):
@@ -158,6 +267,47 @@ def find_unpaired_reads(fastq_directory, forward_id='_R1', reverse_id='_R2', fin
     return read_list
 
 
+def load_gene_allele_map(gene_allele_file):
+    """
+    Loads the alleles of every genus in a gene_allele.txt file. The file is only parsed once: the parsed map is pickled
+    next to it (gene_allele.txt.pickle) for other processes and later runs, and kept in memory for the rest of this one.
+    The pickle is remade whenever gene_allele.txt is newer than it.
+    :param gene_allele_file: Path to gene_allele.txt, as written by confindr_database_setup
+    :return: Dictionary of lists of gene/allele combinations (e.g. BACT000001_30), keyed by genus
+    """
+    stat = os.stat(gene_allele_file)
+    key = (gene_allele_file, stat.st_mtime_ns, stat.st_size)
+    if key in gene_allele_maps:
+        return gene_allele_maps[key]
+    cache_file = gene_allele_file + '.pickle'
+    gene_allele_map = None
+    if os.path.isfile(cache_file) and os.stat(cache_file).st_mtime_ns >= stat.st_mtime_ns:
+        try:
+            with open(cache_file, 'rb') as f:
+                gene_allele_map = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            gene_allele_map = None
+    if gene_allele_map is None:
+        gene_allele_map = dict()
+        with open(gene_allele_file) as f:
+            for line in f:
+                line = line.rstrip()
+                if ':' in line:
+                    genus = line.split(':')[0]
+                    gene_allele_map[genus] = line.split(':')[1].split(',')[:-1]
+        # Write to a temporary file and rename it, so other processes never read a half written pickle. The database
+        # folder may be read-only, in which case the map is parsed again next time.
+        tmp_cache_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        try:
+            with open(tmp_cache_file, 'wb') as f:
+                pickle.dump(gene_allele_map, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_cache_file, cache_file)
+        except OSError:
+            pass
+    gene_allele_maps[key] = gene_allele_map
+    return gene_allele_map
+
+
 def find_genus_specific_allele_list(profiles_file, target_genus):
     """
     A new way of making our specific databases: Make our profiles file have lists of every gene/allele present for
@@ -167,36 +317,65 @@ def find_genus_specific_allele_list(profiles_file, target_genus):
     :param target_genus: Genus you want to make a custom database for (STR)
     :return: List of gene/allele combinations that should be part of species-specific database.
     """
-    alleles = list()
-    with open(profiles_file) as f:
-        lines = f.readlines()
-    for line in lines:
-        line = line.rstrip()
-        genus = line.split(':')[0]
-        if genus == target_genus:
-            alleles = line.split(':')[1].split(',')[:-1]
-    return alleles
+    return list(load_gene_allele_map(profiles_file).get(target_genus, list()))
+
+
+def open_rmlst_index(database_folder):
+    """
+    Opens the on-disk index of rMLST_combined.fasta, so the combined file doesn't have to be scanned every time a
+    genus-specific database is made. The index is an SQLite file next to the FASTA, made by confindr_database_setup or
+    the first time it's needed, and is remade if the FASTA has changed since. If the index can't be written (e.g. the
+    database folder is read-only), the FASTA gets indexed in memory instead.
+    :param database_folder: Path to folder where rMLST_combined is stored.
+    :return: A read-only dictionary of SeqRecords in rMLST_combined.fasta, keyed by ID. Close it when done.
+    """
+    combined_fasta = os.path.join(database_folder, 'rMLST_combined.fasta')
+    index_file = combined_fasta + '.idx'
+    tmp_index_file = '{}.{}.tmp'.format(index_file, os.getpid())
+    try:
+        # Build the index under a lock and a temporary name, so processes sharing the database wait for one index to
+        # be built rather than all building one, and never open half an index
+        with DatabaseLock(combined_fasta):
+            if os.path.isfile(index_file) and os.path.getmtime(index_file) < os.path.getmtime(combined_fasta):
+                os.remove(index_file)
+            if not os.path.isfile(index_file):
+                SeqIO.index_db(tmp_index_file, combined_fasta, 'fasta').close()
+                os.replace(tmp_index_file, index_file)
+        return SeqIO.index_db(index_file, combined_fasta, 'fasta')
+    except (OSError, ValueError, sqlite3.Error):
+        logging.warning('Could not use an index file for {}, indexing it in memory instead.'.format(combined_fasta))
+        if os.path.isfile(tmp_index_file):
+            os.remove(tmp_index_file)
+        return SeqIO.index(combined_fasta, 'fasta')
 
 
 def setup_allelespecific_database(fasta_file, database_folder, allele_list):
     """
     Since some genera have some rMLST genes missing, or two copies of some genes, genus-specific databases are needed.
-    This will take only the alleles known to be part of each genus and write them to a genus-specific file.
+    This will take only the alleles known to be part of each genus and write them to a genus-specific file. If another
+    ConFindr process is already writing the file, waits for it to finish and uses its file instead.
     :param database_folder: Path to folder where rMLST_combined is stored.
     :param fasta_file: Path to fasta file to write allele-specific database to.
     :param allele_list: allele list generated by find_genus_specific_allele_list
     """
-    rmlst_index = SeqIO.index(os.path.join(database_folder, 'rMLST_combined.fasta'), 'fasta')
-    seqs = list()
-    for s in allele_list:
+    with DatabaseLock(fasta_file):
+        if os.path.isfile(fasta_file):
+            return
+        rmlst_index = open_rmlst_index(database_folder)
+        seqs = list()
+        for s in allele_list:
+            try:
+                seqs.append(rmlst_index[s])
+            except KeyError:
+                logging.warning('Tried to add {} to allele-specific database, but could not find it.'.format(s))
+        rmlst_index.close()
+        # Write to a temporary file and rename it, so nothing ever reads a half written database
+        tmp_fasta_file = '{}.{}.tmp'.format(fasta_file, os.getpid())
         try:
-            seqs.append(rmlst_index[s])
-        except KeyError:
-            logging.warning('Tried to add {} to allele-specific database, but could not find it.'.format(s))
-    try:
-        SeqIO.write(seqs, fasta_file, 'fasta')
-    except FileNotFoundError:
-        pass
+            SeqIO.write(seqs, tmp_fasta_file, 'fasta')
+            os.replace(tmp_fasta_file, fasta_file)
+        except FileNotFoundError:
+            pass
 
 
 def find_cross_contamination(databases, reads, sample_name, tmpdir='tmp', log='log.txt', threads=1,
@@ -264,91 +443,166 @@ def number_of_bases_above_threshold(high_quality_base_count, base_count_cutoff=2
     Finds if a site has at least two bases of high quality, enough that it can be considered
     fairly safe to say that base is actually there.
     :param high_quality_base_count: Dictionary of count of HQ bases at a position where key is base and values is the
-    count of that base.
+    count of that base. Can also be an array of counts with bases along the last axis, e.g. (positions x bases) for
+    a whole gene.
     :param base_count_cutoff: Number of bases needed to support multiple allele presence.
     :param base_fraction_cutoff: Fraction of bases needed to support multiple allele presence.
-    :return: True if site has at least base_count_cutoff/base_fraction_cutoff bases, False otherwise
-    (changeable by user)
+    :return: Number of bases that have at least base_count_cutoff/base_fraction_cutoff bases (changeable by user).
+    An array with one value per position if an array of counts was supplied.
     """
+    if isinstance(high_quality_base_count, dict):
+        high_quality_base_count = np.array(list(high_quality_base_count.values()))
+    # True is equal to 1 so sum of the number of Trues is the number of bases passing threshold
+    return bases_above_threshold(base_counts=high_quality_base_count,
+                                 base_count_cutoff=base_count_cutoff,
+                                 base_fraction_cutoff=base_fraction_cutoff).sum(axis=-1)
+
 
-    # make a dict by dictionary comprehension where values are True or False for each base depending on whether the
-    # count meets the threshold.
+def bases_above_threshold(base_counts, base_count_cutoff, base_fraction_cutoff=None):
+    """
+    Determines which bases have enough support to be considered present.
+    :param base_counts: Array of the count of each base, with bases along the last axis
+    :param base_count_cutoff: Number of bases needed to support multiple allele presence.
+    :param base_fraction_cutoff: Fraction of bases needed to support multiple allele presence. If specified, both this
+    and base_count_cutoff must be met
+    :return: Boolean array the same shape as base_counts, True for bases passing the threshold(s)
+    """
+    base_counts = np.asarray(base_counts)
+    # Bases that weren't seen at all can never pass
+    passing = (base_counts >= base_count_cutoff) & (base_counts > 0)
     # Method differs depending on whether absolute or fraction cutoff is specified
     if base_fraction_cutoff:
-        total_hq_base_count = sum(high_quality_base_count.values())
-        bases_above_threshold = {base: float(count) / total_hq_base_count >= base_fraction_cutoff and count
-                                 >= base_count_cutoff for (base, count) in high_quality_base_count.items()}
-    else:
-        bases_above_threshold = {base: count >= base_count_cutoff for (base, count) in high_quality_base_count.items()}
+        total_hq_base_count = base_counts.sum(axis=-1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            passing &= base_counts / total_hq_base_count >= base_fraction_cutoff
+    return passing
 
-    # True is equal to 1 so sum of the number of Trues in the bases_above_threshold dict is the number of bases
-    # passing threshold
-    return sum(bases_above_threshold.values())
 
-
-def parse_bam(bamfile_name, contig_name, pysam_fasta):
+def parse_bam(bamfile_name, contig_name, pysam_fasta, start=None, end=None):
     """
     Use pysam to load the sorted BAM-formatted file, and subsequently the gene-specific read pileup
     :param bamfile_name: Name and path of the sorted BAM file
     :param contig_name: Name of the current gene
     :param pysam_fasta: pysam.FastaFile object created from the reference gene sequence
+    :param start: If set, the pileup only includes the positions from start (0-based) to end
+    :param end: If set, the pileup only includes the positions up to, but not including, end
     :return: bamfile: pysam.AlignmentFile object of the BAM-formatted file
     :return pileup: A pysam pileup object created from the BAM file
     """
     # Load the sorted BAM-formatted file using pysam
     bamfile = pysam.AlignmentFile(bamfile_name, 'rb')
     # These parameters seem to be fairly undocumented with pysam, but I think that they should make the output
-    # that I'm getting to match up with what I'm seeing in Tablet.
+    # that I'm getting to match up with what I'm seeing in Tablet. BAQ and overlapping mate adjustments are turned off
+    # so the qualities of the reads in the pileup are the same as those in the trimmed FASTQ files.
     pileup = bamfile.pileup(contig_name,
+                            start,
+                            end,
+                            truncate=True,
                             stepper='samtools',
                             ignore_orphans=False,
                             fastafile=pysam_fasta,
-                            min_base_quality=0)
+                            min_base_quality=0,
+                            compute_baq=False,
+                            ignore_overlaps=False)
     return bamfile, pileup
 
 
-def characterise_read(column, reference_sequence, fastq_records, quality_cutoff, fasta=False):
+def subsample_read_names(bamfile, contig_name, gene_length, max_depth):
+    """
+    Picks the reads to use for the pileup of a gene so its mean depth is capped at max_depth. Reads are picked by a hash
+    of their name, so both reads of a pair are kept or dropped together, and the same reads are picked every time.
+    :param bamfile: pysam.AlignmentFile of the sorted BAM file
+    :param contig_name: Name of the gene
+    :param gene_length: Length of the gene
+    :param max_depth: Mean depth to cap the gene at
+    :return: Set of the names of the reads to keep, or None if the gene isn't deeper than max_depth and every read
+    should be kept
+    """
+    aligned_bases = 0
+    read_names = set()
+    for read in bamfile.fetch(contig_name):
+        if read.flag & PILEUP_SKIP_FLAGS:
+            continue
+        aligned_bases += read.reference_length
+        read_names.add(read.query_name)
+    depth = aligned_bases / gene_length
+    if depth <= max_depth:
+        return None
+    # Keep each read with probability max_depth / depth, by comparing the (uniformly distributed) 32 bit hash of the
+    # read name against that fraction of 2^32
+    hash_cutoff = max_depth / depth * 2 ** 32
+    return {read_name for read_name in read_names if zlib.crc32(read_name.encode()) < hash_cutoff}
+
+
+def neighbouring_mismatches(alignment, query_position, reference_position, reference_array, mismatch_sums):
+    """
+    Counts the bases within five positions either side of a base in a read that don't match the reference. Each
+    neighbour is compared to the reference base the same distance away from the base's position in the reference, so
+    the bases compared lie on the same diagonal as the base. Neighbours before the start of the read or gene, or in the
+    last base of either, aren't compared. The mismatches along a diagonal of a read are only found once, and kept as a
+    running total, so every other base of the read on the same diagonal is a lookup.
+    :param alignment: pysam.AlignedSegment of the read
+    :param query_position: Position of the base in the read
+    :param reference_position: Position of the base in the gene
+    :param reference_array: Array of the bytes of the reference gene sequence
+    :param mismatch_sums: Dictionary to keep the running totals of mismatches of reads in
+    :return: Number of neighbouring bases that don't match the reference
+    """
+    offset = reference_position - query_position
+    key = (alignment.query_name, alignment.flag, offset)
+    if key not in mismatch_sums:
+        # The range of read positions that can be compared on this diagonal
+        first = max(0, -offset)
+        last = min(alignment.query_alignment_end - 1, len(reference_array) - 1 - offset)
+        query_array = np.frombuffer(alignment.query_sequence.encode(), dtype=np.uint8)
+        mismatches = query_array[first:last] != reference_array[first + offset:last + offset]
+        mismatch_sums[key] = first, np.concatenate(([0], np.cumsum(mismatches)))
+    first, running_total = mismatch_sums[key]
+
+    def mismatches_before(read_position):
+        return int(running_total[min(max(read_position - first, 0), len(running_total) - 1)])
+    # Mismatches in the five bases either side, not counting the base itself
+    return mismatches_before(query_position + 6) - mismatches_before(query_position - 5) - \
+        (mismatches_before(query_position + 1) - mismatches_before(query_position))
+
+
+def characterise_read(column, reference_sequence, fastq_records, quality_cutoff, base_counts, quality_counts,
+                      fasta=False, keep_reads=None, reference_array=None, mismatch_sums=None):
     """
     Parses a column to characterize all the bases present. Determines the number of bases that fit certain criteria
     :param column: A pileupColumn generated by pysam
     :param reference_sequence: String of the FASTA reference gene sequence
-    :param fastq_records: Dictionary of SeqIO records parsed from filtered FASTQ reads
+    :param fastq_records: FastqQualities of the base qualities of the filtered FASTQ reads. If None, qualities are taken
+    from the reads in the BAM file instead
     :param quality_cutoff: Desired min phred quality for a base in order to be counted towards a multi-allelic column
     If specified, both the base_cutoff and base_fraction_cutoff will have to be met
+    :param base_counts: Array of shape (categories, bases) to add the count of each characterised base in the column
+    to. Categories are in the order of BASE_CATEGORIES, and bases in the order of BASES
+    :param quality_counts: List indexed by phred score, used to tally the phred scores of the bases passing filter
     :param fasta: Boolean of whether the samples are in FASTQ or FASTA format
-    :return: filtered_read_dict: Dictionary with of base types: read direction: count
-    :return: qualities: List of all phred scores in the pileup
-    """
-    # Initialise a dictionary to store the base details
-    filtered_read_dict = {
-        'congruent_SNV': dict(),
-        'congruent_ref': dict(),
-        'forward_SNV_reverse_SNV1': dict(),
-        'reverse_SNV_forward_SNV1': dict(),
-        'forward_SNV_reverse_ref': dict(),
-        'reverse_SNV_forward_ref': dict(),
-        'forward_SNV_reverse_UM_QF': dict(),
-        'forward_ref_reverse_UM_QF': dict(),
-        'forward_quality_filtered': dict(),
-        'reverse_SNV_forward_UM_QF': dict(),
-        'reverse_ref_forward_UM_QF': dict(),
-        'reverse_quality_filtered': dict()
-    }
-    # Initialise a dictionary to store the details parsed from the pileup
+    :param keep_reads: Set of the names of the reads to characterise, from subsample_read_names. If None, every read
+    is characterised
+    :param reference_array: Array of the bytes of reference_sequence. Found from reference_sequence if None
+    :param mismatch_sums: Dictionary of the running totals of mismatches of the reads, shared between the columns of a
+    gene so each read is only compared to the reference once. If None, they are only kept for this column
+    """
+    if reference_array is None:
+        reference_array = np.frombuffer(reference_sequence.encode(), dtype=np.uint8)
+    if mismatch_sums is None:
+        mismatch_sums = dict()
+    # Initialise a dictionary to store the (match, base, quality) details parsed from the pileup for each read
     unfiltered_read_details = dict()
-    # Initialise a list to store all the phred scores for the bases passing filter in the column
-    qualities = list()
+    # Extract the sequence of the base in the reference gene
+    ref_base = reference_sequence[column.pos]
     # Iterate through every read present in the column of the pileup
     for read in column.pileups:
+        # Skip the reads left out by subsampling
+        if keep_reads is not None and read.alignment.query_name not in keep_reads:
+            continue
         # Not entirely sure why this is sometimes None, but it causes bad stuff
         if read.query_position is not None:
-            #  Initialise the read name in the dictionary as required
-            if read.alignment.qname not in unfiltered_read_details:
-                unfiltered_read_details[read.alignment.qname] = dict()
             # Extract the sequence of the base in the read
             query_base = read.alignment.query_sequence[read.query_position]
-            # Extract the sequence of the base in the reference gene
-            ref_base = reference_sequence[column.pos]
             # Create a boolean of whether the query base matches the reference base (is it a SNV?)
             match = query_base == ref_base
             # Read names in the pileup have the direction removed - add it back for future parsing. Not an issue for
@@ -358,216 +612,114 @@ def characterise_read(column, reference_sequence, fastq_records, quality_cutoff,
                     read.alignment.qname.split(' ')[0] + '/2'
             else:
                 read_name = read.alignment.qname
-            # Extract the phred quality score from the FASTQ records
-            quality = fastq_records[read_name].letter_annotations["phred_quality"][read.query_position]
-            # Initialise a dictionary to store the ran
-            range_dict = dict()
-            # Determine whether there are SNVs clustered together - they will be discarded from the analysis
-            # Iterate through a range of the five positions preceding, and five subsequent
-            # positions
-            for iterator, contig_pos in enumerate(
-                    chain(range(column.pos - 5, column.pos), range(column.pos + 1, column.pos + 6))):
-                # Ensure that the contig position being examined isn't beyond the length of the gene
-                if 0 <= contig_pos < len(reference_sequence) - 1:
-                    # Calculate the read position corresponding to the current column position
-                    read_pos = list(chain(range(read.query_position - 5, read.query_position),
-                                          range(read.query_position + 1, read.query_position + 6)))[iterator]
-                    # Ensure that read position being examined isn't beyond the length of the read
-                    if 0 <= read_pos < read.alignment.query_alignment_end - 1:
-                        # Populate the dictionary with the calculated positions
-                        range_dict[contig_pos] = read_pos
+            # Extract the phred quality score, either from the FASTQ records or from the read in the BAM file. The
+            # FASTQ records are in the orientation the reads were sequenced in, so reverse strand reads are looked up
+            # from the other end, giving the same qualities as the BAM file
+            if fastq_records is None:
+                quality = read.alignment.query_qualities[read.query_position]
+            else:
+                quality = fastq_records.quality(read_name, read.query_position, read.alignment.is_reverse)
             # Initialise a boolean of whether the current base passes filters, and should be added to the dictionary
             add_base = True
-            # Iterate through the range_dict to extract the sequence of the bases in the range for both the read and
-            # the reference sequence
-            for contig_pos, read_pos in range_dict.items():
-                try:
-                    # Extract the sequence of the base
-                    reference_base = reference_sequence[contig_pos]
-                    base = read.alignment.query_sequence[read_pos]
-                    # If any of the downstream or upstream bases do not match, set the boolean to False
-                    if not match and reference_base != base:
-                        add_base = False
-                except KeyError:
-                    pass
+            # Determine whether there are SNVs clustered together - they will be discarded from the analysis. Bases
+            # that match the reference are kept whatever their neighbours are, so only SNVs need checking
+            if not match:
+                add_base = not neighbouring_mismatches(alignment=read.alignment,
+                                                       query_position=read.query_position,
+                                                       reference_position=column.pos,
+                                                       reference_array=reference_array,
+                                                       mismatch_sums=mismatch_sums)
             # Populate the dictionary only if there are no other SNVs within five downstream and five upstream bases
             if add_base:
-                unfiltered_read_details[read.alignment.qname][read.alignment.is_read1] = {
-                    'mate unmapped': read.alignment.mate_is_unmapped,
-                    'paired': read.alignment.is_paired,
-                    'forward': read.alignment.is_read1,
-                    'reverse': read.alignment.is_read2,
-                    'match': match,
-                    'qbase': query_base,
-                    'rbase': ref_base,
-                    'qual': quality,
-                    'pos': column.pos,
-                    'gene': column.reference_name
-                }
+                if read.alignment.qname not in unfiltered_read_details:
+                    unfiltered_read_details[read.alignment.qname] = dict()
+                unfiltered_read_details[read.alignment.qname][read.alignment.is_read1] = \
+                    (match, BASE_INDEX.get(query_base, UNKNOWN_BASE), quality)
                 # Add the quality of the base
                 if quality >= quality_cutoff:
-                    qualities.append(quality)
+                    quality_counts[quality] += 1
+    if not unfiltered_read_details:
+        return
+    # Tally the characterised bases for the column in a (categories x bases) list before adding them to the array
+    column_counts = [[0] * len(BASES) for _ in BASE_CATEGORIES]
     # Parse the unfiltered reads to characterise the bases
-    for read_base, dir_dict in unfiltered_read_details.items():
+    for dir_dict in unfiltered_read_details.values():
         # Check to see if paired reads are present at this position
         if len(dir_dict) > 1:
+            forward_match, forward_base, forward_qual = dir_dict[True]
+            reverse_match, reverse_base, reverse_qual = dir_dict[False]
             # SNV in both forward and reverse reads
-            if not dir_dict[True]['match'] and not dir_dict[False]['match']:
+            if not forward_match and not reverse_match:
                 # Same SNV sequence - don't quality filter as the reads agreeing acts as a quality check
-                if dir_dict[True]['qbase'] == dir_dict[False]['qbase']:
+                if forward_base == reverse_base:
                     # Forward and reverse SNV - add two matches (for forward and reverse reads)
-                    if dir_dict[True]['qbase'] not in filtered_read_dict['congruent_SNV']:
-                        filtered_read_dict['congruent_SNV'][dir_dict[True]['qbase']] = 2
-                    else:
-                        filtered_read_dict['congruent_SNV'][dir_dict[True]['qbase']] += 2
-                # Different SNV sequences
+                    column_counts[CONGRUENT_SNV][forward_base] += 2
+                # Both SNV sequences pass quality
+                elif forward_qual >= quality_cutoff and reverse_qual >= quality_cutoff:
+                    column_counts[FORWARD_SNV_REVERSE_SNV1][forward_base] += 1
+                    column_counts[REVERSE_SNV_FORWARD_SNV1][reverse_base] += 1
+                # Only the forward reads pass quality
+                elif forward_qual >= quality_cutoff:
+                    column_counts[FORWARD_SNV_REVERSE_UM_QF][forward_base] += 1
+                    column_counts[REVERSE_QUALITY_FILTERED][reverse_base] += 1
+                # Only the reverse reads pass quality
+                elif reverse_qual >= quality_cutoff:
+                    column_counts[REVERSE_SNV_FORWARD_UM_QF][reverse_base] += 1
+                    column_counts[FORWARD_QUALITY_FILTERED][forward_base] += 1
+                # Neither forward nor reverse reads pass quality
                 else:
-                    # Both SNV sequences pass quality
-                    if dir_dict[True]['qual'] >= quality_cutoff and dir_dict[False]['qual'] >= quality_cutoff:
-                        # Forward SNV1
-                        if dir_dict[True]['qbase'] not in filtered_read_dict['forward_SNV_reverse_SNV1']:
-                            filtered_read_dict['forward_SNV_reverse_SNV1'][dir_dict[True]['qbase']] = 1
-                        else:
-                            filtered_read_dict['forward_SNV_reverse_SNV1'][dir_dict[True]['qbase']] += 1
-                        # Reverse SNV2
-                        if dir_dict[False]['qbase'] not in filtered_read_dict['reverse_SNV_forward_SNV1']:
-                            filtered_read_dict['reverse_SNV_forward_SNV1'][dir_dict[False]['qbase']] = 1
-                        else:
-                            filtered_read_dict['reverse_SNV_forward_SNV1'][dir_dict[False]['qbase']] += 1
-                    # Only the forward reads pass quality
-                    elif dir_dict[True]['qual'] >= quality_cutoff:
-                        # Forward SNV reverse QF
-                        if dir_dict[True]['qbase'] not in filtered_read_dict['forward_SNV_reverse_UM_QF']:
-                            filtered_read_dict['forward_SNV_reverse_UM_QF'][dir_dict[True]['qbase']] = 1
-                        else:
-                            filtered_read_dict['forward_SNV_reverse_UM_QF'][dir_dict[True]['qbase']] += 1
-                        # Reverse QF
-                        if dir_dict[False]['qbase'] not in filtered_read_dict['reverse_quality_filtered']:
-                            filtered_read_dict['reverse_quality_filtered'][dir_dict[False]['qbase']] = 1
-                        else:
-                            filtered_read_dict['reverse_quality_filtered'][dir_dict[False]['qbase']] += 1
-                    # Only the reverse reads pass quality
-                    elif dir_dict[False]['qual'] >= quality_cutoff:
-                        # Reverse SNV forward QF
-                        if dir_dict[False]['qbase'] not in filtered_read_dict['reverse_SNV_forward_UM_QF']:
-                            filtered_read_dict['reverse_SNV_forward_UM_QF'][dir_dict[False]['qbase']] = 1
-                        else:
-                            filtered_read_dict['reverse_SNV_forward_UM_QF'][dir_dict[False]['qbase']] += 1
-                        # Forward QF
-                        if dir_dict[True]['qbase'] not in filtered_read_dict['forward_quality_filtered']:
-                            filtered_read_dict['forward_quality_filtered'][dir_dict[True]['qbase']] = 1
-                        else:
-                            filtered_read_dict['forward_quality_filtered'][dir_dict[True]['qbase']] += 1
-                    # Neither forward nor reverse reads pass quality
-                    else:
-                        # Forward QF
-                        if dir_dict[True]['qbase'] not in filtered_read_dict['forward_quality_filtered']:
-                            filtered_read_dict['forward_quality_filtered'][dir_dict[True]['qbase']] = 1
-                        else:
-                            filtered_read_dict['forward_quality_filtered'][dir_dict[True]['qbase']] += 1
-                        # Reverse QF
-                        if dir_dict[False]['qbase'] not in filtered_read_dict['reverse_quality_filtered']:
-                            filtered_read_dict['reverse_quality_filtered'][dir_dict[False]['qbase']] = 1
-                        else:
-                            filtered_read_dict['reverse_quality_filtered'][dir_dict[False]['qbase']] += 1
+                    column_counts[FORWARD_QUALITY_FILTERED][forward_base] += 1
+                    column_counts[REVERSE_QUALITY_FILTERED][reverse_base] += 1
             # SNV in forward read only
-            elif not dir_dict[True]['match'] and dir_dict[False]['match']:
-                # Since only the forward read supports the SNV, quality filter
-                if dir_dict[True]['qual'] >= quality_cutoff:
-                    if dir_dict[True]['qbase'] not in filtered_read_dict['forward_SNV_reverse_ref']:
-                        filtered_read_dict['forward_SNV_reverse_ref'][dir_dict[True]['qbase']] = 1
-                    else:
-                        filtered_read_dict['forward_SNV_reverse_ref'][dir_dict[True]['qbase']] += 1
-                    # Since the reverse base matches the reference, don't quality filter
-                    if dir_dict[False]['qbase'] not in filtered_read_dict['forward_SNV_reverse_ref']:
-                        filtered_read_dict['forward_SNV_reverse_ref'][dir_dict[False]['qbase']] = 1
-                    else:
-                        filtered_read_dict['forward_SNV_reverse_ref'][dir_dict[False]['qbase']] += 1
+            elif not forward_match:
+                # Since only the forward read supports the SNV, quality filter. The reverse base matches the
+                # reference, so don't quality filter it
+                if forward_qual >= quality_cutoff:
+                    column_counts[FORWARD_SNV_REVERSE_REF][forward_base] += 1
+                    column_counts[FORWARD_SNV_REVERSE_REF][reverse_base] += 1
                 # Reverse ref forward QF
                 else:
-                    if dir_dict[False]['qbase'] not in filtered_read_dict['reverse_ref_forward_UM_QF']:
-                        filtered_read_dict['reverse_ref_forward_UM_QF'][dir_dict[False]['qbase']] = 1
-                    else:
-                        filtered_read_dict['reverse_ref_forward_UM_QF'][dir_dict[False]['qbase']] += 1
+                    column_counts[REVERSE_REF_FORWARD_UM_QF][reverse_base] += 1
             # SNV in reverse read only
-            elif dir_dict[True]['match'] and not dir_dict[False]['match']:
-                # Quality filter
-                if dir_dict[False]['qual'] >= quality_cutoff:
-                    if dir_dict[False]['qbase'] not in filtered_read_dict['reverse_SNV_forward_ref']:
-                        filtered_read_dict['reverse_SNV_forward_ref'][dir_dict[False]['qbase']] = 1
-                    else:
-                        filtered_read_dict['reverse_SNV_forward_ref'][dir_dict[False]['qbase']] += 1
-                    # Since the forward base matches the reference, don't quality filter
-                    if dir_dict[True]['qbase'] not in filtered_read_dict['reverse_SNV_forward_ref']:
-                        filtered_read_dict['reverse_SNV_forward_ref'][dir_dict[True]['qbase']] = 1
-                    else:
-                        filtered_read_dict['reverse_SNV_forward_ref'][dir_dict[True]['qbase']] += 1
+            elif not reverse_match:
+                if reverse_qual >= quality_cutoff:
+                    column_counts[REVERSE_SNV_FORWARD_REF][reverse_base] += 1
+                    column_counts[REVERSE_SNV_FORWARD_REF][forward_base] += 1
                 # Forward ref reverse QF
                 else:
-                    if dir_dict[True]['qbase'] not in filtered_read_dict['forward_ref_reverse_UM_QF']:
-                        filtered_read_dict['forward_ref_reverse_UM_QF'][dir_dict[True]['qbase']] = 1
-                    else:
-                        filtered_read_dict['forward_ref_reverse_UM_QF'][dir_dict[True]['qbase']] += 1
+                    column_counts[FORWARD_REF_REVERSE_UM_QF][forward_base] += 1
             # Both reads match the reference sequence - don't quality filter, and add two matches (for forward and
             # reverse reads)
             else:
-                if dir_dict[True]['qbase'] not in filtered_read_dict['congruent_ref']:
-                    filtered_read_dict['congruent_ref'][dir_dict[True]['qbase']] = 2
-                else:
-                    filtered_read_dict['congruent_ref'][dir_dict[True]['qbase']] += 2
+                column_counts[CONGRUENT_REF][forward_base] += 2
         # Either the reads are unpaired, or only a single read aligns to this position on the gene (no overlap)
         else:
-            for direction in dir_dict:
+            for direction, (match, base, qual) in dir_dict.items():
                 # SNV supported by a single read
-                if not dir_dict[direction]['match']:
-                    if dir_dict[direction]['qual'] >= quality_cutoff:
-                        # Forward
+                if not match:
+                    if qual >= quality_cutoff:
                         if direction:
-                            if dir_dict[direction]['qbase'] not in filtered_read_dict['forward_SNV_reverse_UM_QF']:
-                                filtered_read_dict['forward_SNV_reverse_UM_QF'][dir_dict[direction]['qbase']] = 1
-                            else:
-                                filtered_read_dict['forward_SNV_reverse_UM_QF'][dir_dict[direction]['qbase']] += 1
-                        # Reverse
+                            column_counts[FORWARD_SNV_REVERSE_UM_QF][base] += 1
                         else:
-                            if dir_dict[direction]['qbase'] not in filtered_read_dict['reverse_SNV_forward_UM_QF']:
-                                filtered_read_dict['reverse_SNV_forward_UM_QF'][dir_dict[direction]['qbase']] = 1
-                            else:
-                                filtered_read_dict['reverse_SNV_forward_UM_QF'][dir_dict[direction]['qbase']] += 1
+                            column_counts[REVERSE_SNV_FORWARD_UM_QF][base] += 1
                     else:
-                        # Forward QF
-                        if dir_dict[direction]['qbase'] not in filtered_read_dict['forward_quality_filtered']:
-                            filtered_read_dict['forward_quality_filtered'][dir_dict[direction]['qbase']] = 1
-                        else:
-                            filtered_read_dict['forward_quality_filtered'][dir_dict[direction]['qbase']] += 1
-
+                        column_counts[FORWARD_QUALITY_FILTERED][base] += 1
                 # Match to the reference sequence supported by a single read
                 else:
-                    if dir_dict[direction]['qual'] >= quality_cutoff:
-                        # Forward
+                    if qual >= quality_cutoff:
                         if direction:
-                            if dir_dict[direction]['qbase'] not in filtered_read_dict['forward_ref_reverse_UM_QF']:
-                                filtered_read_dict['forward_ref_reverse_UM_QF'][dir_dict[direction]['qbase']] = 1
-                            else:
-                                filtered_read_dict['forward_ref_reverse_UM_QF'][dir_dict[direction]['qbase']] += 1
-                        # Reverse
+                            column_counts[FORWARD_REF_REVERSE_UM_QF][base] += 1
                         else:
-                            if dir_dict[direction]['qbase'] not in filtered_read_dict['reverse_ref_forward_UM_QF']:
-                                filtered_read_dict['reverse_ref_forward_UM_QF'][dir_dict[direction]['qbase']] = 1
-                            else:
-                                filtered_read_dict['reverse_ref_forward_UM_QF'][dir_dict[direction]['qbase']] += 1
+                            column_counts[REVERSE_REF_FORWARD_UM_QF][base] += 1
                     else:
-                        # Reverse QF
-                        if dir_dict[direction]['qbase'] not in filtered_read_dict['reverse_quality_filtered']:
-                            filtered_read_dict['reverse_quality_filtered'][dir_dict[direction]['qbase']] = 1
-                        else:
-                            filtered_read_dict['reverse_quality_filtered'][dir_dict[direction]['qbase']] += 1
-    return filtered_read_dict, qualities
+                        column_counts[REVERSE_QUALITY_FILTERED][base] += 1
+    base_counts += column_counts
 
 
-def determine_cutoff(qualities, reference_sequence, error_cutoff=1.0):
+def determine_cutoff(quality_counts, reference_sequence, error_cutoff=1.0):
     """
     Determine the base cutoff value to use for SNV determination
-    :param qualities: List of phred scores for every base in the pileup
+    :param quality_counts: List or array indexed by phred score of the number of bases in the pileup with that score
     :param reference_sequence: String of the FASTA reference gene sequence
     :param error_cutoff: Float of the error cutoff value to use. Default is 1.0%
     :return: base_cutoff: Int of calculated gene-specific cutoff value to use
@@ -576,14 +728,17 @@ def determine_cutoff(qualities, reference_sequence, error_cutoff=1.0):
     # Initialise the base cutoff to be at least two - FASTA sequences are not processed by this method
     base_cutoff = 2
     depth_prob = 0
+    number_qualities = int(np.sum(quality_counts))
     # Only find the cutoff if there are qualities (the gene is present in the sample)
-    if qualities:
+    if number_qualities:
+        # Find the mean of the phred scores
+        mean_quality = int(np.dot(np.arange(len(quality_counts)), quality_counts)) / number_qualities
         # Convert the gene-specific phred score to its probability e.g phred score of 20 is 1x10^(-20/10) = 1x10^(-2)
         # = 0.01
-        phred_prob = 1 * 10 ** (-(mean(qualities) / 10))
+        phred_prob = 1 * 10 ** (-(mean_quality / 10))
         # Determine the probability that any base in the pileup will be incorrect. Multiply the phred probability by
         # the average depth of the sample (number of bases / length of the gene)
-        depth_prob = phred_prob * len(qualities) / len(reference_sequence)
+        depth_prob = phred_prob * number_qualities / len(reference_sequence)
         # Find the lowest value of the base cutoff that gives a false positive error value under the error cutoff value
         # for the entire length of the gene. Take the depth_prob to the power of the current base_cutoff value.
         # Multiply this by the length of the gene to find find that value for the entire gene, and by 100 to convert
@@ -595,169 +750,43 @@ def determine_cutoff(qualities, reference_sequence, error_cutoff=1.0):
     return base_cutoff, depth_prob ** base_cutoff * 100 * len(reference_sequence)
 
 
-def find_multibase_positions(ref_base, filtered_read_dict, base_cutoff, base_fraction_cutoff):
+def find_multibase_positions(reference_sequence, base_counts, base_cutoff, base_fraction_cutoff):
     """
-
-    :param ref_base: String of the sequence of the reference gene at the current position
-    :param filtered_read_dict: Dictionary with of base types: read direction: count
+    Calls SNVs for every position of a gene at once.
+    :param reference_sequence: String of the FASTA reference gene sequence
+    :param base_counts: Array of shape (positions, categories, bases) of the characterised bases of the gene
     :param base_cutoff: Integer of the number of identical mismatches in a column required for a SNV call
     :param base_fraction_cutoff: Float fraction of bases necessary to support a SNV call
-    :return: snv_dict: Dictionary of characterised bases of the current column e.g. total, number matching reference
-    sequence, number of SNVs in both forward and reverse reads, etc.
-    :return: passing_snv_dict: Dictionary summarising counts of categories of bases e.g. congruent, forward, reverse,
-    paired
-    :return: total_coverage: Integer of the total number of bases passing filter in the pileup
-    """
-    # Initialise a dictionary to store the counts of the characterised bases
-    snv_dict = {
-        'total': 0,
-        'total_congruent': 0,
-        'total_congruent_SNV': 0,
-        'total_forward': 0,
-        'total_forward_SNV': 0,
-        'total_reverse': 0,
-        'total_reverse_SNV': 0,
-        'total_SNV': 0
-    }
-    # Initialise the total depth of the column to zero
-    total_coverage = 0
-    # Initialise a dictionary to store the count for each individual nucleotide at this position e.g. A:24, G:2
-    base_count = dict()
-    # Iterate through the categories e.g. congruent_ref in the dictionary
-    for category, base_dict in filtered_read_dict.items():
-        # Iterate through the sequence of each query base, and the corresponding count
-        for base, count in base_dict.items():
-            # Do not process the base if it has been flagged as 'filtered'
-            if 'filtered' not in category:
-                # Populate the base counting dictionary with the base sequence and increment the count
-                if base not in base_count:
-                    base_count[base] = count
-                else:
-                    base_count[base] += count
-                # Update the total coverage
-                total_coverage += count
-                snv_dict['total'] += count
-            # Forward and reverse reads agree on base
-            if 'congruent' in category:
-                # Congruent reference sequence
-                snv_dict['total_congruent'] += count
-                snv_dict['total_forward'] += int(count / 2)
-                snv_dict['total_reverse'] += int(count / 2)
-                # Congruent SNVs
-                if 'SNV' in category and base != ref_base:
-                    snv_dict['total_congruent_SNV'] += count
-                    snv_dict['total_forward_SNV'] += int(count / 2)
-                    snv_dict['total_reverse_SNV'] += int(count / 2)
-                    snv_dict['total_SNV'] += count
-            # SNV in forward read
-            elif category.startswith('forward_SNV'):
-                snv_dict['total_forward'] += count
-                if base != ref_base:
-                    snv_dict['total_forward_SNV'] += count
-                    snv_dict['total_SNV'] += count
-            # Forward read matches reference
-            elif category.startswith('forward_ref'):
-                snv_dict['total_forward'] += count
-            # SNV in reverse read
-            elif category.startswith('reverse_SNV'):
-                snv_dict['total_reverse'] += count
-                if base != ref_base:
-                    snv_dict['total_reverse_SNV'] += count
-                    snv_dict['total_SNV'] += count
-            # Reverse read match reference
-            elif category.startswith('reverse_ref'):
-                snv_dict['total_reverse'] += count
-    # Initialise a dictionary to store the summary of characterised base types
-    passing_snv_dict = {
-        'congruent': dict(),
-        'forward': dict(),
-        'reverse': dict(),
-        'paired': dict()
-    }
-    # Boolean of whether there are bases passing filter, and the passing_snv_dict should be used
-    return_dict = False
-    # Iterate through the categories in the dictionary
-    for category, base_dict in filtered_read_dict.items():
-        # Iterate through each query base and its corresponding count
-        for base, count in base_dict.items():
-            # Congruent SNVs
-            if 'congruent' in category and base != ref_base:
-                # If the base_cutoff_fraction has been provided, use it in making SNV calls
-                if base_fraction_cutoff:
-                    # Ensure that the number of SNVs in the pileup is greater than the base_cutoff and the
-                    # fraction of SNVs in the pileup is greater than the base_cutoff_fraction
-                    if float(base_count[base] / snv_dict['total']) >= base_fraction_cutoff and base_count[base] \
-                            >= base_cutoff:
-                        # Update the summary dictionary with the base sequence and count
-                        if base not in passing_snv_dict['forward']:
-                            passing_snv_dict['congruent'][base] = count
-                        else:
-                            passing_snv_dict['congruent'][base] += count
-                        return_dict = True
-                # If base_cutoff_fraction is not supplied, only the number of SNVs in the pileup must be greater than
-                # the base_cutoff value in order for a SNV call
-                else:
-                    if base_count[base] >= base_cutoff:
-                        if base not in passing_snv_dict['congruent']:
-                            passing_snv_dict['congruent'][base] = count
-                        else:
-                            passing_snv_dict['congruent'][base] += count
-                    return_dict = True
-            # SNVs in the forward read
-            if category.startswith('forward_SNV') and base != ref_base:
-                if base_fraction_cutoff:
-                    if float(base_count[base] / snv_dict['total']) >= base_fraction_cutoff and base_count[base] \
-                            >= base_cutoff:
-                        if base not in passing_snv_dict['forward']:
-                            passing_snv_dict['forward'][base] = count
-                        else:
-                            passing_snv_dict['forward'][base] += count
-                        return_dict = True
-                else:
-                    if base_count[base] >= base_cutoff:
-                        if base not in passing_snv_dict['forward']:
-                            passing_snv_dict['forward'][base] = count
-                        else:
-                            passing_snv_dict['forward'][base] += count
-                        return_dict = True
-            # SNVs in the reverse read
-            if category.startswith('reverse_SNV') and base != ref_base:
-                if base_fraction_cutoff:
-                    if float(base_count[base] / snv_dict['total']) >= base_fraction_cutoff and base_count[base] \
-                            >= base_cutoff:
-                        if base not in passing_snv_dict['reverse']:
-                            passing_snv_dict['reverse'][base] = count
-                        else:
-                            passing_snv_dict['reverse'][base] += count
-                        return_dict = True
-                else:
-                    if base_count[base] >= base_cutoff:
-                        if base not in passing_snv_dict['reverse']:
-                            passing_snv_dict['reverse'][base] = count
-                        else:
-                            passing_snv_dict['reverse'][base] += count
-                        return_dict = True
-            # All unfiltered bases
-            if base != ref_base and 'filtered' not in category:
-                if base_fraction_cutoff:
-                    if float(base_count[base] / snv_dict['total']) >= base_fraction_cutoff and base_count[base] \
-                            >= base_cutoff:
-                        if base not in passing_snv_dict['paired']:
-                            passing_snv_dict['paired'][base] = count
-                        else:
-                            passing_snv_dict['paired'][base] += count
-                        return_dict = True
-                else:
-                    if base_count[base] >= base_cutoff:
-                        if base not in passing_snv_dict['paired']:
-                            passing_snv_dict['paired'][base] = count
-                        else:
-                            passing_snv_dict['paired'][base] += count
-                        return_dict = True
-    if return_dict:
-        return snv_dict, passing_snv_dict, total_coverage
-    else:
-        return snv_dict, dict(), total_coverage
+    :return: passing_snv_counts: Array of shape (positions, read types, bases) summarising the counts of the SNV bases
+    passing the cutoffs for each of the READ_TYPES (congruent, forward, reverse, paired)
+    :return: multibase_positions: Array of the positions with at least one SNV passing the cutoffs
+    :return: total_coverage: Array of the total number of bases passing filter at each position
+    """
+    # Count of each individual nucleotide at each position e.g. A:24, G:2, ignoring quality filtered bases
+    base_count = base_counts[:, UNFILTERED_CATEGORIES, :].sum(axis=1)
+    total_coverage = base_count.sum(axis=1)
+    # Only bases that differ from the reference can be SNVs
+    reference_bases = np.array([BASE_INDEX.get(base, -1) for base in reference_sequence], dtype=int)
+    is_snv = np.arange(len(BASES)) != reference_bases[:, np.newaxis]
+    # Find the bases with a count (and if provided, a fraction of the pileup) over the cutoffs
+    passing = is_snv & bases_above_threshold(base_counts=base_count,
+                                             base_count_cutoff=base_cutoff,
+                                             base_fraction_cutoff=base_fraction_cutoff)
+    # Summarise the counts of the passing bases for each type of read
+    passing_snv_counts = np.stack([base_counts[:, categories, :].sum(axis=1) for categories in READ_TYPE_CATEGORIES],
+                                  axis=1) * passing[:, np.newaxis, :]
+    multibase_positions = np.flatnonzero(passing.any(axis=1))
+    return passing_snv_counts, multibase_positions, total_coverage
+
+
+def passing_snv_dict(passing_snv_counts):
+    """
+    Convert the passing SNV counts of a position to a dictionary
+    :param passing_snv_counts: Array of shape (read types, bases) from find_multibase_positions
+    :return: Dictionary of read type: base: count, e.g. {'congruent': {'C': 34}, 'forward': {'C': 17}, ...}
+    """
+    return {read_type: {BASES[base]: int(count) for base, count in enumerate(counts) if count}
+            for read_type, counts in zip(READ_TYPES, passing_snv_counts)}
 
 
 def position_details(actual_position, passing_snv_dict, contig_name, ref_base, total_coverage, base_cutoff, error_perc):
@@ -806,83 +835,365 @@ def position_details(actual_position, passing_snv_dict, contig_name, ref_base, t
     return to_write
 
 
-def read_contig(contig_name, bamfile_name, reference_fasta, allele_records, fastq_records, quality_cutoff=20,
-                base_cutoff=None, base_fraction_cutoff=None, fasta=False, error_cutoff=1.0):
+def count_contig_bases(contig_name, bamfile_name, reference_fasta, reference_sequence, fastq_records, quality_cutoff=20,
+                       fasta=False, max_depth=None, start=0, end=None, use_kernel=True):
     """
-    Examines a contig to find if there are positions where more than one base is present.
-    :param contig_name: Name of contig as a string.
+    Walks the pileup of a gene, or of a window of positions in it, counting the characterised bases at each position.
+    Every column of the pileup is characterised independently of its neighbours (the check for nearby SNVs looks at
+    the sequences of the reads, not at other columns), so counting a gene in windows gives the same counts as counting
+    it in one go.
+    :param contig_name: Name of the gene
     :param bamfile_name: Full path to bamfile. Must be sorted/indexed
     :param reference_fasta: Full path to fasta file that was used to generate the bamfile.
-    :param allele_records:
-    :param fastq_records: Dictionary of SeqIO records parsed from filtered FASTQ reads
+    :param reference_sequence: String of the FASTA reference gene sequence
+    :param fastq_records: FastqQualities of the base qualities of the filtered FASTQ reads. If None, qualities are taken
+    from the reads in the BAM file instead
     :param quality_cutoff: Bases must have at least this phred score to be considered (INT)
+    :param fasta: Boolean on whether the samples are in FASTA format. Default is False
+    :param max_depth: If set, genes with a mean depth above this are subsampled down to it before the pileup (INT)
+    :param start: First position of the window to count (0-based). Default is the start of the gene
+    :param end: Position after the last position of the window to count. If None, the end of the gene
+    :param use_kernel: If True, the bases are counted with the compiled pileup kernel when it has been built, which gives
+    the same counts as walking the pileup here, much faster
+    :return: base_counts: Array of shape (positions in the window, categories, bases) of the characterised bases
+    :return: quality_counts: List indexed by phred score of the number of bases passing filter with that score
+    """
+    if end is None:
+        end = len(reference_sequence)
+    pysam_fasta = pysam.FastaFile(reference_fasta)
+    # Parse the BAM file with pysam to create AlignmentFile, and AlignmentFile.pileup objects
+    bamfile, pileup = parse_bam(bamfile_name=bamfile_name,
+                                contig_name=contig_name,
+                                pysam_fasta=pysam_fasta,
+                                start=start,
+                                end=end)
+    # Very deep genes take a long time to walk without changing the result, so cap their depth. The base cutoff is
+    # found from the depth of the subsampled pileup, so it scales down with it. The reads to keep are picked based on
+    # the depth of the whole gene, so every window of a gene keeps the same reads.
+    keep_reads = None
+    if max_depth:
+        key = (bamfile_name, os.stat(bamfile_name).st_mtime_ns, contig_name, max_depth)
+        if key not in worker_keep_reads:
+            worker_keep_reads[key] = subsample_read_names(bamfile=bamfile,
+                                                          contig_name=contig_name,
+                                                          gene_length=len(reference_sequence),
+                                                          max_depth=max_depth)
+            # The reads kept for a gene are capped by max_depth, so plenty of genes can be kept, dropping the oldest
+            while len(worker_keep_reads) > 256:
+                del worker_keep_reads[next(iter(worker_keep_reads))]
+        keep_reads = worker_keep_reads[key]
+    base_counts = np.zeros((end - start, len(BASE_CATEGORIES), len(BASES)), dtype=np.int64)
+    quality_counts = [0] * 256
+    if use_kernel and pileup_kernel is not None and \
+            pileup_kernel.count_bases(bamfile=bamfile,
+                                      contig_name=contig_name,
+                                      reference_sequence=reference_sequence,
+                                      fastq_records=fastq_records,
+                                      quality_cutoff=quality_cutoff,
+                                      fasta=fasta,
+                                      keep_reads=keep_reads,
+                                      start=start,
+                                      end=end,
+                                      base_counts=base_counts,
+                                      quality_counts=quality_counts):
+        bamfile.close()
+        return base_counts, quality_counts
+    reference_array = np.frombuffer(reference_sequence.encode(), dtype=np.uint8)
+    mismatch_sums = dict()
+    for column in pileup:
+        characterise_read(column=column,
+                          reference_sequence=reference_sequence,
+                          fastq_records=fastq_records,
+                          quality_cutoff=quality_cutoff,
+                          base_counts=base_counts[column.pos - start],
+                          quality_counts=quality_counts,
+                          fasta=fasta,
+                          keep_reads=keep_reads,
+                          reference_array=reference_array,
+                          mismatch_sums=mismatch_sums)
+    bamfile.close()
+    return base_counts, quality_counts
+
+
+def call_contig_snvs(contig_name, reference_sequence, base_counts, quality_counts, base_cutoff=None,
+                     base_fraction_cutoff=None, fasta=False, error_cutoff=1.0):
+    """
+    Finds the positions of a gene where more than one base is present, from the bases counted across the whole gene.
+    :param contig_name: Name of the gene
+    :param reference_sequence: String of the FASTA reference gene sequence
+    :param base_counts: Array of shape (positions, categories, bases) of the characterised bases of the gene
+    :param quality_counts: List or array indexed by phred score of the number of bases passing filter with that score
     :param base_cutoff: At least this many bases must support a minor variant (INT)
     :param base_fraction_cutoff: At least this percentage of bases must support minor variant (FLOAT)
     :param fasta: Boolean on whether the samples are in FASTA format. Default is False
     :param error_cutoff: Float of the error cutoff value to use. Default is 1.0%
     :return: Dictionary of positions where more than one base is present. Keys are contig name, values are positions
+    :return: to_write: String of the report lines for the positions
     """
-    pysam_fasta = pysam.FastaFile(reference_fasta)
     multibase_position_dict = dict()
     to_write = str()
     # If analysing FASTA files, a single base difference is all that is expected
     if fasta:
         base_cutoff = 1
-    reference_sequence = str(allele_records[contig_name].seq)
-    # Parse the BAM file with pysam to create AlignmentFile, and AlignmentFile.pileup objects
-    bamfile, pileup = parse_bam(bamfile_name=bamfile_name,
-                                contig_name=contig_name,
-                                pysam_fasta=pysam_fasta)
-    filtered_read_dict = dict()
-    quality_list = list()
-    for i, column in enumerate(pileup):
-        filtered_reads, qualities = characterise_read(column=column,
-                                                      reference_sequence=reference_sequence,
-                                                      fastq_records=fastq_records,
-                                                      quality_cutoff=quality_cutoff,
-                                                      fasta=fasta)
-        filtered_read_dict[i] = filtered_reads
-        quality_list += qualities
     # Initialise the calculated error percentage to zero
     error_perc = None
     if not base_cutoff:
-        base_cutoff, error_perc = determine_cutoff(qualities=quality_list,
+        base_cutoff, error_perc = determine_cutoff(quality_counts=quality_counts,
                                                    reference_sequence=reference_sequence,
                                                    error_cutoff=error_cutoff)
-    bamfile.close()
-    # It seems that the pileup (generator?) is used up above, so it must be recreated
-    bamfile, pileup = parse_bam(bamfile_name=bamfile_name,
-                                contig_name=contig_name,
-                                pysam_fasta=pysam_fasta)
-    for i, column in enumerate(pileup):
+    # Summarise the pileup
+    passing_snv_counts, multibase_positions, total_coverage = \
+        find_multibase_positions(reference_sequence=reference_sequence,
+                                 base_counts=base_counts,
+                                 base_cutoff=base_cutoff,
+                                 base_fraction_cutoff=base_fraction_cutoff)
+    # If there are any SNVs called for the gene, update the multibase_position_dict, and to_write string
+    for position in multibase_positions:
         # Extract the sequence of the reference gene at the current position
-        ref_base = reference_sequence[column.pos]
-        # Summarise the pileup
-        snv_dict, passing_snv_dict, total_coverage = \
-            find_multibase_positions(ref_base=ref_base,
-                                     filtered_read_dict=filtered_read_dict[i],
+        ref_base = reference_sequence[position]
+        snv_dict = passing_snv_dict(passing_snv_counts[position])
+        # Pysam starts counting at 0, whereas we actually want to start counting at 1.
+        actual_position = int(position) + 1
+        # Initialise the gene name in the dictionary as required
+        if contig_name not in multibase_position_dict:
+            multibase_position_dict[contig_name] = dict()
+        # Update the dictionary with the actual position:
+        multibase_position_dict[contig_name].update({actual_position: snv_dict})
+        to_write += position_details(actual_position=actual_position,
+                                     passing_snv_dict=snv_dict,
+                                     contig_name=contig_name,
+                                     ref_base=ref_base,
+                                     total_coverage=int(total_coverage[position]),
                                      base_cutoff=base_cutoff,
-                                     base_fraction_cutoff=base_fraction_cutoff)
-        # If there are any SNVs called for the gene, update the multibase_position_dict, and to_write string
-        if passing_snv_dict:
-            # Pysam starts counting at 0, whereas we actually want to start counting at 1.
-            actual_position = column.pos + 1
-            # Initialise the gene name in the dictionary as required
-            if column.reference_name not in multibase_position_dict:
-                multibase_position_dict[column.reference_name] = dict()
-            # Update the dictionary with the actual position:
-            multibase_position_dict[column.reference_name].update({actual_position: passing_snv_dict})
-            to_write += position_details(actual_position=actual_position,
-                                         passing_snv_dict=passing_snv_dict,
-                                         contig_name=contig_name,
-                                         ref_base=ref_base,
-                                         total_coverage=total_coverage,
-                                         base_cutoff=base_cutoff,
-                                         error_perc=error_perc)
-    bamfile.close()
+                                     error_perc=error_perc)
     return multibase_position_dict, to_write
 
 
+def read_contig(contig_name, bamfile_name, reference_fasta, allele_records, fastq_records, quality_cutoff=20,
+                base_cutoff=None, base_fraction_cutoff=None, fasta=False, error_cutoff=1.0, max_depth=None):
+    """
+    Examines a contig to find if there are positions where more than one base is present.
+    :param contig_name: Name of contig as a string.
+    :param bamfile_name: Full path to bamfile. Must be sorted/indexed
+    :param reference_fasta: Full path to fasta file that was used to generate the bamfile.
+    :param allele_records:
+    :param fastq_records: FastqQualities of the base qualities of the filtered FASTQ reads. If None, qualities are taken
+    from the reads in the BAM file instead
+    :param quality_cutoff: Bases must have at least this phred score to be considered (INT)
+    :param base_cutoff: At least this many bases must support a minor variant (INT)
+    :param base_fraction_cutoff: At least this percentage of bases must support minor variant (FLOAT)
+    :param fasta: Boolean on whether the samples are in FASTA format. Default is False
+    :param error_cutoff: Float of the error cutoff value to use. Default is 1.0%
+    :param max_depth: If set, genes with a mean depth above this are subsampled down to it before the pileup (INT)
+    :return: Dictionary of positions where more than one base is present. Keys are contig name, values are positions
+    """
+    reference_sequence = str(allele_records[contig_name].seq)
+    # Walk the pileup once, counting the characterised bases at each position of the gene. The base cutoff depends on
+    # the qualities of the whole gene, so SNVs are only called once the walk is complete.
+    base_counts, quality_counts = count_contig_bases(contig_name=contig_name,
+                                                     bamfile_name=bamfile_name,
+                                                     reference_fasta=reference_fasta,
+                                                     reference_sequence=reference_sequence,
+                                                     fastq_records=fastq_records,
+                                                     quality_cutoff=quality_cutoff,
+                                                     fasta=fasta,
+                                                     max_depth=max_depth)
+    return call_contig_snvs(contig_name=contig_name,
+                            reference_sequence=reference_sequence,
+                            base_counts=base_counts,
+                            quality_counts=quality_counts,
+                            base_cutoff=base_cutoff,
+                            base_fraction_cutoff=base_fraction_cutoff,
+                            fasta=fasta,
+                            error_cutoff=error_cutoff)
+
+
+class PileupPool(object):
+    """
+    Pool of worker processes for the pileup stage. Starting the workers (and importing pysam, numpy, etc. in each of
+    them) is only done once, so a single pool can be shared by every sample in a run, including samples being analysed
+    at the same time.
+    """
+
+    def read_contigs(self, context_file, pileup_context, contig_names):
+        """
+        Does the same as running read_contig on each gene, but with the genes split into windows of positions that are
+        counted in the worker processes, so a sample can use more workers than it has genes, and a long or deep gene
+        doesn't hold up the rest of the sample. The counts of the windows are combined, and SNVs called, in this
+        process.
+        :param context_file: Pickle written by write_pileup_context with the arguments shared by all the genes
+        :param pileup_context: The dictionary of arguments written to context_file
+        :param contig_names: List of gene names
+        :return: List of the outputs of read_contig for each gene, in the same order as contig_names
+        """
+        reference_sequences = {contig_name: str(pileup_context['allele_records'][contig_name].seq)
+                               for contig_name in contig_names}
+        windows = plan_pileup_windows(contig_lengths=[(contig_name, len(reference_sequences[contig_name]))
+                                                      for contig_name in contig_names],
+                                      workers=self.processes)
+        # Hand out the most expensive windows first, so a sample doesn't end waiting on one deep gene that was started
+        # last
+        costs = estimate_window_costs(bamfile_name=pileup_context['bamfile_name'],
+                                      windows=windows)
+        jobs = [(context_file, ) + window for cost, window in sorted(zip(costs, windows),
+                                                                      key=lambda job: job[0],
+                                                                      reverse=True)]
+        # Put the windows of each gene back together as they finish
+        base_counts = {contig_name: np.zeros((len(reference_sequences[contig_name]), len(BASE_CATEGORIES), len(BASES)),
+                                             dtype=np.int64) for contig_name in contig_names}
+        quality_counts = {contig_name: np.zeros(256, dtype=np.int64) for contig_name in contig_names}
+        for (contig_name, start, end), (window_base_counts, window_quality_counts) in \
+                self.pool.imap_unordered(read_window_job, jobs):
+            base_counts[contig_name][start:end] = window_base_counts
+            quality_counts[contig_name] += window_quality_counts
+        snv_arguments = {key: value for key, value in pileup_context.items() if key in SNV_CALL_ARGUMENTS}
+        return [call_contig_snvs(contig_name=contig_name,
+                                 reference_sequence=reference_sequences[contig_name],
+                                 base_counts=base_counts[contig_name],
+                                 quality_counts=quality_counts[contig_name],
+                                 **snv_arguments)
+                for contig_name in contig_names]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __init__(self, processes, samples=1):
+        """
+        :param processes: Number of worker processes
+        :param samples: Number of samples that will use the pool at the same time, so workers keep the pileup context of
+        each of them loaded rather than loading them again and again
+        """
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes=processes,
+                                         initializer=set_pileup_context_limit,
+                                         initargs=(max(1, samples), ))
+
+
+def plan_pileup_windows(contig_lengths, workers, windows_per_worker=4, min_window_size=250):
+    """
+    Splits genes into windows of positions to spread the pileup stage of a sample over the pileup workers. Genes are
+    only split when there are too few of them to give every worker a few windows, and never into windows shorter than
+    min_window_size, as each window has to open the BAM file and pick its reads.
+    :param contig_lengths: List of (gene name, length) tuples
+    :param workers: Number of pileup workers
+    :param windows_per_worker: Number of windows to aim for per worker, so workers that finish early can pick up more
+    :param min_window_size: Shortest window to split a gene into
+    :return: List of (gene name, start, end) tuples, with the windows of each gene in order
+    """
+    total_length = sum(length for contig_name, length in contig_lengths)
+    window_size = max(min_window_size, math.ceil(total_length / (workers * windows_per_worker)))
+    windows = list()
+    for contig_name, length in contig_lengths:
+        # Split the gene into equal windows, as close to window_size as possible
+        number_windows = max(1, round(length / window_size))
+        size = math.ceil(length / number_windows)
+        windows += [(contig_name, start, min(start + size, length)) for start in range(0, length, size)]
+    return windows
+
+
+def write_pileup_context(context_file, pileup_context):
+    """
+    Writes the arguments to read_contig shared by every gene in a sample to disk, so each pileup worker only has to
+    load them once per sample rather than receive them with every gene.
+    :param context_file: Path to write the pickled arguments to
+    :param pileup_context: Dictionary of keyword arguments for read_contig, other than contig_name
+    """
+    with open(context_file, 'wb') as f:
+        pickle.dump(pileup_context, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_pileup_context(context_file):
+    """
+    Loads the pileup context for a sample, keeping the contexts of the last few samples cached in the worker.
+    :param context_file: Pickle written by write_pileup_context
+    :return: Dictionary of keyword arguments for read_contig
+    """
+    # Include the modification time and size in the key so a rewritten context is never confused with an old one
+    stat = os.stat(context_file)
+    key = (context_file, stat.st_mtime_ns, stat.st_size)
+    if key in worker_pileup_contexts:
+        # Move the context to the end, so the contexts of samples that are still running are the last to be dropped
+        worker_pileup_contexts[key] = worker_pileup_contexts.pop(key)
+    else:
+        with open(context_file, 'rb') as f:
+            worker_pileup_contexts[key] = pickle.load(f)
+        # Samples may be analysed concurrently, so keep a context for each of them, dropping the least recently used
+        while len(worker_pileup_contexts) > worker_pileup_context_limit:
+            del worker_pileup_contexts[next(iter(worker_pileup_contexts))]
+    return worker_pileup_contexts[key]
+
+
+def set_pileup_context_limit(limit):
+    """
+    Sets the number of pileup contexts a pileup worker keeps loaded. Runs when each PileupPool worker starts.
+    :param limit: Number of contexts to keep
+    """
+    global worker_pileup_context_limit
+    worker_pileup_context_limit = limit
+
+
+def estimate_window_costs(bamfile_name, windows):
+    """
+    Estimates how long the pileup of each window will take, from the number of reads mapped to each gene in the BAM
+    index, times the length of the window.
+    :param bamfile_name: Full path to bamfile. Must be sorted/indexed
+    :param windows: List of (gene name, start, end) tuples from plan_pileup_windows
+    :return: List of the estimated cost of each window
+    """
+    with pysam.AlignmentFile(bamfile_name, 'rb') as bamfile:
+        mapped_reads = {index_stats.contig: index_stats.mapped for index_stats in bamfile.get_index_statistics()}
+    return [mapped_reads.get(contig_name, 0) * (end - start) for contig_name, start, end in windows]
+
+
+def read_window_job(job):
+    """
+    Runs read_window_task for PileupPool.read_contigs, returning the window along with its counts so the counts can be
+    put back in the right place whatever order the windows finish in.
+    :param job: Tuple of the context file, gene name, start and end of the window
+    :return: The (gene name, start, end) of the window, and the outputs of read_window_task
+    """
+    context_file, contig_name, start, end = job
+    return (contig_name, start, end), read_window_task(context_file=context_file,
+                                                       contig_name=contig_name,
+                                                       start=start,
+                                                       end=end)
+
+
+def read_window_task(context_file, contig_name, start, end):
+    """
+    Counts the bases in a window of a gene, using the arguments stored in a pileup context file
+    :param context_file: Pickle written by write_pileup_context
+    :param contig_name: Name of the gene
+    :param start: First position of the window
+    :param end: Position after the last position of the window
+    :return: The outputs of count_contig_bases
+    """
+    pileup_context = load_pileup_context(context_file)
+    return count_contig_bases(contig_name=contig_name,
+                              reference_sequence=str(pileup_context['allele_records'][contig_name].seq),
+                              start=start,
+                              end=end,
+                              **{key: value for key, value in pileup_context.items() if key in COUNT_ARGUMENTS})
+
+
+def read_contig_task(context_file, contig_name):
+    """
+    Runs read_contig on a gene, using the arguments stored in a pileup context file
+    :param context_file: Pickle written by write_pileup_context
+    :param contig_name: Name of the gene
+    :return: The outputs of read_contig
+    """
+    return read_contig(contig_name=contig_name,
+                       **load_pileup_context(context_file))
+
+
 def find_rmlst_type(kma_report, rmlst_report):
     """
     Uses a report generated by KMA to determine what allele is present for each rMLST gene.
@@ -962,67 +1273,655 @@ def estimate_percent_contamination(contamination_report_file):
     return '%.2f' % (np.mean(contam_levels)), '%.2f' % np.std(contam_levels)
 
 
-def load_fastq_records(gz, paired, forward):
+class FastqQualities(object):
+    """
+    Compact store of the base qualities of a set of reads. Rather than keeping a SeqRecord for every read, the phred
+    scores of all reads are concatenated into a single buffer, and each read name maps to its slice of that buffer.
+    """
+
+    # Translation table to convert phred+33 encoded quality characters to their phred scores
+    phred_table = bytes((i - 33) % 256 for i in range(256))
+
+    def add(self, read_name, quality_string):
+        """
+        Add the qualities of a read to the store
+        :param read_name: Name of the read (STR)
+        :param quality_string: Phred+33 encoded quality line from the FASTQ file (BYTES)
+        """
+        self.read_index[read_name] = len(self.offsets) - 1
+        self.buffer += quality_string.translate(self.phred_table)
+        self.offsets.append(len(self.buffer))
+
+    def update(self, other):
+        """
+        Add all the reads from another FastqQualities object to this one
+        :param other: FastqQualities object
+        """
+        shift = len(self.buffer)
+        first_read = len(self.offsets) - 1
+        self.buffer += other.buffer
+        self.offsets.extend(offset + shift for offset in other.offsets[1:])
+        for read_name, index in other.read_index.items():
+            self.read_index[read_name] = first_read + index
+
+    def quality(self, read_name, position, reverse=False):
+        """
+        :param read_name: Name of the read (STR)
+        :param position: 0-based position in the read, as in the BAM file
+        :param reverse: Whether the read is mapped to the reverse strand. BAM files store these reads reverse
+        complemented, so the position is counted from the other end of the read as it was sequenced (BOOL)
+        :return: Phred score of the base at that position of the read (INT)
+        """
+        index = self.read_index[read_name]
+        if reverse:
+            return self.buffer[self.offsets[index + 1] - 1 - position]
+        return self.buffer[self.offsets[index] + position]
+
+    def __getitem__(self, read_name):
+        index = self.read_index[read_name]
+        return list(self.buffer[self.offsets[index]:self.offsets[index + 1]])
+
+    def __contains__(self, read_name):
+        return read_name in self.read_index
+
+    def __len__(self):
+        return len(self.read_index)
+
+    def __init__(self):
+        self.read_index = dict()
+        self.buffer = bytearray()
+        # Offset of the start of each read in the buffer, with the end of the last read as the final entry
+        self.offsets = array('Q', [0])
+
+
+def load_fastq_records(gz, paired, forward, records=None):
     """
-    Use SeqIO to load FASTQ records from file
-    :param gz: Name and path of FASTQ file
+    Stream the base qualities from a FASTQ file into a FastqQualities store. Records are expected to be in the four line
+    format written by BBTools
+    :param gz: Binary mode file handle of the FASTQ file
     :param paired: Boolean of whether the reads are paired
     :param forward: Boolean of whether the current reads are in the forward direction
-    :return: records: Dictionary of SeqIO parsed FASTQ records with consistent ID naming
+    :param records: FastqQualities to add the reads to. If not provided, a new one is created
+    :return: records: FastqQualities of the reads, with consistent ID naming
+    :raises ValueError: If the last record in the file is missing any of its lines
     """
-    # Initialise a dictionary to store the FASTQ records
-    records = dict()
-    # Iterate through the reads
-    for record in SeqIO.parse(gz, 'fastq'):
-        # Only update the naming scheme for paired reads
-        if paired:
-            if forward:
-                # Change a :1: to /1 in the record.id
-                if ':1:' in record.id:
-                    record.id = record.id + '/1'
-                # Don't worry if the record.id already has a /1
-                elif '/1' in record.id:
-                    pass
-                # If the record.id doesn't have a read direction, add /1
-                else:
-                    record.id = record.id + '/1'
-            # Process reverse reads in a similar fashion to forward reads
-            else:
-                if ':2:' in record.id:
-                    record.id = record.id + '/2'
-                elif '/2' in record.id:
-                    pass
-                else:
-                    record.id = record.id + '/2'
-        else:
-            pass
-        records.update(SeqIO.to_dict([record]))
+    # Initialise the store for the qualities
+    if records is None:
+        records = FastqQualities()
+    direction = '/1' if forward else '/2'
+    for header in gz:
+        # Skip the sequence and the separator lines
+        try:
+            next(gz)
+            next(gz)
+            quality_string = next(gz).rstrip()
+        except StopIteration:
+            raise ValueError('FASTQ file {} is truncated: the last record ({}) does not have all four lines.'
+                             .format(getattr(gz, 'name', 'of reads'), header.rstrip().decode())) from None
+        # The read ID is everything in the header up to the first whitespace
+        read_id = header[1:].split(None, 1)[0].decode()
+        # Only update the naming scheme for paired reads. Read IDs already ending in the direction (e.g. /1) are left
+        # alone, while IDs without one (e.g. with a :1: in the comment) have it added
+        if paired and direction not in read_id:
+            read_id += direction
+        records.add(read_id, quality_string)
     return records
 
 
+def open_reads(reads_file):
+    """
+    Opens a FASTQ file for binary reading, decompressing it if it is gzipped
+    :param reads_file: Path to the FASTQ file
+    :return: Binary mode file handle
+    """
+    if reads_file.endswith('.gz'):
+        return gzip.open(reads_file, 'rb')
+    return open(reads_file, 'rb')
+
+
 def index_databases(sample_database):
     """
-    Index the database file with pysam and kma
+    Index the database file with pysam and kma. If another ConFindr process is already indexing the database, waits for
+    it to finish instead of indexing it again.
     :param sample_database:
+    :return: kma_database: Name of the KMA database to give to kma with -t_db
     """
-    if not os.path.isfile(sample_database + '.fai'):  # Don't bother re-indexing, this only needs to happen once.
-        try:
-            pysam.faidx(sample_database)
-        except pysam.utils.SamtoolsError:
-            pass
     kma_database = sample_database.replace('.fasta', '') + '_kma'
+    with DatabaseLock(sample_database):
+        if not os.path.isfile(sample_database + '.fai'):  # Don't bother re-indexing, this only needs to happen once.
+            try:
+                pysam.faidx(sample_database)
+            except pysam.utils.SamtoolsError as e:
+                logging.error('ERROR: Could not index {} with samtools faidx.'.format(sample_database))
+                if os.path.isfile(sample_database + '.fai'):
+                    os.remove(sample_database + '.fai')
+                raise subprocess.CalledProcessError(returncode=1,
+                                                    cmd='samtools faidx {}'.format(sample_database),
+                                                    output=str(e))
+
+        # The .name is one of the files KMA creates when making a database.
+        if not os.path.isfile(kma_database + '.name'):
+            logging.info('Since this is the first time you are using this database, it needs to be indexed by KMA. '
+                         'This might take a while')
+            # Index under a temporary name, and rename the files into place when KMA is done, so nothing ever uses a
+            # half built database. The .name file is moved last, as that's what says the database is there.
+            tmp_kma_database = '{}.{}.tmp'.format(kma_database, os.getpid())
+            # NOTE: Need KMA >=1.2.0 for this to work.
+            cmd = 'kma index -i {} -o {}'.format(sample_database, tmp_kma_database)
+            out = str()
+            log = sample_database + '_log.txt'
+            try:
+                out, err = run_cmd(cmd)
+                write_to_logfile(log, out, err, cmd)
+            except subprocess.CalledProcessError as e:
+                write_to_logfile(log, out, e, cmd)
+                logging.error('ERROR: Could not index {} with KMA. See {} for details.'.format(sample_database, log))
+                for tmp_file in glob.glob(tmp_kma_database + '.*'):
+                    os.remove(tmp_file)
+                raise
+            tmp_files = sorted(glob.glob(tmp_kma_database + '.*'), key=lambda tmp_file: tmp_file.endswith('.name'))
+            for tmp_file in tmp_files:
+                os.replace(tmp_file, kma_database + tmp_file[len(tmp_kma_database):])
+    return kma_database
+
+
+class DatabaseLock(object):
+    """
+    Advisory lock on a database, held while it is set up or indexed, so that ConFindr processes sharing a database
+    folder (or samples being analysed at the same time) wait for one of them to build a database rather than all
+    building it at once. The lock is taken on a .lock file next to the database. If that can't be created, e.g. because
+    the database folder is read-only, nothing can be building the database either, so no lock is taken.
+    """
 
-    if not os.path.isfile(kma_database + '.name'):  # The .name is one of the files KMA creates when making a database.
-        logging.info('Since this is the first time you are using this database, it needs to be indexed by KMA. '
-                     'This might take a while')
-        cmd = 'kma index -i {} -o {}'.format(sample_database, kma_database)  # NOTE: Need KMA >=1.2.0 for this to work.
-        out = str()
+    def __enter__(self):
         try:
-            out, err = run_cmd(cmd)
-        except subprocess.CalledProcessError as e:
-            err = e
-        log = sample_database + '_log.txt'
+            self.lock_file = open(self.database + '.lock', 'a')
+        except OSError:
+            return self
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info('Waiting for another ConFindr process to finish setting up {}...'.format(self.database))
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+    def __init__(self, database):
+        self.database = database
+        self.lock_file = None
+
+
+class KmaSharedMemory(object):
+    """
+    Keeps KMA databases loaded in shared memory for a whole run, so kma doesn't have to load the database from disk for
+    every sample. Each database is loaded the first time a sample needs it, and counts the samples using it. Databases
+    stay loaded between samples, as the next sample is likely to be the same genus, and are removed from shared memory
+    when the run closes the KmaSharedMemory, or when Python exits.
+    """
+
+    def acquire(self, kma_database):
+        """
+        Makes sure a database is loaded into shared memory, and counts one more sample as using it.
+        :param kma_database: KMA database, as given to kma with -t_db
+        :return: The level to give kma with -shm, or None if the database couldn't be put in shared memory, in which
+        case kma should load it from disk as usual
+        """
+        with self.lock:
+            if kma_database in self.failed:
+                return None
+            if kma_database not in self.users:
+                logging.info('Loading {} into shared memory...'.format(kma_database))
+                try:
+                    kma.shm_load(database=kma_database,
+                                 level=self.level)
+                except subprocess.CalledProcessError:
+                    logging.warning('Could not load {} into shared memory, KMA will load it from disk instead.'
+                                    .format(kma_database))
+                    self.failed.add(kma_database)
+                    return None
+                self.users[kma_database] = 0
+            self.users[kma_database] += 1
+            return self.level
+
+    def release(self, kma_database):
+        """
+        Counts one less sample as using a database acquired with acquire.
+        :param kma_database: KMA database, as given to kma with -t_db
+        """
+        with self.lock:
+            self.users[kma_database] -= 1
+
+    def close(self):
+        """
+        Removes all the databases from shared memory.
+        """
+        with self.lock:
+            for kma_database, users in self.users.items():
+                if users:
+                    logging.warning('Removing {} from shared memory while {} samples are still using it'
+                                    .format(kma_database, users))
+                try:
+                    kma.shm_destroy(database=kma_database,
+                                    level=self.level)
+                except subprocess.CalledProcessError:
+                    logging.warning('Could not remove {} from shared memory. Remove it with kma shm -t_db {} '
+                                    '-shmLvl {} -destroy'.format(kma_database, kma_database, self.level))
+            self.users.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __init__(self, level=1):
+        self.level = level
+        self.lock = threading.Lock()
+        self.users = dict()
+        self.failed = set()
+        # Shared memory outlives the processes using it, so never leave databases behind, even if a run crashes
+        atexit.register(self.close)
+
+
+def bbmap_index(reference, index_folder, log, threads=1, xmx=None):
+    """
+    Finds or builds a BBMap index for a reference in a folder of cached indexes. Indexes are keyed by the contents of
+    the reference, so samples that end up with the same set of alleles share one index, rather than BBMap building a
+    new one in memory for every sample.
+    :param reference: Reference fasta.
+    :param index_folder: Folder the cached indexes are kept in.
+    :param log: Logfile to write to.
+    :param threads: Number of threads to build the index with.
+    :param xmx: if None, BBTools will use auto memory detection. If string, BBTools will use what's specified as their
+    memory request.
+    :return: Path to the index, to give to bbmap.sh with path=, or None if the index couldn't be built.
+    """
+    with open(reference, 'rb') as f:
+        reference_hash = hashlib.sha1(f.read()).hexdigest()
+    index_path = os.path.join(index_folder, reference_hash)
+    if os.path.isdir(index_path):
+        return index_path
+    try:
+        if not os.path.isdir(index_folder):
+            os.makedirs(index_folder, exist_ok=True)
+        # Build the index in a temporary folder and rename it into place, so no sample ever sees half an index
+        tmp_index_path = tempfile.mkdtemp(dir=index_folder)
+    except OSError:
+        logging.debug('Could not write to {}, BBMap will index the reference in memory'.format(index_folder))
+        return None
+    cmd = 'bbmap.sh ref={ref} path={path} threads={threads}'.format(ref=reference,
+                                                                    path=tmp_index_path,
+                                                                    threads=threads)
+    if xmx:
+        cmd += ' -Xmx{}'.format(xmx)
+    try:
+        out, err = run_cmd(cmd)
+        write_to_logfile(log, out, err, cmd)
+    except subprocess.CalledProcessError:
+        logging.debug('Could not build a BBMap index for {}, BBMap will index the reference in memory'
+                      .format(reference))
+        shutil.rmtree(tmp_index_path)
+        return None
+    try:
+        os.rename(tmp_index_path, index_path)
+    except OSError:
+        # Another sample with the same alleles got there first
+        shutil.rmtree(tmp_index_path)
+    return index_path
+
+
+def mappy_segment(hit, name, sequence, qualities, reference_ids, read_number=0, mate_hit=None):
+    """
+    Converts a mappy alignment of a read into a pysam AlignedSegment, laid out the way BBMap would have written it.
+    :param hit: mappy Alignment of the read
+    :param name: Name of the read, without any /1 or /2
+    :param sequence: Sequence of the read, as it was in the FASTQ file
+    :param qualities: Quality string of the read, as it was in the FASTQ file
+    :param reference_ids: Dictionary of the index of each reference sequence in the BAM header
+    :param read_number: 1 or 2 for the forward or reverse read of a pair, 0 for unpaired reads
+    :param mate_hit: mappy Alignment of the other read in the pair, or None if it didn't map
+    :return: The AlignedSegment
+    """
+    segment = pysam.AlignedSegment()
+    segment.query_name = name
+    read_length = len(sequence)
+    # mappy gives query coordinates on the read as sequenced, while BAM records store reverse strand reads reverse
+    # complemented, with the CIGAR running along the reference
+    if hit.strand == -1:
+        sequence = sequence.translate(COMPLEMENT)[::-1]
+        qualities = qualities[::-1]
+        left_clip, right_clip = read_length - hit.q_en, hit.q_st
+    else:
+        left_clip, right_clip = hit.q_st, read_length - hit.q_en
+    segment.query_sequence = sequence
+    segment.query_qualities = pysam.qualitystring_to_array(qualities)
+    cigar = [(operation, length) for length, operation in hit.cigar]
+    if left_clip:
+        cigar.insert(0, (4, left_clip))
+    if right_clip:
+        cigar.append((4, right_clip))
+    segment.cigartuples = cigar
+    segment.reference_id = reference_ids[hit.ctg]
+    segment.reference_start = hit.r_st
+    segment.mapping_quality = hit.mapq
+    segment.set_tag('NM', hit.NM)
+    flag = 0x10 if hit.strand == -1 else 0
+    if read_number:
+        flag |= 0x1 | (0x40 if read_number == 1 else 0x80)
+        if mate_hit is None:
+            flag |= 0x8
+        else:
+            if mate_hit.strand == -1:
+                flag |= 0x20
+            segment.next_reference_id = reference_ids[mate_hit.ctg]
+            segment.next_reference_start = mate_hit.r_st
+            if mate_hit.ctg == hit.ctg and mate_hit.strand != hit.strand:
+                flag |= 0x2
+                template_length = max(hit.r_en, mate_hit.r_en) - min(hit.r_st, mate_hit.r_st)
+                leftmost = hit.r_st < mate_hit.r_st or (hit.r_st == mate_hit.r_st and read_number == 1)
+                segment.template_length = template_length if leftmost else -template_length
+    segment.flag = flag
+    return segment
+
+
+def map_reads_mappy(reference, read_files, sorted_bam, max_substitutions=None):
+    """
+    Maps reads to a small reference in-process with minimap2's python bindings, and writes them straight to a sorted
+    BAM file. This avoids starting a JVM, and going through an unsorted file that then has to be sorted. All the mapped
+    reads are held in memory while sorting, which is fine for baited reads.
+    :param reference: Reference fasta.
+    :param read_files: List with the forward and reverse reads, or just the unpaired reads.
+    :param sorted_bam: Path to write the sorted BAM file to.
+    :param max_substitutions: If not None, reads with more substitutions than this are left out, like BBMap's subfilter
+    """
+    if mappy is None:
+        raise ImportError('mappy needs to be installed to use it for mapping. Install it with pip install mappy')
+    aligner = mappy.Aligner(reference, preset='sr')
+    if not aligner:
+        raise ValueError('mappy could not load or index {}'.format(reference))
+    references = [(record.id, len(record.seq)) for record in SeqIO.parse(reference, 'fasta')]
+    reference_ids = {reference_name: index for index, (reference_name, length) in enumerate(references)}
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': reference_name, 'LN': length} for reference_name, length in references]}
+
+    def best_hits(hits):
+        # mappy marks supplementary (split) alignments as primary too, but returns the best alignment of each read
+        # first. Only that one is kept, as BBMap reports one alignment per read, and it is dropped if it has too many
+        # substitutions rather than replaced by a worse one.
+        best = dict()
+        for hit in hits:
+            if hit.is_primary and hit.read_num not in best:
+                best[hit.read_num] = hit
+        if max_substitutions is not None:
+            for read_number, hit in list(best.items()):
+                gaps = sum(length for length, operation in hit.cigar if operation in (1, 2))
+                if hit.NM - gaps > max_substitutions:
+                    del best[read_number]
+        return best
+
+    def read_name(name):
+        return name[:-2] if name.endswith(('/1', '/2')) else name
+
+    segments = list()
+    if len(read_files) == 2:
+        for (name, forward_sequence, forward_qualities), (_, reverse_sequence, reverse_qualities) in \
+                zip(mappy.fastx_read(read_files[0]), mappy.fastx_read(read_files[1])):
+            hits = best_hits(aligner.map(forward_sequence, reverse_sequence))
+            for read_number, sequence, qualities in ((1, forward_sequence, forward_qualities),
+                                                     (2, reverse_sequence, reverse_qualities)):
+                if read_number in hits:
+                    segments.append(mappy_segment(hit=hits[read_number],
+                                                  name=read_name(name),
+                                                  sequence=sequence,
+                                                  qualities=qualities,
+                                                  reference_ids=reference_ids,
+                                                  read_number=read_number,
+                                                  mate_hit=hits.get(3 - read_number)))
+    else:
+        for name, sequence, qualities in mappy.fastx_read(read_files[0]):
+            for hit in best_hits(aligner.map(sequence)).values():
+                segments.append(mappy_segment(hit=hit,
+                                              name=read_name(name),
+                                              sequence=sequence,
+                                              qualities=qualities,
+                                              reference_ids=reference_ids))
+    segments.sort(key=lambda segment: (segment.reference_id, segment.reference_start))
+    with pysam.AlignmentFile(sorted_bam, 'wb', header=header) as bam:
+        for segment in segments:
+            bam.write(segment)
+
+
+def select_sample_database(genus, databases_folder, tmpdir=None, cgmlst_db=None, use_rmlst=False, create_database=True):
+    """
+    Picks the database to bait and map reads against for a genus, setting up the genus-specific rMLST database if it
+    doesn't exist yet.
+    :param genus: Genus of the sample, as found by find_cross_contamination.
+    :param databases_folder: Full path to folder where ConFindr's databases live.
+    :param tmpdir: if None, any genus-specifc databases that need to be created will be written to ConFindr DB location.
+    :param cgmlst_db: if None, we're using rMLST, if a path, using some sort of custom cgMLST database.
+    :param use_rmlst: If False, use cgderived data instead of rMLST where possible. If True, always use rMLST. (BOOL)
+    :param create_database: If False, the genus-specific rMLST database isn't set up if it doesn't exist yet. (BOOL)
+    :return: sample_database: Path to the database. May not exist if there is no database available for the genus.
+    """
+    if cgmlst_db is not None:
+        # Sanity check that the DB specified is actually a file, otherwise, quit with appropriate error message.
+        if not os.path.isfile(cgmlst_db):
+            logging.error('ERROR: Specified cgMLST file ({}) does not exist. Please check the path and try again.'
+                          .format(cgmlst_db))
+            quit(code=1)
+        sample_database = cgmlst_db
+    else:
+        db_folder = databases_folder if tmpdir is None else tmpdir
+        if not os.path.isdir(db_folder):
+            os.makedirs(db_folder)
+        if genus != 'ND':
+            # Logic here is as follows: users can either have both rMLST databases, which cover all of bacteria,
+            # cgmlst-derived databases, which cover only Escherichia, Salmonella, and Listeria (may add more at some
+            # point), or they can have both. They can also set priority to either always use rMLST, or to use my
+            # core-genome derived stuff and fall back on rMLST if they're trying to look at a genus I haven't created
+            # a scheme for.
+            #
+            if len(genus.split(':')) > 1:
+                predominant_genus = genus.split(':')[0]
+            else:
+                predominant_genus = genus
+            # In the event rmlst databases have priority, always use them.
+            if use_rmlst is True:
+                sample_database = os.path.join(db_folder, '{}_db.fasta'.format(predominant_genus))
+                if not os.path.isfile(sample_database) and create_database:
+
+                    if os.path.isfile(os.path.join(databases_folder, 'gene_allele.txt')) and \
+                            os.path.isfile(os.path.join(databases_folder, 'rMLST_combined.fasta')):
+                        logging.info('Setting up rMLST genus-specific database for genus {}...'
+                                     .format(predominant_genus))
+                        allele_list = find_genus_specific_allele_list(
+                            os.path.join(databases_folder, 'gene_allele.txt'), predominant_genus)
+                        # Create the allele-specific database
+                        setup_allelespecific_database(fasta_file=sample_database,
+                                                      database_folder=databases_folder,
+                                                      allele_list=allele_list)
+            else:
+                # Check if a cgderived database is available. If not, try to use rMLST database.
+                sample_database = os.path.join(db_folder, '{}_db_cgderived.fasta'.format(predominant_genus))
+                if not os.path.isfile(sample_database):
+                    sample_database = os.path.join(db_folder, '{}_db.fasta'.format(predominant_genus))
+                    # Create genus specific database if it doesn't already exist and we have the necessary rMLST files.
+                    if create_database and os.path.isfile(os.path.join(databases_folder, 'rMLST_combined.fasta')) and \
+                            os.path.isfile(os.path.join(databases_folder, 'gene_allele.txt')) and not \
+                            os.path.isfile(sample_database):
+                        logging.info('Setting up core genome genus-specific database for genus {}...'
+                                     .format(predominant_genus))
+                        allele_list = find_genus_specific_allele_list(
+                            os.path.join(databases_folder, 'gene_allele.txt'), predominant_genus)
+                        setup_allelespecific_database(fasta_file=sample_database,
+                                                      database_folder=databases_folder,
+                                                      allele_list=allele_list)
+
+        else:
+            sample_database = os.path.join(db_folder, 'rMLST_combined.fasta')
+    return sample_database
+
+
+def most_common_genus(output_report):
+    """
+    Finds the genus (or the predominant genus, for cross-contaminated samples) seen most often in a ConFindr report.
+    Samples that failed to be analysed are ignored.
+    :param output_report: Path to CSV output report file.
+    :return: The most common genus, or ND if the report doesn't exist or has no samples in it.
+    """
+    genus_counts = dict()
+    with report_lock:
+        if not os.path.isfile(output_report):
+            return 'ND'
+        with open(output_report) as f:
+            for row in csv.DictReader(f):
+                if row['Genus'] == 'Error processing sample':
+                    continue
+                predominant_genus = row['Genus'].split(':')[0]
+                genus_counts[predominant_genus] = genus_counts.get(predominant_genus, 0) + 1
+    if not genus_counts:
+        return 'ND'
+    return max(genus_counts, key=genus_counts.get)
+
+
+def guess_sample_database(output_report, databases_folder, tmpdir=None, cgmlst_db=None, use_rmlst=False):
+    """
+    Guesses which database a sample will end up using before its genus is known, assuming it is most likely to be the
+    same genus as most of the samples already in the report. Samples in a run tend to be of the same genus.
+    :param output_report: Path to CSV output report file.
+    :param databases_folder: Full path to folder where ConFindr's databases live.
+    :param tmpdir: if None, any genus-specifc databases that need to be created will be written to ConFindr DB location.
+    :param cgmlst_db: if None, we're using rMLST, if a path, using some sort of custom cgMLST database.
+    :param use_rmlst: If False, use cgderived data instead of rMLST where possible. If True, always use rMLST. (BOOL)
+    :return: Path to the database that is most likely to be used. Databases aren't set up just for a guess, so this may
+    not exist yet.
+    """
+    return select_sample_database(genus=most_common_genus(output_report),
+                                  databases_folder=databases_folder,
+                                  tmpdir=tmpdir,
+                                  cgmlst_db=cgmlst_db,
+                                  use_rmlst=use_rmlst,
+                                  create_database=False)
+
+
+def bait_read_files(pair, sample_name, sample_tmp_dir, data_type='Illumina', fasta=False, stream=False,
+                    intermediate_format='gzip'):
+    """
+    Works out the files bait_reads writes the baited reads of a sample to.
+    :param pair: List with the forward and reverse reads, or just the unpaired reads.
+    :param sample_name: Name of the sample.
+    :param sample_tmp_dir: Folder the baited reads are written to.
+    :param data_type: Either Illumina or Nanopore, depending on what type your reads are. (STR)
+    :param fasta: Boolean on whether the samples are in FASTA format.
+    :param stream: If True, the baited reads are quality trimmed straight away, without writing them to disk. (BOOL)
+    :param intermediate_format: Format to write the reads in, one of the keys of INTERMEDIATE_FORMATS. (STR)
+    :return: List of the baited (or, when streaming, baited and trimmed) read files.
+    """
+    reads_extension = INTERMEDIATE_FORMATS[intermediate_format][0]
+    if stream or (len(pair) == 1 and (data_type == 'Nanopore' or fasta)):
+        suffix = '_baited_trimmed'
+    else:
+        suffix = '_baited'
+    if len(pair) == 2:
+        forward_bait = os.path.join(sample_tmp_dir, '{sn}{suffix}_R1{ext}'.format(sn=sample_name,
+                                                                                 suffix=suffix,
+                                                                                 ext=reads_extension))
+        return [forward_bait, forward_bait.replace('_R1', '_R2')]
+    return [os.path.join(sample_tmp_dir, '{sn}{suffix}{ext}'.format(sn=sample_name,
+                                                                    suffix=suffix,
+                                                                    ext=reads_extension))]
+
+
+def discard_baited_reads(read_files):
+    """
+    Removes reads baited with the wrong database (or only partly baited), so bait_reads doesn't skip them.
+    :param read_files: List of read files returned by bait_reads or bait_read_files
+    """
+    for read_file in read_files:
+        if os.path.isfile(read_file):
+            os.remove(read_file)
+
+
+def bait_reads(pair, sample_database, sample_name, sample_tmp_dir, log, threads=1, xmx=None, data_type='Illumina',
+               fasta=False, stream=False, intermediate_format='gzip'):
+    """
+    Uses bbduk to bait out the reads that match the database, skipping any reads that have already been baited.
+    :param pair: List with the forward and reverse reads, or just the unpaired reads.
+    :param sample_database: Database to bait reads against.
+    :param sample_name: Name of the sample.
+    :param sample_tmp_dir: Folder to write the baited reads to.
+    :param log: Logfile to write to.
+    :param threads: Number of threads to run bbduk with.
+    :param xmx: if None, BBTools will use auto memory detection. If string, BBTools will use what's specified as their
+    memory request.
+    :param data_type: Either Illumina or Nanopore, depending on what type your reads are. (STR)
+    :param fasta: Boolean on whether the samples are in FASTA format.
+    :param stream: If True, the baited reads are quality trimmed straight away, without writing them to disk. (BOOL)
+    :param intermediate_format: Format to write the reads in, one of the keys of INTERMEDIATE_FORMATS. (STR)
+    :return: List of the baited (or, when streaming, baited and trimmed) read files.
+    """
+    paired = len(pair) == 2
+    compression_options = INTERMEDIATE_FORMATS[intermediate_format][1]
+    read_files = bait_read_files(pair=pair,
+                                 sample_name=sample_name,
+                                 sample_tmp_dir=sample_tmp_dir,
+                                 data_type=data_type,
+                                 fasta=fasta,
+                                 stream=stream,
+                                 intermediate_format=intermediate_format)
+    out, err, cmd = '', '', ''
+    if os.path.isfile(read_files[0]):
+        return read_files
+    if stream:
+        # Baiting and trimming run at the same time, so they share the sample's threads and memory. Only the trimming
+        # bbduk writes reads to disk, so it's the only one that needs the compression options.
+        bait_threads = max(1, threads // 2)
+        bait_options = dict(threads=bait_threads)
+        bbduk_options = dict(threads=max(1, threads - bait_threads), **compression_options)
+        if xmx is not None:
+            bait_options['Xmx'] = split_xmx(xmx, 2)
+            bbduk_options['Xmx'] = split_xmx(xmx, 2)
+        bbduk_options['bait_kwargs'] = bait_options
+        if paired:
+            out, err, cmd = bbtools.bbduk_bait_trim(reference=sample_database,
+                                                    forward_in=pair[0],
+                                                    reverse_in=pair[1],
+                                                    forward_out=read_files[0],
+                                                    reverse_out=read_files[1],
+                                                    returncmd=True,
+                                                    **bbduk_options)
+        else:
+            out, err, cmd = bbtools.bbduk_bait_trim(reference=sample_database,
+                                                    forward_in=pair[0],
+                                                    forward_out=read_files[0],
+                                                    returncmd=True,
+                                                    **bbduk_options)
+    else:
+        bbduk_options = dict(threads=threads, **compression_options)
+        if xmx is not None:
+            bbduk_options['Xmx'] = xmx
+        if paired:
+            out, err, cmd = bbtools.bbduk_bait(reference=sample_database,
+                                               forward_in=pair[0],
+                                               reverse_in=pair[1],
+                                               forward_out=read_files[0],
+                                               reverse_out=read_files[1],
+                                               returncmd=True,
+                                               **bbduk_options)
+        else:
+            out, err, cmd = bbtools.bbduk_bait(reference=sample_database,
+                                               forward_in=pair[0],
+                                               forward_out=read_files[0],
+                                               returncmd=True,
+                                               **bbduk_options)
+    if out:
         write_to_logfile(log, out, err, cmd)
+    return read_files
 
 
 # noinspection PyUnresolvedReferences
@@ -1030,7 +1929,9 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                        keep_files=False,
                        quality_cutoff=20, base_cutoff=None, base_fraction_cutoff=0.05, cgmlst_db=None, xmx=None,
                        tmpdir=None, data_type='Illumina', use_rmlst=False, cross_details=False, min_matching_hashes=40,
-                       fasta=False, error_cutoff=1.0, debug=False):
+                       fasta=False, error_cutoff=1.0, debug=False, bam_qualities=False, pileup_pool=None,
+                       stream_reads=False, intermediate_format=None, speculative_bait=False, cache_dir=None,
+                       mapper='bbmap', kma_shm=None, max_depth=None):
     """
     This needs some documentation fairly badly, so here we go.
     :param pair: This has become a misnomer. If the input reads are actually paired, needs to be a list
@@ -1064,12 +1965,28 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
     :param fasta: Boolean on whether the samples are in FASTA format. Default is False
     :param error_cutoff: Float of the error cutoff value to use. Default is 1.0%
     :param debug: Run the find_contamination with multi-processing to allow easier debugging
+    :param bam_qualities: If True, base qualities are taken from the reads in the BAM file rather than by loading the
+    trimmed FASTQ files into memory. (BOOL)
+    :param pileup_pool: PileupPool to run the pileup stage with, so worker processes can be shared between samples. If
+    None, a pool with the specified number of threads is started for this sample.
+    :param stream_reads: If True, Illumina FASTQ reads are piped straight from baiting into quality trimming, and the
+    trimmed reads are written once, uncompressed, for KMA, BBMap and the quality lookup to read. (BOOL)
+    :param intermediate_format: Format to write the baited and trimmed reads in - one of gzip, gzip1 (gzip at the
+    lowest compression level), bgzf or plain. If None, plain is used when streaming reads, and gzip otherwise. (STR)
+    :param speculative_bait: If True, reads are baited against the database the sample is most likely to need while
+    mash checks for cross-species contamination, and baited again if that turns out to be the wrong database. (BOOL)
+    :param cache_dir: Folder to cache results in. If the same reads have already been analysed with the same
+    parameters and databases, their results are taken from the cache instead of analysing them again. If None, no
+    cache is used.
+    :param mapper: Mapper to map Illumina reads to the alleles with, either bbmap or mappy (minimap2's python bindings,
+    which have to be installed separately). (STR)
+    :param kma_shm: KmaSharedMemory to keep the KMA database in shared memory with, so it doesn't have to be loaded
+    from disk for every sample. If None, kma loads it from disk.
+    :param max_depth: If set, genes with a mean depth above this are subsampled down to it before looking for SNVs,
+    which makes very deep samples much faster to analyse. If None, every read is used. (INT)
+    :return: report_row: List of the values written to the report for the sample, as strings
     """
-    if os.path.isfile(os.path.join(databases_folder, 'download_date.txt')):
-        with open(os.path.join(databases_folder, 'download_date.txt')) as f:
-            database_download_date = f.readline().rstrip()
-    else:
-        database_download_date = 'ND'
+    database_download_date = read_database_download_date(databases_folder)
     log = os.path.join(output_folder, 'confindr_log.txt')
     if len(pair) == 2:
         sample_name = os.path.split(pair[0])[-1].split(forward_id)[0]
@@ -1079,10 +1996,79 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
         sample_name = os.path.split(pair[0])[-1].split('.')[0]
         paired = False
         logging.debug('Sample is unpaired. Sample name is {}'.format(sample_name))
+    cache_key = None
+    if cache_dir is not None:
+        cache_key = result_cache_key(reads=pair,
+                                     database_download_date=database_download_date,
+                                     parameters=dict(quality_cutoff=quality_cutoff,
+                                                     base_cutoff=base_cutoff,
+                                                     base_fraction_cutoff=base_fraction_cutoff,
+                                                     error_cutoff=error_cutoff,
+                                                     cgmlst_db=cgmlst_db,
+                                                     data_type=data_type,
+                                                     use_rmlst=use_rmlst,
+                                                     cross_details=cross_details,
+                                                     min_matching_hashes=min_matching_hashes,
+                                                     fasta=fasta,
+                                                     mapper=mapper,
+                                                     max_depth=max_depth,
+                                                     bam_qualities=bam_qualities))
+        report_row = load_cached_result(cache_dir=cache_dir,
+                                        cache_key=cache_key,
+                                        output_folder=output_folder,
+                                        sample_name=sample_name)
+        if report_row is not None:
+            logging.info('Found results for identical reads in the result cache, skipping analysis...')
+            return report_row
     sample_tmp_dir = os.path.join(output_folder, sample_name)
     if not os.path.isdir(sample_tmp_dir):
         os.makedirs(sample_tmp_dir)
 
+    # When streaming, the baited reads are never written, and by default the trimmed reads are left uncompressed, as
+    # they are read several times further on and compressing them costs more than it saves
+    stream = stream_reads and data_type == 'Illumina' and not fasta
+    if intermediate_format is None:
+        intermediate_format = 'plain' if stream else 'gzip'
+    reads_extension, compression_options = INTERMEDIATE_FORMATS[intermediate_format]
+    bait_options = dict(pair=pair,
+                        sample_name=sample_name,
+                        sample_tmp_dir=sample_tmp_dir,
+                        log=log,
+                        threads=threads,
+                        xmx=xmx,
+                        data_type=data_type,
+                        fasta=fasta,
+                        stream=stream,
+                        intermediate_format=intermediate_format)
+    # The genus only matters to baiting through the database the reads are baited against, so when speculating, reads
+    # are baited against a guess at the database while mash works out the genus, and only baited again if the guess was
+    # wrong.
+    speculative_database = None
+    speculative_bait_future = None
+    mash_threads = threads
+    if speculative_bait:
+        speculative_database = guess_sample_database(output_report=os.path.join(output_folder, 'confindr_report.csv'),
+                                                     databases_folder=databases_folder,
+                                                     tmpdir=tmpdir,
+                                                     cgmlst_db=cgmlst_db,
+                                                     use_rmlst=use_rmlst)
+        if os.path.isfile(speculative_database):
+            logging.info('Extracting conserved core genes with {db} while checking for cross-species contamination...'
+                         .format(db=os.path.split(speculative_database)[-1]))
+            # mash and the baiting run at the same time, so they share the sample's threads and memory
+            speculative_threads = max(1, threads // 2)
+            mash_threads = max(1, threads - speculative_threads)
+            speculative_options = dict(bait_options,
+                                       threads=speculative_threads,
+                                       xmx=None if xmx is None else split_xmx(xmx, 2))
+            executor = ThreadPoolExecutor(max_workers=1)
+            speculative_bait_future = executor.submit(bait_reads,
+                                                      sample_database=speculative_database,
+                                                      **speculative_options)
+            executor.shutdown(wait=False)
+        else:
+            speculative_database = None
+
     logging.info('Checking for cross-species contamination...')
     if paired:
         genus = find_cross_contamination(databases_folder,
@@ -1090,7 +2076,7 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                                          sample_name=sample_name,
                                          tmpdir=sample_tmp_dir,
                                          log=log,
-                                         threads=threads,
+                                         threads=mash_threads,
                                          min_matching_hashes=min_matching_hashes)
     else:
         genus = find_cross_contamination(databases_folder,
@@ -1098,92 +2084,60 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                                          sample_name=sample_name,
                                          tmpdir=sample_tmp_dir,
                                          log=log,
-                                         threads=threads,
+                                         threads=mash_threads,
                                          min_matching_hashes=min_matching_hashes)
+    if speculative_bait_future is not None:
+        # Let the baiting finish before anything else happens, so it is never cleaned up from under it. It was only a
+        # guess, so if it failed, the reads are just baited again once the database is known.
+        try:
+            speculative_bait_future.result()
+        except Exception as e:
+            logging.warning('Extracting core genes with {db} failed ({e}), they will be extracted again...'
+                            .format(db=os.path.split(speculative_database)[-1], e=e))
+            speculative_database = None
+            discard_baited_reads(bait_read_files(pair=pair,
+                                                 sample_name=sample_name,
+                                                 sample_tmp_dir=sample_tmp_dir,
+                                                 data_type=data_type,
+                                                 fasta=fasta,
+                                                 stream=stream,
+                                                 intermediate_format=intermediate_format))
     if len(genus.split(':')) > 1:
         if not cross_details:
-            write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
-                         sample_name=sample_name,
-                         multi_positions=0,
-                         genus=genus,
-                         percent_contam='ND',
-                         contam_stddev='ND',
-                         total_gene_length=0,
-                         database_download_date=database_download_date)
+            report_row = write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
+                                      sample_name=sample_name,
+                                      multi_positions=0,
+                                      genus=genus,
+                                      percent_contam='ND',
+                                      contam_stddev='ND',
+                                      total_gene_length=0,
+                                      database_download_date=database_download_date)
             logging.info('Found cross-contamination! Skipping rest of analysis...\n')
             if keep_files is False:
                 shutil.rmtree(sample_tmp_dir)
-            return
-    # Setup genus-specific databases, if necessary.
-    if cgmlst_db is not None:
-        # Sanity check that the DB specified is actually a file, otherwise, quit with appropriate error message.
-        if not os.path.isfile(cgmlst_db):
-            logging.error('ERROR: Specified cgMLST file ({}) does not exist. Please check the path and try again.'
-                          .format(cgmlst_db))
-            quit(code=1)
-        sample_database = cgmlst_db
-    else:
-        db_folder = databases_folder if tmpdir is None else tmpdir
-        if not os.path.isdir(db_folder):
-            os.makedirs(db_folder)
-        if genus != 'ND':
-            # Logic here is as follows: users can either have both rMLST databases, which cover all of bacteria,
-            # cgmlst-derived databases, which cover only Escherichia, Salmonella, and Listeria (may add more at some
-            # point), or they can have both. They can also set priority to either always use rMLST, or to use my
-            # core-genome derived stuff and fall back on rMLST if they're trying to look at a genus I haven't created
-            # a scheme for.
-            #
-            if len(genus.split(':')) > 1:
-                predominant_genus = genus.split(':')[0]
-            else:
-                predominant_genus = genus
-            # In the event rmlst databases have priority, always use them.
-            if use_rmlst is True:
-                sample_database = os.path.join(db_folder, '{}_db.fasta'.format(predominant_genus))
-                if not os.path.isfile(sample_database):
-
-                    if os.path.isfile(os.path.join(db_folder, 'gene_allele.txt')) and \
-                            os.path.isfile(os.path.join(db_folder, 'rMLST_combined.fasta')):
-                        logging.info('Setting up rMLST genus-specific database for genus {}...'
-                                     .format(predominant_genus))
-                        allele_list = find_genus_specific_allele_list(os.path.join(db_folder, 'gene_allele.txt'),
-                                                                      predominant_genus)
-                        # Create the allele-specific database
-                        setup_allelespecific_database(fasta_file=sample_database,
-                                                      database_folder=db_folder,
-                                                      allele_list=allele_list)
-            else:
-                # Check if a cgderived database is available. If not, try to use rMLST database.
-                sample_database = os.path.join(db_folder, '{}_db_cgderived.fasta'.format(predominant_genus))
-                if not os.path.isfile(sample_database):
-                    sample_database = os.path.join(db_folder, '{}_db.fasta'.format(predominant_genus))
-                    # Create genus specific database if it doesn't already exist and we have the necessary rMLST files.
-                    if os.path.isfile(os.path.join(db_folder, 'rMLST_combined.fasta')) and \
-                            os.path.isfile(os.path.join(db_folder, 'gene_allele.txt')) and not \
-                            os.path.isfile(sample_database):
-                        logging.info('Setting up core genome genus-specific database for genus {}...'
-                                     .format(predominant_genus))
-                        allele_list = find_genus_specific_allele_list(os.path.join(db_folder, 'gene_allele.txt'),
-                                                                      predominant_genus)
-                        setup_allelespecific_database(fasta_file=sample_database,
-                                                      database_folder=db_folder,
-                                                      allele_list=allele_list)
-
-        else:
-            sample_database = os.path.join(db_folder, 'rMLST_combined.fasta')
+            if cache_key is not None:
+                store_cached_result(cache_dir=cache_dir,
+                                    cache_key=cache_key,
+                                    report_row=report_row)
+            return report_row
+    sample_database = select_sample_database(genus=genus,
+                                             databases_folder=databases_folder,
+                                             tmpdir=tmpdir,
+                                             cgmlst_db=cgmlst_db,
+                                             use_rmlst=use_rmlst)
 
     # If a user has gotten to this point and they don't have any database available to do analysis because
     # they don't have rMLST downloaded and we don't have a cg-derived database available, boot them with a helpful
     # message.
     if not os.path.isfile(sample_database):
-        write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
-                     sample_name=sample_name,
-                     multi_positions=0,
-                     genus=genus,
-                     percent_contam='ND',
-                     contam_stddev='ND',
-                     total_gene_length=0,
-                     database_download_date=database_download_date)
+        report_row = write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
+                                  sample_name=sample_name,
+                                  multi_positions=0,
+                                  genus=genus,
+                                  percent_contam='ND',
+                                  contam_stddev='ND',
+                                  total_gene_length=0,
+                                  database_download_date=database_download_date)
         logging.info('Did not find databases for genus {genus}. You can download the rMLST database to get access to '
                      'all genera (see https://olc-bioinformatics.github.io/ConFindr/install/). Alternatively, if you '
                      'have a high-quality core-genome derived database for your genome of interest, we would be happy '
@@ -1191,62 +2145,34 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                      'title "Add genus-specific database: {genus}"\n'.format(genus=genus))
         if keep_files is False:
             shutil.rmtree(sample_tmp_dir)
-        return
+        return report_row
 
     # Extract rMLST reads and quality trim.
+    if speculative_database is not None and speculative_database != sample_database:
+        logging.info('Reads were extracted with the wrong database for genus {}, extracting them again...'
+                     .format(genus))
+        discard_baited_reads(speculative_bait_future.result())
     logging.info('Extracting conserved core genes...')
-    out, err, cmd = '', '', ''
     forward_bait = str()
     forward_trimmed = str()
     reverse_bait = str()
     reverse_trimmed = str()
     unpaired_bait = str()
     unpaired_trimmed = str()
-    if paired:
-        forward_bait = os.path.join(sample_tmp_dir, '{sn}_baited_R1.fastq.gz'.format(sn=sample_name))
-        reverse_bait = forward_bait.replace('_R1', '_R2')
-        if not os.path.isfile(forward_bait):
-            if xmx is None:
-                out, err, cmd = bbtools.bbduk_bait(reference=sample_database,
-                                                   forward_in=pair[0],
-                                                   reverse_in=pair[1],
-                                                   forward_out=forward_bait,
-                                                   reverse_out=reverse_bait,
-                                                   threads=threads,
-                                                   returncmd=True)
-            else:
-                out, err, cmd = bbtools.bbduk_bait(reference=sample_database,
-                                                   forward_in=pair[0],
-                                                   reverse_in=pair[1],
-                                                   forward_out=forward_bait,
-                                                   reverse_out=reverse_bait,
-                                                   threads=threads,
-                                                   Xmx=xmx,
-                                                   returncmd=True)
-    else:
-        if data_type == 'Nanopore' or fasta:
-            unpaired_bait = os.path.join(sample_tmp_dir, '{sn}_baited_trimmed.fastq.gz'.format(sn=sample_name))
+    baited_reads = bait_reads(sample_database=sample_database,
+                              **bait_options)
+    if not stream:
+        if paired:
+            forward_bait, reverse_bait = baited_reads
         else:
-            unpaired_bait = os.path.join(sample_tmp_dir, '{sn}_baited.fastq.gz'.format(sn=sample_name))
-        if not os.path.isfile(unpaired_bait):
-            if xmx is None:
-                out, err, cmd = bbtools.bbduk_bait(reference=sample_database,
-                                                   forward_in=pair[0],
-                                                   forward_out=unpaired_bait,
-                                                   returncmd=True, threads=threads)
-            else:
-                out, err, cmd = bbtools.bbduk_bait(reference=sample_database,
-                                                   forward_in=pair[0],
-                                                   forward_out=unpaired_bait,
-                                                   Xmx=xmx,
-                                                   returncmd=True, threads=threads)
-    if out:
-        write_to_logfile(log, out, err, cmd)
-    logging.info('Quality trimming...')
+            unpaired_bait = baited_reads[0]
+        logging.info('Quality trimming...')
     out, err, cmd = '', '', ''
     if data_type == 'Illumina':
         if paired:
-            forward_trimmed = os.path.join(sample_tmp_dir, '{sn}_baited_trimmed_R1.fastq.gz'.format(sn=sample_name))
+            forward_trimmed = os.path.join(sample_tmp_dir, '{sn}_baited_trimmed_R1{ext}'
+                                           .format(sn=sample_name,
+                                                   ext=reads_extension))
             reverse_trimmed = forward_trimmed.replace('_R1', '_R2')
             if not os.path.isfile(forward_trimmed):
                 if xmx is None:
@@ -1254,7 +2180,8 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                                                        reverse_in=reverse_bait,
                                                        forward_out=forward_trimmed,
                                                        reverse_out=reverse_trimmed,
-                                                       threads=str(threads), returncmd=True)
+                                                       threads=str(threads), returncmd=True,
+                                                       **compression_options)
                 else:
                     out, err, cmd = bbtools.bbduk_trim(forward_in=forward_bait,
                                                        reverse_in=reverse_bait,
@@ -1262,20 +2189,13 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                                                        reverse_out=reverse_trimmed,
                                                        Xmx=xmx,
                                                        threads=str(threads),
-                                                       returncmd=True)
-
-            with gzip.open(forward_trimmed, 'rt') as gz:
-                fastq_records = load_fastq_records(gz=gz,
-                                                   paired=True,
-                                                   forward=True)
-            with gzip.open(reverse_trimmed, 'rt') as gz:
-                # fastq_records.update(SeqIO.to_dict(SeqIO.parse(gz, 'fastq')))
-                fastq_records.update(load_fastq_records(gz=gz,
-                                                        paired=True,
-                                                        forward=False))
-
+                                                       returncmd=True,
+                                                       **compression_options)
+            quality_files = [(forward_trimmed, True), (reverse_trimmed, False)]
         else:
-            unpaired_trimmed = os.path.join(sample_tmp_dir, '{sn}_baited_trimmed.fastq.gz'.format(sn=sample_name))
+            unpaired_trimmed = os.path.join(sample_tmp_dir, '{sn}_baited_trimmed{ext}'
+                                            .format(sn=sample_name,
+                                                    ext=reads_extension))
 
             if not fasta:
                 if not os.path.isfile(unpaired_trimmed):
@@ -1283,44 +2203,34 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                         out, err, cmd = bbtools.bbduk_trim(forward_in=unpaired_bait,
                                                            forward_out=unpaired_trimmed,
                                                            returncmd=True,
-                                                           threads=threads)
+                                                           threads=threads,
+                                                           **compression_options)
                     else:
                         out, err, cmd = bbtools.bbduk_trim(forward_in=unpaired_bait,
                                                            forward_out=unpaired_trimmed,
                                                            returncmd=True,
                                                            threads=threads,
-                                                           Xmx=xmx)
-                with gzip.open(unpaired_trimmed, 'rt') as gz:
-                    # fastq_records = SeqIO.to_dict(SeqIO.parse(gz, 'fastq'))
-                    fastq_records = load_fastq_records(gz=gz,
-                                                       paired=False,
-                                                       forward=True)
+                                                           Xmx=xmx,
+                                                           **compression_options)
+                quality_files = [(unpaired_trimmed, True)]
             else:
-                # '''unpaired_bait'''
-                with gzip.open(unpaired_bait, 'rt') as gz:
-                    # fastq_records = SeqIO.to_dict(SeqIO.parse(gz, 'fastq'))
-                    fastq_records = load_fastq_records(gz=gz,
-                                                       paired=False,
-                                                       forward=True)
+                quality_files = [(unpaired_bait, True)]
         write_to_logfile(log, out, err, cmd)
     else:
         if paired:
-            with gzip.open(forward_bait, 'rt') as gz:
-                # fastq_records = SeqIO.to_dict(SeqIO.parse(gz, 'fastq'))
-                fastq_records = load_fastq_records(gz=gz,
-                                                   paired=True,
-                                                   forward=True)
-            with gzip.open(reverse_bait, 'rt') as gz:
-                # fastq_records.update(SeqIO.to_dict(SeqIO.parse(gz, 'fastq')))
-                fastq_records.update(load_fastq_records(gz=gz,
-                                                        paired=True,
-                                                        forward=False))
+            quality_files = [(forward_bait, True), (reverse_bait, False)]
         else:
-            with gzip.open(unpaired_bait, 'rt') as gz:
-                # fastq_records = SeqIO.to_dict(SeqIO.parse(gz, 'fastq'))
-                fastq_records = load_fastq_records(gz=gz,
-                                                   paired=False,
-                                                   forward=True)
+            quality_files = [(unpaired_bait, True)]
+    # Base qualities are either taken straight from the BAM file during the pileup, or looked up from the reads
+    fastq_records = None
+    if not bam_qualities:
+        fastq_records = FastqQualities()
+        for quality_file, forward in quality_files:
+            with open_reads(quality_file) as gz:
+                load_fastq_records(gz=gz,
+                                   paired=paired,
+                                   forward=forward,
+                                   records=fastq_records)
     logging.info('Detecting contamination...')
     # Now do mapping in two steps - first, map reads back to database with ambiguous reads matching all - this
     # will be used to get a count of number of reads aligned to each gene/allele so we can create a custom rmlst file
@@ -1336,44 +2246,52 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
     #     cmd = 'kma index -i {} -o {}'.format(sample_database, kma_database)  # NOTE: Need KMA >=1.2.0 for this to work
     #     out, err = run_cmd(cmd)
     #     write_to_logfile(log, out, err, cmd)
-    index_databases(sample_database=sample_database)
+    kma_database = index_databases(sample_database=sample_database)
+    kma_shm_level = None if kma_shm is None else kma_shm.acquire(kma_database)
+    kma_options = '' if kma_shm_level is None else ' -shm {}'.format(kma_shm_level)
     # Run KMA.
-    if paired:
-        if not os.path.isfile(kma_report + '.res'):
-            cmd = 'kma -ipe {forward_in} {reverse_in} -t_db {kma_database} -o {kma_report} ' \
-                  '-t {threads}'.format(forward_in=forward_trimmed,
-                                        reverse_in=reverse_trimmed,
-                                        kma_database=kma_database,
-                                        kma_report=kma_report,
-                                        threads=threads)
-            out, err = run_cmd(cmd)
-            write_to_logfile(log, out, err, cmd)
-    else:
-        if not os.path.isfile(kma_report + '.res'):
-            if data_type == 'Illumina':
-                # Use the FASTA file (rather than the reads) as the input
-                if fasta:
-                    cmd = 'kma -i {input_reads} -t_db {kma_database} -mem_mode -ID 100 -ConClave 2 -ex_mode ' \
-                          '-o {kma_report} -t {threads}' \
-                        .format(input_reads=pair[0],
-                                kma_database=kma_database,
-                                kma_report=kma_report,
-                                threads=threads)
-                else:
-                    cmd = 'kma -i {input_reads} -t_db {kma_database} -o {kma_report} ' \
-                          '-t {threads}'.format(input_reads=unpaired_trimmed,
-                                                kma_database=kma_database,
-                                                kma_report=kma_report,
-                                                threads=threads)
-            else:
-                # Recommended Nanopore settings from KMA repo: https://bitbucket.org/genomicepidemiology/kma
-                cmd = 'kma -i {input_reads} -t_db {kma_database} -o {kma_report} -mem_mode -mp 20 -mrs 0.0 -bcNano ' \
-                      '-t {threads}'.format(input_reads=unpaired_trimmed,
+    try:
+        if paired:
+            if not os.path.isfile(kma_report + '.res'):
+                cmd = 'kma -ipe {forward_in} {reverse_in} -t_db {kma_database} -o {kma_report} ' \
+                      '-t {threads}'.format(forward_in=forward_trimmed,
+                                            reverse_in=reverse_trimmed,
                                             kma_database=kma_database,
                                             kma_report=kma_report,
                                             threads=threads)
-            out, err = run_cmd(cmd)
-            write_to_logfile(log, out, err, cmd)
+                cmd += kma_options
+                out, err = run_cmd(cmd)
+                write_to_logfile(log, out, err, cmd)
+        else:
+            if not os.path.isfile(kma_report + '.res'):
+                if data_type == 'Illumina':
+                    # Use the FASTA file (rather than the reads) as the input
+                    if fasta:
+                        cmd = 'kma -i {input_reads} -t_db {kma_database} -mem_mode -ID 100 -ConClave 2 -ex_mode ' \
+                              '-o {kma_report} -t {threads}' \
+                            .format(input_reads=pair[0],
+                                    kma_database=kma_database,
+                                    kma_report=kma_report,
+                                    threads=threads)
+                    else:
+                        cmd = 'kma -i {input_reads} -t_db {kma_database} -o {kma_report} ' \
+                              '-t {threads}'.format(input_reads=unpaired_trimmed,
+                                                    kma_database=kma_database,
+                                                    kma_report=kma_report,
+                                                    threads=threads)
+                else:
+                    # Recommended Nanopore settings from KMA repo: https://bitbucket.org/genomicepidemiology/kma
+                    cmd = 'kma -i {input_reads} -t_db {kma_database} -o {kma_report} -mem_mode -mp 20 -mrs 0.0 ' \
+                          '-bcNano -t {threads}'.format(input_reads=unpaired_trimmed,
+                                                        kma_database=kma_database,
+                                                        kma_report=kma_report,
+                                                        threads=threads)
+                cmd += kma_options
+                out, err = run_cmd(cmd)
+                write_to_logfile(log, out, err, cmd)
+    finally:
+        if kma_shm_level is not None:
+            kma_shm.release(kma_database)
 
     rmlst_report = os.path.join(output_folder, sample_name + '_alleles.csv')
     gene_alleles = find_rmlst_type(kma_report=kma_report + '.res',
@@ -1399,13 +2317,36 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
         sorted_bam = os.path.join(sample_tmp_dir, '{sn}_contamination_sorted.bam'.format(sn=sample_name))
         outsam = outbam.replace('.bam', '.sam')
         if not os.path.isfile(sorted_bam):
-            if paired:
-                cmd = 'bbmap.sh ref={ref} in={forward_in} in2={reverse_in} out={outbam} threads={threads} mdtag ' \
-                      'nodisk'.format(ref=rmlst_fasta,
-                                      forward_in=forward_trimmed,
-                                      reverse_in=reverse_trimmed,
-                                      outbam=outbam,
-                                      threads=threads)
+            use_mappy = mapper == 'mappy' and (paired or (data_type == 'Illumina' and not fasta))
+            if not use_mappy and (paired or (data_type == 'Illumina' and not fasta)):
+                # Samples often end up with the same alleles as others, so with a cache folder, use a cached index of
+                # them where possible. Without one, BBMap indexes the alleles in memory, so nothing is written to the
+                # database folder.
+                index_path = None
+                if cache_dir is not None:
+                    index_path = bbmap_index(reference=rmlst_fasta,
+                                             index_folder=os.path.join(cache_dir, 'bbmap_index'),
+                                             log=log,
+                                             threads=threads,
+                                             xmx=xmx)
+                if index_path is not None:
+                    bbmap_reference = 'path={}'.format(index_path)
+                else:
+                    bbmap_reference = 'ref={} nodisk'.format(rmlst_fasta)
+            if use_mappy:
+                # Core genes can have relatives within a genome at ~70 percent identity, so with cgMLST databases
+                # reads can only have one substitution, as with BBMap's subfilter below.
+                map_reads_mappy(reference=rmlst_fasta,
+                                read_files=[forward_trimmed, reverse_trimmed] if paired else [unpaired_trimmed],
+                                sorted_bam=sorted_bam,
+                                max_substitutions=1 if cgmlst_db is not None else None)
+            elif paired:
+                cmd = 'bbmap.sh {reference} in={forward_in} in2={reverse_in} out={outbam} threads={threads} ' \
+                      'mdtag'.format(reference=bbmap_reference,
+                                     forward_in=forward_trimmed,
+                                     reverse_in=reverse_trimmed,
+                                     outbam=outbam,
+                                     threads=threads)
                 if cgmlst_db is not None:
                     # Lots of core genes seem to have relatives within a genome that are at ~70% identity. This means
                     # that reads that shouldn't map do, and cause false positives. Adding in this sub-filter means that
@@ -1418,11 +2359,11 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
             else:
                 #
                 if data_type == 'Illumina' and not fasta:
-                    cmd = 'bbmap.sh ref={ref} in={forward_in} out={outbam} threads={threads} mdtag ' \
-                          'nodisk'.format(ref=rmlst_fasta,
-                                          forward_in=unpaired_trimmed,
-                                          outbam=outbam,
-                                          threads=threads)
+                    cmd = 'bbmap.sh {reference} in={forward_in} out={outbam} threads={threads} ' \
+                          'mdtag'.format(reference=bbmap_reference,
+                                         forward_in=unpaired_trimmed,
+                                         outbam=outbam,
+                                         threads=threads)
                     if cgmlst_db is not None:
                         # Core genes can have relatives within a genome that are at ~70 percent identity. This means
                         # that reads that shouldn't map do, and cause false positives. Adding in this sub-filter means
@@ -1462,53 +2403,36 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
         # Now find number of multi-positions for each rMLST gene/allele combination
         multi_positions = 0
 
-        # Run the BAM parsing in parallel! Some refactoring of the code would likely be a good idea so this
-        # isn't quite so ugly, but it works.
-        p = multiprocessing.Pool(processes=threads)
-        allele_records = SeqIO.to_dict(SeqIO.parse(rmlst_fasta, 'fasta'))
-        bamfile_list = [sorted_bam] * len(gene_alleles)
-        reference_fasta_list = [rmlst_fasta] * len(gene_alleles)
-        fasta_list = [fasta] * len(gene_alleles)
-        quality_cutoff_list = [quality_cutoff] * len(gene_alleles)
-        base_cutoff_list = [base_cutoff] * len(gene_alleles)
-        base_fraction_list = [base_fraction_cutoff] * len(gene_alleles)
-        records_list = [allele_records] * len(gene_alleles)
-        fastq_records_list = [fastq_records] * len(gene_alleles)
-        error_cutoff_list = [error_cutoff] * len(gene_alleles)
-        multibase_dict_list = list()
-        report_write_list = list()
+        # Run the BAM parsing in parallel. Everything the genes have in common (including the read qualities, which
+        # can be large) is written to disk once, and loaded by each worker once, so each task is just a window of
+        # positions in a gene.
+        context_file = os.path.join(sample_tmp_dir, '{sn}_pileup_context.pickle'.format(sn=sample_name))
+        pileup_context = dict(bamfile_name=sorted_bam,
+                              reference_fasta=rmlst_fasta,
+                              allele_records=SeqIO.to_dict(SeqIO.parse(rmlst_fasta, 'fasta')),
+                              fastq_records=fastq_records,
+                              quality_cutoff=quality_cutoff,
+                              base_cutoff=base_cutoff,
+                              base_fraction_cutoff=base_fraction_cutoff,
+                              fasta=fasta,
+                              error_cutoff=error_cutoff,
+                              max_depth=max_depth)
+        write_pileup_context(context_file=context_file,
+                             pileup_context=pileup_context)
         if debug == 'debug':
-            for i, gene in enumerate(gene_alleles):
-                multibase_dict, report_write = read_contig(
-                    contig_name=gene,
-                    bamfile_name=bamfile_list[i],
-                    reference_fasta=reference_fasta_list[i],
-                    allele_records=records_list[i],
-                    fastq_records=fastq_records_list[i],
-                    quality_cutoff=quality_cutoff_list[i],
-                    base_cutoff=base_cutoff_list[i],
-                    base_fraction_cutoff=base_fraction_list[i],
-                    fasta=fasta_list[i],
-                    error_cutoff=error_cutoff_list[i])
-                multibase_dict_list.append(multibase_dict)
-                report_write_list.append(report_write)
+            results = [read_contig_task(context_file, gene) for gene in gene_alleles]
+        elif pileup_pool is not None:
+            results = pileup_pool.read_contigs(context_file=context_file,
+                                               pileup_context=pileup_context,
+                                               contig_names=gene_alleles)
         else:
-            for multibase_dict, report_write in p.starmap(read_contig,
-                                                          zip(gene_alleles,
-                                                              bamfile_list,
-                                                              reference_fasta_list,
-                                                              records_list,
-                                                              fastq_records_list,
-                                                              quality_cutoff_list,
-                                                              base_cutoff_list,
-                                                              base_fraction_list,
-                                                              fasta_list,
-                                                              error_cutoff_list),
-                                                          chunksize=1):
-                multibase_dict_list.append(multibase_dict)
-                report_write_list.append(report_write)
-            p.close()
-            p.join()
+            # Library callers that don't supply a pool get one just for this sample
+            with PileupPool(processes=threads) as sample_pileup_pool:
+                results = sample_pileup_pool.read_contigs(context_file=context_file,
+                                                          pileup_context=pileup_context,
+                                                          contig_names=gene_alleles)
+        multibase_dict_list = [multibase_dict for multibase_dict, report_write in results]
+        report_write_list = [report_write for multibase_dict, report_write in results]
     except SamtoolsError:
         pysam_pass = False
         multi_positions = 0
@@ -1537,18 +2461,26 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
         percent_contam = 0
         contam_stddev = 0
     logging.info('Done! Number of contaminating SNVs found: {}\n'.format(multi_positions))
-    write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
-                 sample_name=sample_name,
-                 multi_positions=multi_positions,
-                 genus=genus,
-                 percent_contam=percent_contam,
-                 contam_stddev=contam_stddev,
-                 total_gene_length=rmlst_gene_length,
-                 snp_cutoff=snp_cutoff,
-                 database_download_date=database_download_date,
-                 pysam_pass=pysam_pass)
+    report_row = write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
+                              sample_name=sample_name,
+                              multi_positions=multi_positions,
+                              genus=genus,
+                              percent_contam=percent_contam,
+                              contam_stddev=contam_stddev,
+                              total_gene_length=rmlst_gene_length,
+                              snp_cutoff=snp_cutoff,
+                              database_download_date=database_download_date,
+                              pysam_pass=pysam_pass)
     if keep_files is False:
         shutil.rmtree(sample_tmp_dir)
+    # Failures are left out of the cache so they get another go
+    if cache_key is not None and pysam_pass:
+        store_cached_result(cache_dir=cache_dir,
+                            cache_key=cache_key,
+                            report_row=report_row,
+                            sample_database=sample_database,
+                            result_files=[report_file, rmlst_report])
+    return report_row
 
 
 def write_output(output_report, sample_name, multi_positions, genus, percent_contam, contam_stddev, total_gene_length,
@@ -1567,12 +2499,8 @@ def write_output(output_report, sample_name, multi_positions, genus, percent_con
     :param database_download_date:
     :param snp_cutoff: Number of cSNVs to use to call a sample contaminated. Default 3. (INT)
     :param pysam_pass: Boolean of whether pysam encountered an error
+    :return: report_row: List of the values written to the report, as strings
     """
-    # If the report file hasn't been created, make it, with appropriate header.
-    if not os.path.isfile(output_report):
-        with open(os.path.join(output_report), 'w') as f:
-            f.write('Sample,Genus,NumContamSNVs,ContamStatus,PercentContam,PercentContamStandardDeviation,'
-                    'BasesExamined,DatabaseDownloadDate\n')
     if pysam_pass:
         if multi_positions >= snp_cutoff or len(genus.split(':')) > 1:
             contaminated = True
@@ -1583,17 +2511,222 @@ def write_output(output_report, sample_name, multi_positions, genus, percent_con
         multi_positions = 'ND'
         percent_contam = 'ND'
         contam_stddev = 'ND'
-    with open(output_report, 'a+') as f:
-        f.write('{samplename},{genus},{numcontamsnvs},'
-                '{contamstatus},{percent_contam},{contam_stddev},'
-                '{gene_length},{database_download_date}\n'.format(samplename=sample_name,
-                                                                  genus=genus,
-                                                                  numcontamsnvs=multi_positions,
-                                                                  contamstatus=contaminated,
-                                                                  percent_contam=percent_contam,
-                                                                  contam_stddev=contam_stddev,
-                                                                  gene_length=total_gene_length,
-                                                                  database_download_date=database_download_date))
+    report_row = [str(value) for value in (sample_name, genus, multi_positions, contaminated, percent_contam,
+                                           contam_stddev, total_gene_length, database_download_date)]
+    append_report_row(output_report=output_report,
+                      report_row=report_row)
+    return report_row
+
+
+def append_report_row(output_report, report_row):
+    """
+    Appends a row to the report file, creating the file with the appropriate header if it doesn't already exist.
+    :param output_report: Path to CSV output report file.
+    :param report_row: List of the values for each column of the report, as strings.
+    """
+    with report_lock:
+        # If the report file hasn't been created, make it, with appropriate header.
+        if not os.path.isfile(output_report):
+            with open(os.path.join(output_report), 'w') as f:
+                f.write('Sample,Genus,NumContamSNVs,ContamStatus,PercentContam,PercentContamStandardDeviation,'
+                        'BasesExamined,DatabaseDownloadDate\n')
+        with open(output_report, 'a+') as f:
+            f.write(','.join(report_row) + '\n')
+
+
+def sort_report(output_report, sample_names):
+    """
+    Puts the rows of a report in the order the samples were given in. Samples analysed at the same time add their rows
+    as they finish, so this makes the report the same as if the samples had been analysed one at a time.
+    :param output_report: Path to CSV output report file.
+    :param sample_names: List of sample names, in the order their rows should be in.
+    """
+    with report_lock:
+        if not os.path.isfile(output_report):
+            return
+        with open(output_report) as f:
+            header = f.readline()
+            rows = f.readlines()
+        sample_order = {sample_name: index for index, sample_name in enumerate(sample_names)}
+        # Rows for samples that aren't in the list are left at the end, in the order they were written
+        rows.sort(key=lambda row: sample_order.get(row.split(',')[0], len(sample_order)))
+        tmp_report = output_report + '.tmp'
+        with open(tmp_report, 'w') as f:
+            f.write(header)
+            f.writelines(rows)
+        os.replace(tmp_report, output_report)
+
+
+def read_database_download_date(databases_folder):
+    """
+    Reads the date the ConFindr databases were downloaded, which is used as their version.
+    :param databases_folder: Full path to folder where ConFindr's databases live.
+    :return: The download date, or ND if it isn't known.
+    """
+    if os.path.isfile(os.path.join(databases_folder, 'download_date.txt')):
+        with open(os.path.join(databases_folder, 'download_date.txt')) as f:
+            return f.readline().rstrip()
+    return 'ND'
+
+
+def fingerprint_files(file_list, block_size=1048576):
+    """
+    Quickly fingerprints a set of files by hashing their sizes and a block from the start, middle and end of each,
+    rather than the whole (often multi-gigabyte) files.
+    :param file_list: List of paths to the files, in a consistent order.
+    :param block_size: Number of bytes to hash from each part of each file.
+    :return: Hex digest of the fingerprint.
+    """
+    sha1 = hashlib.sha1()
+    for file_name in file_list:
+        size = os.path.getsize(file_name)
+        sha1.update(str(size).encode())
+        with open(file_name, 'rb') as f:
+            for offset in sorted({0, max(0, size // 2 - block_size // 2), max(0, size - block_size)}):
+                f.seek(offset)
+                sha1.update(f.read(block_size))
+    return sha1.hexdigest()
+
+
+class RunManifest(object):
+    """
+    JSON record of the samples a run has finished, kept in the output folder so a restarted or extended run can skip
+    them. Each sample is stored with a fingerprint of its reads, the parameters and database version it was analysed
+    with, and its row in the report, and only counts as finished while all of these still match.
+    """
+
+    def finished_report_row(self, sample_name, fingerprint, parameters, database_version):
+        """
+        Looks up whether a sample has been finished with the same reads, parameters and databases.
+        :param sample_name: Name of the sample.
+        :param fingerprint: Fingerprint of the sample's reads, from fingerprint_files.
+        :param parameters: Dictionary of the parameters that affect the results.
+        :param database_version: Version of the databases, from read_database_download_date.
+        :return: The sample's report row if it has been finished, otherwise None.
+        """
+        with self.lock:
+            sample = self.samples.get(sample_name)
+        if sample is None:
+            return None
+        if sample['fingerprint'] != fingerprint or sample['parameters'] != parameters \
+                or sample['database_version'] != database_version:
+            return None
+        return sample['report_row']
+
+    def record(self, sample_name, fingerprint, parameters, database_version, report_row):
+        """
+        Records a finished sample, and saves the manifest.
+        """
+        with self.lock:
+            self.samples[sample_name] = dict(fingerprint=fingerprint,
+                                             parameters=parameters,
+                                             database_version=database_version,
+                                             report_row=report_row)
+            # Write to a temporary file and rename it over the manifest, so a run dying part way through writing
+            # never leaves a broken manifest behind
+            tmp_manifest = self.manifest_file + '.tmp'
+            with open(tmp_manifest, 'w') as f:
+                json.dump(dict(samples=self.samples), f, indent=2, sort_keys=True)
+            os.replace(tmp_manifest, self.manifest_file)
+
+    def __init__(self, manifest_file, resume=True):
+        """
+        :param manifest_file: Path to the JSON manifest.
+        :param resume: If True, samples finished by previous runs are loaded from the manifest. If False, the run starts
+        from scratch, and the manifest is overwritten as samples finish.
+        """
+        self.manifest_file = manifest_file
+        self.lock = threading.Lock()
+        self.samples = dict()
+        if resume and os.path.isfile(manifest_file):
+            try:
+                with open(manifest_file) as f:
+                    self.samples = json.load(f)['samples']
+            except (ValueError, KeyError):
+                logging.warning('Could not read the run manifest {}, all samples will be analysed again.'
+                                .format(manifest_file))
+
+
+def result_cache_key(reads, database_download_date, parameters):
+    """
+    Works out the key a sample's results are cached under, from the contents of its reads, the version of the databases
+    and the parameters that affect the results. The name of the sample isn't part of the key, so the same reads
+    submitted under a different name still hit the cache.
+    :param reads: List of the read files for the sample.
+    :param database_download_date: Version of the databases, from read_database_download_date.
+    :param parameters: Dictionary of the parameters that affect the results.
+    :return: Hex digest of the key.
+    """
+    key_data = dict(reads=fingerprint_files(reads),
+                    database_download_date=database_download_date,
+                    parameters=parameters)
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def load_cached_result(cache_dir, cache_key, output_folder, sample_name):
+    """
+    Looks up a sample's results in the result cache. On a hit, the sample's row is added to the report, and its
+    contamination and allele reports are written to the output folder, just as if it had been analysed.
+    :param cache_dir: Folder the result cache lives in.
+    :param cache_key: Key from result_cache_key.
+    :param output_folder: Folder where ConFindr's outputs are stored.
+    :param sample_name: Name of the sample.
+    :return: report_row: List of the values written to the report, or None if the results weren't in the cache.
+    """
+    entry_dir = os.path.join(cache_dir, cache_key[:2], cache_key)
+    entry_file = os.path.join(entry_dir, 'result.json')
+    if not os.path.isfile(entry_file):
+        return None
+    with open(entry_file) as f:
+        entry = json.load(f)
+    # Which genus database gets used isn't known until mash has been run, so instead of being part of the key, it is
+    # recorded with the results, and they are only used if that database hasn't changed since
+    if entry['database'] is not None:
+        if not os.path.isfile(entry['database']) or \
+                fingerprint_files([entry['database']]) != entry['database_fingerprint']:
+            return None
+    for cached_file in entry['files']:
+        shutil.copyfile(os.path.join(entry_dir, cached_file),
+                        os.path.join(output_folder, sample_name + cached_file))
+    report_row = [sample_name] + entry['report_row'][1:]
+    append_report_row(output_report=os.path.join(output_folder, 'confindr_report.csv'),
+                      report_row=report_row)
+    return report_row
+
+
+def store_cached_result(cache_dir, cache_key, report_row, sample_database=None, result_files=()):
+    """
+    Adds a sample's results to the result cache.
+    :param cache_dir: Folder the result cache lives in.
+    :param cache_key: Key from result_cache_key.
+    :param report_row: List of the values written to the report for the sample.
+    :param sample_database: The database the sample was analysed with, if it got that far.
+    :param result_files: Reports written for the sample (contamination and allele reports), named with the sample name
+    followed by a suffix such as _contamination.csv.
+    """
+    entry_dir = os.path.join(cache_dir, cache_key[:2], cache_key)
+    if os.path.isdir(entry_dir):
+        return
+    if not os.path.isdir(os.path.dirname(entry_dir)):
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+    # Put the entry together in a temporary folder and rename it into place, so the cache never has half an entry in it
+    tmp_entry_dir = tempfile.mkdtemp(dir=cache_dir)
+    cached_files = list()
+    for result_file in result_files:
+        cached_file = os.path.split(result_file)[-1][len(report_row[0]):]
+        shutil.copyfile(result_file, os.path.join(tmp_entry_dir, cached_file))
+        cached_files.append(cached_file)
+    database_fingerprint = None if sample_database is None else fingerprint_files([sample_database])
+    with open(os.path.join(tmp_entry_dir, 'result.json'), 'w') as f:
+        json.dump(dict(report_row=report_row,
+                       database=sample_database,
+                       database_fingerprint=database_fingerprint,
+                       files=cached_files), f, indent=2)
+    try:
+        os.rename(tmp_entry_dir, entry_dir)
+    except OSError:
+        # Another sample with the same reads got there first
+        shutil.rmtree(tmp_entry_dir)
 
 
 def check_for_databases_and_download(database_location):
@@ -1659,6 +2792,51 @@ def check_acceptable_xmx(xmx_string):
     return acceptable_xmx
 
 
+def allocate_sample_threads(threads, parallel_samples, num_samples):
+    """
+    Splits the thread budget for a run between samples that are analysed concurrently.
+    :param threads: Total number of threads available to the run (INT)
+    :param parallel_samples: Number of samples to analyse at once. If 0, a value is picked so that each sample gets
+    roughly four threads (INT)
+    :param num_samples: Number of samples in the run (INT)
+    :return: parallel_samples: Number of samples that will actually be run at once
+    :return: sample_threads: Number of threads each of those samples gets
+    """
+    if parallel_samples < 1:
+        parallel_samples = threads // 4
+    # Never run more samples at once than there are samples or threads
+    parallel_samples = max(1, min(parallel_samples, num_samples, threads))
+    sample_threads = max(1, threads // parallel_samples)
+    return parallel_samples, sample_threads
+
+
+def split_xmx(xmx_string, parts):
+    """
+    Divides a BBTools memory request between concurrently running samples.
+    :param xmx_string: Memory request that has passed check_acceptable_xmx, e.g. 20g
+    :param parts: Number of ways to split the memory (INT)
+    :return: Memory request for each part as a string, in megabytes where possible (i.e. 20g split 4 ways is 5120m)
+    """
+    units = {'K': 1, 'M': 1024, 'G': 1024 * 1024}
+    kilobytes = int(xmx_string[:-1]) * units[xmx_string[-1].upper()] // parts
+    if kilobytes >= units['M']:
+        return '{}m'.format(kilobytes // units['M'])
+    return '{}k'.format(kilobytes)
+
+
+def physical_memory_xmx():
+    """
+    BBTools grabs most of the free memory on a machine when no Xmx is given, which doesn't work when several samples
+    are run at once. This finds a memory request equivalent to 85 percent of physical memory so it can be split up.
+    :return: Memory as an Xmx string in megabytes, or None if physical memory could not be determined.
+    """
+    try:
+        total_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+    return '{}m'.format(int(total_bytes * 0.85) // (1024 * 1024))
+
+
 def get_version():
     try:
         version = 'ConFindr {}'.format(pkg_resources.get_distribution('confindr').version)
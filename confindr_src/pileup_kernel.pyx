@@ -0,0 +1,212 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled version of the base counting done by confindr_src.methods.count_contig_bases. Rather than walking the pileup
+of a gene column by column, each read is walked once along its alignment, and every base it puts in a column is
+characterised exactly as characterise_read does it. The pure Python pileup in methods.py is the reference
+implementation, and is used whenever this module hasn't been built.
+"""
+from libc.stdint cimport int64_t
+
+# Categories of bases, in the same order as BASE_CATEGORIES in methods.py
+cdef enum:
+    CONGRUENT_SNV
+    CONGRUENT_REF
+    FORWARD_SNV_REVERSE_SNV1
+    REVERSE_SNV_FORWARD_SNV1
+    FORWARD_SNV_REVERSE_REF
+    REVERSE_SNV_FORWARD_REF
+    FORWARD_SNV_REVERSE_UM_QF
+    FORWARD_REF_REVERSE_UM_QF
+    FORWARD_QUALITY_FILTERED
+    REVERSE_SNV_FORWARD_UM_QF
+    REVERSE_REF_FORWARD_UM_QF
+    REVERSE_QUALITY_FILTERED
+
+# CIGAR operations
+cdef enum:
+    CIGAR_MATCH = 0
+    CIGAR_INSERTION = 1
+    CIGAR_DELETION = 2
+    CIGAR_REFERENCE_SKIP = 3
+    CIGAR_SOFT_CLIP = 4
+    CIGAR_SEQUENCE_MATCH = 7
+    CIGAR_SEQUENCE_MISMATCH = 8
+
+# Reads with any of these flags (unmapped, secondary, QC fail, duplicate) are left out of pileups, as in
+# PILEUP_SKIP_FLAGS in methods.py
+cdef int SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# pysam pileups stop adding reads to columns this deep, which reads walked one at a time can't reproduce
+MAX_PILEUP_DEPTH = 8000
+
+
+cdef inline int base_index(char base):
+    # Index of the base in BASES in methods.py. Anything other than A, C, G or T is counted as an N
+    if base == b'A':
+        return 0
+    elif base == b'C':
+        return 1
+    elif base == b'G':
+        return 2
+    elif base == b'T':
+        return 3
+    return 4
+
+
+cdef int count_column(dict column_reads, int64_t[:, ::1] column_counts, int quality_cutoff) except -1:
+    """
+    Sorts the characterised bases of the reads in a column into categories, as in the second half of characterise_read
+    """
+    cdef bint forward_match, reverse_match, match, direction
+    cdef int forward_base, reverse_base, forward_qual, reverse_qual, base, qual
+    for dir_dict in column_reads.values():
+        # Check to see if paired reads are present at this position
+        if len(dir_dict) > 1:
+            forward_match, forward_base, forward_qual = dir_dict[True]
+            reverse_match, reverse_base, reverse_qual = dir_dict[False]
+            if not forward_match and not reverse_match:
+                if forward_base == reverse_base:
+                    column_counts[CONGRUENT_SNV, forward_base] += 2
+                elif forward_qual >= quality_cutoff and reverse_qual >= quality_cutoff:
+                    column_counts[FORWARD_SNV_REVERSE_SNV1, forward_base] += 1
+                    column_counts[REVERSE_SNV_FORWARD_SNV1, reverse_base] += 1
+                elif forward_qual >= quality_cutoff:
+                    column_counts[FORWARD_SNV_REVERSE_UM_QF, forward_base] += 1
+                    column_counts[REVERSE_QUALITY_FILTERED, reverse_base] += 1
+                elif reverse_qual >= quality_cutoff:
+                    column_counts[REVERSE_SNV_FORWARD_UM_QF, reverse_base] += 1
+                    column_counts[FORWARD_QUALITY_FILTERED, forward_base] += 1
+                else:
+                    column_counts[FORWARD_QUALITY_FILTERED, forward_base] += 1
+                    column_counts[REVERSE_QUALITY_FILTERED, reverse_base] += 1
+            elif not forward_match:
+                if forward_qual >= quality_cutoff:
+                    column_counts[FORWARD_SNV_REVERSE_REF, forward_base] += 1
+                    column_counts[FORWARD_SNV_REVERSE_REF, reverse_base] += 1
+                else:
+                    column_counts[REVERSE_REF_FORWARD_UM_QF, reverse_base] += 1
+            elif not reverse_match:
+                if reverse_qual >= quality_cutoff:
+                    column_counts[REVERSE_SNV_FORWARD_REF, reverse_base] += 1
+                    column_counts[REVERSE_SNV_FORWARD_REF, forward_base] += 1
+                else:
+                    column_counts[FORWARD_REF_REVERSE_UM_QF, forward_base] += 1
+            else:
+                column_counts[CONGRUENT_REF, forward_base] += 2
+        # Either the reads are unpaired, or only a single read aligns to this position on the gene (no overlap)
+        else:
+            for direction, (match, base, qual) in dir_dict.items():
+                if not match:
+                    if qual >= quality_cutoff:
+                        if direction:
+                            column_counts[FORWARD_SNV_REVERSE_UM_QF, base] += 1
+                        else:
+                            column_counts[REVERSE_SNV_FORWARD_UM_QF, base] += 1
+                    else:
+                        column_counts[FORWARD_QUALITY_FILTERED, base] += 1
+                else:
+                    if qual >= quality_cutoff:
+                        if direction:
+                            column_counts[FORWARD_REF_REVERSE_UM_QF, base] += 1
+                        else:
+                            column_counts[REVERSE_REF_FORWARD_UM_QF, base] += 1
+                    else:
+                        column_counts[REVERSE_QUALITY_FILTERED, base] += 1
+    return 0
+
+
+def count_bases(bamfile, contig_name, reference_sequence, fastq_records, int quality_cutoff, bint fasta, keep_reads,
+                Py_ssize_t start, Py_ssize_t end, int64_t[:, :, ::1] base_counts, list quality_counts):
+    """
+    Counts the characterised bases in a window of a gene, adding them to base_counts and quality_counts in the same way
+    as walking the pileup of the window with characterise_read.
+    :param bamfile: pysam.AlignmentFile of the sorted BAM file
+    :param contig_name: Name of the gene
+    :param reference_sequence: String of the FASTA reference gene sequence
+    :param fastq_records: FastqQualities of the base qualities of the reads, or None to take them from the BAM file
+    :param quality_cutoff: Desired min phred quality for a base in order to be counted towards a multi-allelic column
+    :param fasta: Boolean of whether the samples are in FASTQ or FASTA format
+    :param keep_reads: Set of the names of the reads to characterise, or None to characterise every read
+    :param start: First position of the window
+    :param end: Position after the last position of the window
+    :param base_counts: Array of shape (positions in the window, categories, bases) to add the counts to
+    :param quality_counts: List indexed by phred score to tally the phred scores of the bases passing filter in
+    :return: True if the bases were counted. False if the gene has enough reads that the pileup could have reached its
+    maximum depth, in which case nothing is counted, and the pileup has to be walked instead
+    """
+    cdef bytes reference_bytes = reference_sequence.encode()
+    cdef const char* reference = reference_bytes
+    cdef Py_ssize_t reference_length = len(reference_bytes)
+    cdef bytes sequence_bytes
+    cdef const char* sequence
+    cdef Py_ssize_t query_position, reference_position, query_alignment_end, offset, position, read_position, \
+        contig_position
+    cdef int operation, length, distance, quality
+    cdef bint match, add_base, is_read1, is_reverse
+    cdef char base
+    # The reads characterised in each column of the window, as in characterise_read: {read name: {is_read1: details}}
+    cdef list columns = [dict() for _ in range(end - start)]
+    cdef dict column
+    if bamfile.count(contig_name) >= MAX_PILEUP_DEPTH:
+        return False
+    for read in bamfile.fetch(contig_name, start, end):
+        if read.flag & SKIP_FLAGS:
+            continue
+        qname = read.query_name
+        if keep_reads is not None and qname not in keep_reads:
+            continue
+        is_read1 = read.is_read1
+        is_reverse = read.is_reverse
+        # Read names in the BAM file have the direction removed - add it back to look up the FASTQ qualities
+        if not fasta:
+            read_name = qname.split(' ')[0] + '/1' if is_read1 else qname.split(' ')[0] + '/2'
+        else:
+            read_name = qname
+        sequence_bytes = read.query_sequence.encode()
+        sequence = sequence_bytes
+        qualities = read.query_qualities if fastq_records is None else None
+        query_alignment_end = read.query_alignment_end
+        query_position = 0
+        reference_position = read.reference_start
+        for operation, length in read.cigartuples:
+            if operation == CIGAR_MATCH or operation == CIGAR_SEQUENCE_MATCH or operation == CIGAR_SEQUENCE_MISMATCH:
+                for offset in range(length):
+                    position = reference_position + offset
+                    if position < start or position >= end:
+                        continue
+                    read_position = query_position + offset
+                    base = sequence[read_position]
+                    match = base == reference[position]
+                    if fastq_records is None:
+                        quality = qualities[read_position]
+                    else:
+                        quality = fastq_records.quality(read_name, read_position, is_reverse)
+                    # SNVs with other SNVs within five bases either side are discarded
+                    add_base = True
+                    if not match:
+                        for distance in range(-5, 6):
+                            if distance == 0:
+                                continue
+                            contig_position = position + distance
+                            if 0 <= contig_position < reference_length - 1 and \
+                                    0 <= read_position + distance < query_alignment_end - 1:
+                                if reference[contig_position] != sequence[read_position + distance]:
+                                    add_base = False
+                                    break
+                    if add_base:
+                        column = columns[position - start]
+                        if qname not in column:
+                            column[qname] = dict()
+                        column[qname][is_read1] = (match, base_index(base), quality)
+                        if quality >= quality_cutoff:
+                            quality_counts[quality] += 1
+                query_position += length
+                reference_position += length
+            elif operation == CIGAR_INSERTION or operation == CIGAR_SOFT_CLIP:
+                query_position += length
+            elif operation == CIGAR_DELETION or operation == CIGAR_REFERENCE_SKIP:
+                reference_position += length
+    for position in range(end - start):
+        if columns[position]:
+            count_column(columns[position], base_counts[position], quality_cutoff)
+    return True
@@ -1,4 +1,5 @@
 import os
+import tempfile
 import subprocess
 from subprocess import Popen, PIPE
 
@@ -17,6 +18,38 @@ def run_subprocess(command):
     return out, err
 
 
+def run_pipeline(commands):
+    """
+    commands is a list of commands to run, as strings, with the stdout of each one piped into the stdin of the next.
+    Unlike a shell pipeline, this raises an error if any of the commands fail, not just the last one.
+    returns stdout from the last command and stderr from all of the commands as strings.
+    """
+    processes = list()
+    stderr_files = list()
+    for command in commands:
+        # stderr goes to temporary files, since a full stderr pipe on an earlier command would stall the pipeline
+        stderr_file = tempfile.TemporaryFile()
+        stdin = processes[-1].stdout if processes else None
+        x = Popen(command, shell=True, stdin=stdin, stdout=PIPE, stderr=stderr_file)
+        if stdin is not None:
+            # Close our copy so the earlier command sees a broken pipe if this one exits early
+            stdin.close()
+        processes.append(x)
+        stderr_files.append(stderr_file)
+    out, _ = processes[-1].communicate()
+    out = out.decode('utf-8')
+    err = str()
+    for x, stderr_file in zip(processes, stderr_files):
+        x.wait()
+        stderr_file.seek(0)
+        err += stderr_file.read().decode('utf-8')
+        stderr_file.close()
+    for command, x in zip(commands, processes):
+        if x.returncode != 0:
+            raise subprocess.CalledProcessError(x.returncode, cmd=command)
+    return out, err
+
+
 def kwargs_to_string(kwargs):
     """
     Given a set of kwargs, turns them into a string which can then be passed to a command.
@@ -262,6 +295,56 @@ def bbduk_bait(reference, forward_in, forward_out, returncmd=False, reverse_in='
         return out, err
 
 
+def bbduk_bait_trim(reference, forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA',
+                    bait_kwargs=None, **kwargs):
+    """
+    Baits out reads that have kmers matching to a reference and quality trims them, streaming the baited reads from one
+    bbduk straight into another instead of writing them to disk. Trimming uses the same settings as bbduk_trim.
+    The two bbduks run at the same time, so split threads and memory between them rather than giving both the same.
+    :param reference: Reference you want to pull reads out for. Should be in fasta format.
+    :param forward_in: Forward reads you want to bait and trim.
+    :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param forward_out: Output forward reads, baited and trimmed.
+    :param reverse_in: Reverse input reads. Don't need to be specified if _R1/_R2 naming convention is used.
+    :param reverse_out: Reverse output reads. Don't need to be specified if _R1/_R2 convention is used.
+    :param bait_kwargs: Dictionary of arguments to give to the baiting bbduk, in parameter: argument format.
+    :param kwargs: Other arguments to give to the trimming bbduk, which writes the output reads, in parameter=argument
+    format. See bbduk documentation for full list.
+    :return: out and err: stdout string and stderr string from running the bbduks.
+    """
+    bait_options = kwargs_to_string(bait_kwargs if bait_kwargs is not None else dict())
+    options = kwargs_to_string(kwargs)
+    if os.path.isfile(forward_in.replace('_R1', '_R2')) and reverse_in == 'NA' and '_R1' in forward_in:
+        reverse_in = forward_in.replace('_R1', '_R2')
+        if reverse_out == 'NA':
+            if '_R1' in forward_out:
+                reverse_out = forward_out.replace('_R1', '_R2')
+            else:
+                raise ValueError('If you do not specify reverse_out, forward_out must contain _R1.\n\n')
+    elif reverse_in != 'NA' and reverse_out == 'NA':
+        raise ValueError('Reverse output reads must be specified.')
+    if reverse_in == 'NA':
+        bait_cmd = 'bbduk.sh in={} outm=stdout.fq ref={}{}'.format(forward_in, reference, bait_options)
+        trim_cmd = 'bbduk.sh in=stdin.fq out={f_out} qtrim=w trimq=20 k=25 minlength=50 forcetrimleft=15' \
+                   ' ref=adapters overwrite hdist=1 tpe tbo{optn}'\
+            .format(f_out=forward_out,
+                    optn=options)
+    else:
+        # Paired reads are interleaved on their way from one bbduk to the other
+        bait_cmd = 'bbduk.sh in={} in2={} outm=stdout.fq ref={}{}'.format(forward_in, reverse_in, reference,
+                                                                        bait_options)
+        trim_cmd = 'bbduk.sh in=stdin.fq int=t out1={f_out} out2={r_out} qtrim=w trimq=20 k=25 minlength=50 ' \
+                   'forcetrimleft=15 ref=adapters overwrite hdist=1 tpe tbo{optn}'\
+            .format(f_out=forward_out,
+                    r_out=reverse_out,
+                    optn=options)
+    out, err = run_pipeline([bait_cmd, trim_cmd])
+    if returncmd:
+        return out, err, '{} | {}'.format(bait_cmd, trim_cmd)
+    else:
+        return out, err
+
+
 def bbduk_filter(reference, forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', **kwargs):
     """
     Uses bbduk to filter out reads that have kmers matching to a reference.
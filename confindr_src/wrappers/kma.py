@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import subprocess
+from subprocess import Popen, PIPE
+
+
+def run_subprocess(command):
+    """
+    command is the command to run, as a string.
+    runs a subprocess, returns stdout and stderr from the subprocess as strings.
+    """
+    x = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
+    out, err = x.communicate()
+    out = out.decode('utf-8')
+    err = err.decode('utf-8')
+    if x.returncode != 0:
+        raise subprocess.CalledProcessError(x.returncode, cmd=command)
+    return out, err
+
+
+def shm_load(database, level=1, returncmd=False):
+    """
+    Loads a KMA database into shared memory, so kma runs given -shm with the same level use it instead of loading the
+    database from disk.
+    :param database: KMA database, as given to kma with -t_db.
+    :param level: Which parts of the database to put in shared memory. See kma shm -h. Default 1 (the k-mer index).
+    :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :return: out and err: stdout string and stderr string from running kma shm.
+    """
+    cmd = 'kma shm -t_db {} -shmLvl {}'.format(database, level)
+    out, err = run_subprocess(cmd)
+    if returncmd:
+        return out, err, cmd
+    else:
+        return out, err
+
+
+def shm_destroy(database, level=1, returncmd=False):
+    """
+    Removes a KMA database loaded with shm_load from shared memory.
+    :param database: KMA database, as given to kma with -t_db.
+    :param level: Level the database was loaded into shared memory with.
+    :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :return: out and err: stdout string and stderr string from running kma shm.
+    """
+    cmd = 'kma shm -t_db {} -shmLvl {} -destroy'.format(database, level)
+    out, err = run_subprocess(cmd)
+    if returncmd:
+        return out, err, cmd
+    else:
+        return out, err
@@ -1,6 +1,34 @@
 #!/usr/bin/env python
 
-from setuptools import setup, find_packages
+from setuptools.command.build_ext import build_ext
+from setuptools import setup, find_packages, Extension
+
+
+class OptionalBuildExt(build_ext):
+    """
+    The compiled pileup kernel only makes ConFindr faster, so if it can't be built, ConFindr is installed without it
+    and uses the pure Python pileup instead
+    """
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            print('WARNING: Could not build the compiled pileup kernel ({}), ConFindr will be slower'.format(e))
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            print('WARNING: Could not build {} ({}), ConFindr will be slower'.format(ext.name, e))
+
+
+# The pileup kernel is only built if Cython is installed
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize([Extension('confindr_src.pileup_kernel', ['confindr_src/pileup_kernel.pyx'])])
+except ImportError:
+    ext_modules = list()
 
 setup(
     name="confindr",
@@ -21,5 +49,9 @@ setup(
                       'pysam',
                       'pytest',
                       'numpy',
-                      'rauth']
+                      'rauth'],
+    extras_require={'mappy': ['mappy']},
+    package_data={'confindr_src': ['pileup_kernel.pyx']},
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': OptionalBuildExt}
 )
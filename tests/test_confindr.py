@@ -1,7 +1,15 @@
 from confindr_src.methods import *
+from confindr_src.database_setup import RmlstRest
+from confindr_src import database_setup
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing.pool import ThreadPool
 import subprocess
+import threading
+import hashlib
 import pytest
 import shutil
+import types
+import io
 import csv
 import os
 
@@ -221,6 +229,201 @@ def test_write_output_appends_if_file_does_exist():
     assert len(lines) > 2
 
 
+def test_sort_report(tmpdir):
+    report = str(tmpdir.join('confindr_report.csv'))
+    for sample_name in ('c', 'x', 'a', 'b'):
+        append_report_row(output_report=report,
+                          report_row=[sample_name, 'Escherichia', '0', 'False', '0.0', '0.0', '100', 'ND'])
+    sort_report(output_report=report,
+                sample_names=['a', 'b', 'c'])
+    with open(report) as f:
+        assert [line.split(',')[0] for line in f] == ['Sample', 'a', 'b', 'c', 'x']
+
+
+def test_run_manifest_resumes_finished_samples(tmpdir):
+    manifest_file = str(tmpdir.join('confindr_manifest.json'))
+    report_row = ['sample', 'Escherichia', '0', 'False', '0', '0', '100', '2020-01-01']
+    manifest = RunManifest(manifest_file=manifest_file)
+    manifest.record(sample_name='sample',
+                    fingerprint='abc',
+                    parameters={'quality_cutoff': 20, 'base_fraction_cutoff': 0.05},
+                    database_version='2020-01-01',
+                    report_row=report_row)
+    resumed = RunManifest(manifest_file=manifest_file)
+    assert resumed.finished_report_row(sample_name='sample',
+                                       fingerprint='abc',
+                                       parameters={'quality_cutoff': 20, 'base_fraction_cutoff': 0.05},
+                                       database_version='2020-01-01') == report_row
+    # Anything that could change the result means the sample has to be analysed again
+    assert resumed.finished_report_row(sample_name='sample',
+                                       fingerprint='abc',
+                                       parameters={'quality_cutoff': 30, 'base_fraction_cutoff': 0.05},
+                                       database_version='2020-01-01') is None
+    assert resumed.finished_report_row(sample_name='sample',
+                                       fingerprint='def',
+                                       parameters={'quality_cutoff': 20, 'base_fraction_cutoff': 0.05},
+                                       database_version='2020-01-01') is None
+    assert RunManifest(manifest_file=manifest_file, resume=False).finished_report_row(
+        sample_name='sample',
+        fingerprint='abc',
+        parameters={'quality_cutoff': 20, 'base_fraction_cutoff': 0.05},
+        database_version='2020-01-01') is None
+
+
+def test_fingerprint_files(tmpdir):
+    reads = tmpdir.join('reads.fastq')
+    reads.write('@read1\nACGT\n+\nIIII\n')
+    fingerprint = fingerprint_files([str(reads)])
+    assert fingerprint == fingerprint_files([str(reads)])
+    reads.write('@read1\nACGA\n+\nIIII\n')
+    assert fingerprint != fingerprint_files([str(reads)])
+
+
+def test_result_cache(tmpdir):
+    cache_dir = str(tmpdir.mkdir('cache'))
+    first_run = tmpdir.mkdir('first_run')
+    second_run = tmpdir.mkdir('second_run')
+    sample_database = str(tmpdir.join('Escherichia_db.fasta'))
+    shutil.copyfile('tests/rmlst.fasta', sample_database)
+    first_run.join('sample_contamination.csv').write('Gene,Position\n')
+    first_run.join('sample_alleles.csv').write('Gene,Allele\n')
+    cache_key = result_cache_key(reads=['tests/rmlst.fasta'],
+                                 database_download_date='2020-01-01',
+                                 parameters={'quality_cutoff': 20})
+    assert load_cached_result(cache_dir=cache_dir, cache_key=cache_key, output_folder=str(second_run),
+                              sample_name='renamed') is None
+    store_cached_result(cache_dir=cache_dir,
+                        cache_key=cache_key,
+                        report_row=['sample', 'Escherichia', '0', 'False', '0', '0', '100', '2020-01-01'],
+                        sample_database=sample_database,
+                        result_files=[str(first_run.join('sample_contamination.csv')),
+                                      str(first_run.join('sample_alleles.csv'))])
+    report_row = load_cached_result(cache_dir=cache_dir, cache_key=cache_key, output_folder=str(second_run),
+                                    sample_name='renamed')
+    assert report_row == ['renamed', 'Escherichia', '0', 'False', '0', '0', '100', '2020-01-01']
+    assert second_run.join('renamed_contamination.csv').read() == 'Gene,Position\n'
+    assert second_run.join('renamed_alleles.csv').read() == 'Gene,Allele\n'
+    assert second_run.join('confindr_report.csv').readlines()[-1] == ','.join(report_row) + '\n'
+    # Results from a database that has since changed can't be used
+    with open(sample_database, 'a') as f:
+        f.write('>extra\nACGT\n')
+    assert load_cached_result(cache_dir=cache_dir, cache_key=cache_key, output_folder=str(second_run),
+                              sample_name='renamed') is None
+
+
+def test_bbmap_index_reused(tmpdir):
+    with open('tests/rmlst.fasta', 'rb') as f:
+        index_path = tmpdir.join(hashlib.sha1(f.read()).hexdigest())
+    index_path.mkdir()
+    assert bbmap_index(reference='tests/rmlst.fasta',
+                       index_folder=str(tmpdir),
+                       log=str(tmpdir.join('log.txt'))) == str(index_path)
+
+
+def test_bbmap_index_falls_back_to_memory(tmpdir, monkeypatch):
+    # With no bbmap.sh to build the index with, BBMap is left to index the reference in memory
+    monkeypatch.setenv('PATH', str(tmpdir))
+    assert bbmap_index(reference='tests/rmlst.fasta',
+                       index_folder=str(tmpdir.join('bbmap_index')),
+                       log=str(tmpdir.join('log.txt'))) is None
+    assert tmpdir.join('bbmap_index').listdir() == []
+
+
+def test_mappy_segment_reverse_strand():
+    # Stand-ins for mappy Alignments, which only need the attributes mappy_segment looks at
+    hit = types.SimpleNamespace(ctg='BACT000001_30', r_st=100, r_en=107, q_st=2, q_en=9, strand=-1, cigar=[[7, 0]],
+                                mapq=60, NM=0)
+    mate_hit = types.SimpleNamespace(ctg='BACT000001_30', r_st=50, r_en=60, q_st=0, q_en=10, strand=1,
+                                     cigar=[[10, 0]], mapq=60, NM=0)
+    segment = mappy_segment(hit=hit, name='read1', sequence='AACCGGTTAC', qualities='ABCDEFGHIJ',
+                            reference_ids={'BACT000001_30': 0}, read_number=1, mate_hit=mate_hit)
+    assert segment.query_sequence == 'GTAACCGGTT'
+    assert list(segment.query_qualities) == [ord(quality) - 33 for quality in 'JIHGFEDCBA']
+    assert segment.cigartuples == [(4, 1), (0, 7), (4, 2)]
+    assert segment.is_reverse and segment.is_read1 and segment.is_paired and segment.is_proper_pair
+    assert not segment.mate_is_reverse and not segment.mate_is_unmapped
+    assert segment.next_reference_start == 50
+    assert segment.template_length == -57
+
+
+def test_mappy_segment_unpaired():
+    hit = types.SimpleNamespace(ctg='BACT000001_30', r_st=5, r_en=13, q_st=0, q_en=8, strand=1, cigar=[[8, 0]],
+                                mapq=60, NM=1)
+    segment = mappy_segment(hit=hit, name='read1', sequence='AACCGGTTAC', qualities='IIIIIIIIII',
+                            reference_ids={'BACT000001_30': 0})
+    assert segment.flag == 0
+    assert segment.cigartuples == [(0, 8), (4, 2)]
+    assert segment.get_tag('NM') == 1
+
+
+def test_map_reads_mappy(tmpdir):
+    pytest.importorskip('mappy')
+    allele = str(next(SeqIO.parse('tests/rmlst.fasta', 'fasta')).seq)
+    forward = tmpdir.join('reads_R1.fastq')
+    reverse = tmpdir.join('reads_R2.fastq')
+    forward.write('@read1/1\n{}\n+\n{}\n'.format(allele[100:250], 'I' * 150))
+    reverse.write('@read1/2\n{}\n+\n{}\n'.format(allele[300:450].translate(COMPLEMENT)[::-1], 'I' * 150))
+    sorted_bam = str(tmpdir.join('sorted.bam'))
+    map_reads_mappy(reference='tests/rmlst.fasta', read_files=[str(forward), str(reverse)], sorted_bam=sorted_bam)
+    with pysam.AlignmentFile(sorted_bam, 'rb') as bam:
+        reads = list(bam)
+    assert [(read.query_name, read.is_read1, read.reference_start) for read in reads] == [('read1', True, 100),
+                                                                                         ('read1', False, 300)]
+
+
+def test_map_reads_mappy_chimeric_read(tmpdir):
+    pytest.importorskip('mappy')
+    alleles = [str(record.seq) for record in SeqIO.parse('tests/rmlst.fasta', 'fasta')]
+    # Half of each read is from one gene, and half from another, so mappy splits it into two alignments
+    chimera = alleles[0][100:200] + alleles[5][300:400]
+    unpaired = tmpdir.join('reads.fastq')
+    unpaired.write('@read1\n{}\n+\n{}\n'.format(chimera, 'I' * len(chimera)))
+    sorted_bam = str(tmpdir.join('unpaired.bam'))
+    map_reads_mappy(reference='tests/rmlst.fasta', read_files=[str(unpaired)], sorted_bam=sorted_bam)
+    with pysam.AlignmentFile(sorted_bam, 'rb') as bam:
+        assert [(read.query_name, read.reference_name, read.reference_start) for read in bam] == \
+            [('read1', 'BACT000001_30', 100)]
+    forward = tmpdir.join('reads_R1.fastq')
+    reverse = tmpdir.join('reads_R2.fastq')
+    forward.write('@read1/1\n{}\n+\n{}\n'.format(chimera, 'I' * len(chimera)))
+    reverse.write('@read1/2\n{}\n+\n{}\n'.format(alleles[0][300:450].translate(COMPLEMENT)[::-1], 'I' * 150))
+    sorted_bam = str(tmpdir.join('paired.bam'))
+    map_reads_mappy(reference='tests/rmlst.fasta', read_files=[str(forward), str(reverse)], sorted_bam=sorted_bam)
+    with pysam.AlignmentFile(sorted_bam, 'rb') as bam:
+        reads = list(bam)
+    assert [(read.is_read1, read.reference_name, read.reference_start) for read in reads] == \
+        [(True, 'BACT000001_30', 100), (False, 'BACT000001_30', 300)]
+    assert reads[0].next_reference_start == 300 and reads[1].next_reference_start == 100
+
+
+def test_kma_shared_memory_loads_each_database_once(monkeypatch):
+    calls = list()
+    monkeypatch.setattr(kma, 'shm_load', lambda database, level: calls.append(('load', database)))
+    monkeypatch.setattr(kma, 'shm_destroy', lambda database, level: calls.append(('destroy', database)))
+    kma_shm = KmaSharedMemory()
+    assert kma_shm.acquire('db') == 1
+    assert kma_shm.acquire('db') == 1
+    kma_shm.release('db')
+    kma_shm.release('db')
+    assert calls == [('load', 'db')]
+    kma_shm.close()
+    assert calls == [('load', 'db'), ('destroy', 'db')]
+
+
+def test_kma_shared_memory_falls_back_to_disk(monkeypatch):
+    calls = list()
+
+    def failed_load(database, level):
+        calls.append(database)
+        raise subprocess.CalledProcessError(1, cmd='kma shm')
+    monkeypatch.setattr(kma, 'shm_load', failed_load)
+    kma_shm = KmaSharedMemory()
+    assert kma_shm.acquire('db') is None
+    assert kma_shm.acquire('db') is None
+    assert calls == ['db']
+    kma_shm.close()
+
+
 def test_base_dict_to_string_two_base_descending():
     assert base_dict_to_string({'A': 18, 'C': 3}) == 'A:18;C:3'
 
@@ -258,3 +461,620 @@ def test_invalid_xmx_float():
 
 def test_invalid_xmx_not_an_integer():
     assert check_acceptable_xmx('asdfK') is False
+
+
+def test_allocate_sample_threads_serial():
+    assert allocate_sample_threads(threads=12, parallel_samples=1, num_samples=96) == (1, 12)
+
+
+def test_allocate_sample_threads_split():
+    assert allocate_sample_threads(threads=48, parallel_samples=4, num_samples=96) == (4, 12)
+
+
+def test_allocate_sample_threads_automatic():
+    assert allocate_sample_threads(threads=48, parallel_samples=0, num_samples=96) == (12, 4)
+
+
+def test_allocate_sample_threads_more_parallel_than_samples():
+    assert allocate_sample_threads(threads=48, parallel_samples=8, num_samples=2) == (2, 24)
+
+
+def test_split_xmx_gigabytes():
+    assert split_xmx('20g', 4) == '5120m'
+
+
+def test_split_xmx_small_request():
+    assert split_xmx('800k', 2) == '400k'
+
+
+def test_load_fastq_records_paired_names():
+    fastq = io.BytesIO(b'@read1 1:N:0:1\nACGT\n+\nI#5?\n@read2/1\nAC\n+\n!!\n')
+    records = load_fastq_records(gz=fastq, paired=True, forward=True)
+    assert 'read1/1' in records and 'read2/1' in records
+    assert records['read1/1'] == [40, 2, 20, 30]
+    assert records.quality('read1/1', 3) == 30
+
+
+def test_load_fastq_records_unpaired_names():
+    fastq = io.BytesIO(b'@read1 extra\nACGT\n+\nIIII\n')
+    records = load_fastq_records(gz=fastq, paired=False, forward=True)
+    assert 'read1' in records
+    assert len(records) == 1
+
+
+def test_load_fastq_records_truncated():
+    gz = io.BytesIO(b'@read1\nACGT\n+\nIIII\n@read2\nACGT\n')
+    with pytest.raises(ValueError, match='@read2'):
+        load_fastq_records(gz=gz, paired=False, forward=True)
+
+
+def test_fastq_qualities_update():
+    records = load_fastq_records(gz=io.BytesIO(b'@read1\nAC\n+\nI5\n'), paired=True, forward=True)
+    records.update(load_fastq_records(gz=io.BytesIO(b'@read1\nACG\n+\n#?I\n'), paired=True, forward=False))
+    assert records['read1/1'] == [40, 20]
+    assert records['read1/2'] == [2, 30, 40]
+
+
+def test_open_reads_plain_and_gzipped(tmpdir):
+    fastq = b'@read1\nAC\n+\nI5\n'
+    plain = tmpdir.join('reads.fastq')
+    plain.write_binary(fastq)
+    compressed = tmpdir.join('reads.fastq.gz')
+    compressed.write_binary(gzip.compress(fastq))
+    for reads_file in (plain, compressed):
+        with open_reads(str(reads_file)) as f:
+            assert f.read() == fastq
+
+
+def test_run_pipeline():
+    out, err = bbtools.run_pipeline(['printf "b\\na\\n"', 'sort'])
+    assert out == 'a\nb\n'
+
+
+def test_bait_reads_stream_splits_threads_and_memory(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(bbtools, 'run_pipeline', lambda pipeline: commands.extend(pipeline) or ('', ''))
+    bait_reads(pair=['reads_R1.fastq.gz', 'reads_R2.fastq.gz'],
+               sample_database='db.fasta',
+               sample_name='sample',
+               sample_tmp_dir=str(tmpdir),
+               log=str(tmpdir.join('log.txt')),
+               threads=4,
+               xmx='4g',
+               stream=True,
+               intermediate_format='gzip1')
+    bait_cmd, trim_cmd = commands
+    assert ' threads=2' in bait_cmd and ' Xmx=2048m' in bait_cmd and 'ziplevel' not in bait_cmd
+    assert ' threads=2' in trim_cmd and ' Xmx=2048m' in trim_cmd and ' ziplevel=1' in trim_cmd
+
+
+def test_run_pipeline_early_failure():
+    # A shell pipeline would only report the exit code of the last command
+    with pytest.raises(subprocess.CalledProcessError):
+        bbtools.run_pipeline(['false', 'cat'])
+
+
+def test_most_common_genus(tmpdir):
+    report = tmpdir.join('confindr_report.csv')
+    assert most_common_genus(str(report)) == 'ND'
+    report.write('Sample,Genus,NumContamSNVs,ContamStatus,PercentContam,PercentContamStandardDeviation,'
+                 'BasesExamined,DatabaseDownloadDate\n'
+                 'a,Escherichia,0,False,0.0,0.0,100,ND\n'
+                 'b,Listeria,0,False,0.0,0.0,100,ND\n'
+                 'c,Escherichia:Salmonella,0,True,ND,ND,0,ND\n'
+                 'd,Error processing sample,0,False,ND,ND,0,ND\n'
+                 'e,Error processing sample,0,False,ND,ND,0,ND\n')
+    assert most_common_genus(str(report)) == 'Escherichia'
+
+
+def test_guess_sample_database_does_not_build(tmpdir):
+    shutil.copy('tests/rmlst.fasta', str(tmpdir.join('rMLST_combined.fasta')))
+    tmpdir.join('gene_allele.txt').write('Listeria:BACT000003_16,\n')
+    report = tmpdir.join('confindr_report.csv')
+    report.write('Sample,Genus,NumContamSNVs,ContamStatus,PercentContam,PercentContamStandardDeviation,'
+                 'BasesExamined,DatabaseDownloadDate\n'
+                 'a,Listeria,0,False,0.0,0.0,100,ND\n')
+    guess = guess_sample_database(output_report=str(report),
+                                  databases_folder=str(tmpdir),
+                                  use_rmlst=True)
+    assert guess == str(tmpdir.join('Listeria_db.fasta'))
+    assert not tmpdir.join('Listeria_db.fasta').check()
+
+
+def test_bait_read_files():
+    assert bait_read_files(pair=['a_R1.fastq.gz', 'a_R2.fastq.gz'], sample_name='a', sample_tmp_dir='tmp') == \
+        [os.path.join('tmp', 'a_baited_R1.fastq.gz'), os.path.join('tmp', 'a_baited_R2.fastq.gz')]
+    assert bait_read_files(pair=['a.fastq.gz'], sample_name='a', sample_tmp_dir='tmp', stream=True,
+                           intermediate_format='plain') == [os.path.join('tmp', 'a_baited_trimmed.fastq')]
+    assert bait_read_files(pair=['a.fastq.gz'], sample_name='a', sample_tmp_dir='tmp', data_type='Nanopore') == \
+        [os.path.join('tmp', 'a_baited_trimmed.fastq.gz')]
+
+
+def test_select_sample_database_no_genus(tmpdir):
+    assert select_sample_database(genus='ND', databases_folder=str(tmpdir)) == \
+        os.path.join(str(tmpdir), 'rMLST_combined.fasta')
+
+
+def test_open_rmlst_index_concurrently(tmpdir, monkeypatch):
+    shutil.copy('tests/rmlst.fasta', str(tmpdir.join('rMLST_combined.fasta')))
+    # Threads opening the index at the same time all get the one built on disk, instead of falling back to memory
+    monkeypatch.setattr(SeqIO, 'index', lambda *args: pytest.fail('Indexed in memory'))
+    with ThreadPool(4) as pool:
+        indexes = pool.map(open_rmlst_index, [str(tmpdir)] * 4)
+    assert all(len(rmlst_index) == 51 for rmlst_index in indexes)
+    for rmlst_index in indexes:
+        rmlst_index.close()
+
+
+def test_setup_allelespecific_database_index(tmpdir):
+    shutil.copy('tests/rmlst.fasta', str(tmpdir.join('rMLST_combined.fasta')))
+    genus_database = str(tmpdir.join('Genus_db.fasta'))
+    setup_allelespecific_database(fasta_file=genus_database,
+                                  database_folder=str(tmpdir),
+                                  allele_list=['BACT000001_30', 'BACT000003_16', 'BACT000004_1000000'])
+    assert tmpdir.join('rMLST_combined.fasta.idx').check()
+    assert not [f for f in tmpdir.listdir() if f.basename.endswith('.tmp')]
+    assert [record.id for record in SeqIO.parse(genus_database, 'fasta')] == ['BACT000001_30', 'BACT000003_16']
+    # The index is reused for the next database, and gets remade if the combined file is newer than it
+    index_file = str(tmpdir.join('rMLST_combined.fasta.idx'))
+    os.utime(index_file, (0, 0))
+    other_genus_database = str(tmpdir.join('OtherGenus_db.fasta'))
+    setup_allelespecific_database(fasta_file=other_genus_database,
+                                  database_folder=str(tmpdir),
+                                  allele_list=['BACT000002_25'])
+    assert os.path.getmtime(index_file) > 0
+    assert [record.id for record in SeqIO.parse(other_genus_database, 'fasta')] == ['BACT000002_25']
+    # A database that's already there is left alone
+    setup_allelespecific_database(fasta_file=other_genus_database,
+                                  database_folder=str(tmpdir),
+                                  allele_list=['BACT000003_16'])
+    assert [record.id for record in SeqIO.parse(other_genus_database, 'fasta')] == ['BACT000002_25']
+
+
+def test_prebuild_genus_databases(tmpdir, monkeypatch):
+    shutil.copy('tests/rmlst.fasta', str(tmpdir.join('rMLST_combined.fasta')))
+    tmpdir.join('gene_allele.txt').write('Escherichia:BACT000001_30,BACT000002_25,\n'
+                                         'Listeria:BACT000003_16,\n')
+    # Index in this process, so the test doesn't depend on KMA being installed
+    indexed = list()
+    monkeypatch.setattr(multiprocessing, 'Pool', ThreadPool)
+    monkeypatch.setattr('confindr_src.methods.index_databases',
+                        lambda sample_database: indexed.append(sample_database))
+    prebuild_genus_databases(output_folder=str(tmpdir),
+                             genera=['Listeria', 'Notagenus'],
+                             processes=2)
+    assert indexed == [str(tmpdir.join('Listeria_db.fasta'))]
+    assert not tmpdir.join('Escherichia_db.fasta').check()
+    prebuild_genus_databases(output_folder=str(tmpdir),
+                             processes=2)
+    assert sorted(indexed) == sorted([str(tmpdir.join('{}_db.fasta'.format(genus)))
+                                      for genus in ('Escherichia', 'Listeria', 'Listeria')])
+    assert [record.id for record in SeqIO.parse(str(tmpdir.join('Escherichia_db.fasta')), 'fasta')] == \
+        ['BACT000001_30', 'BACT000002_25']
+
+
+def test_database_setup_prebuild_genera(tmpdir, monkeypatch):
+    shutil.copy('tests/rmlst.fasta', str(tmpdir.join('rMLST_combined.fasta')))
+    tmpdir.join('gene_allele.txt').write('Escherichia:BACT000001_30,BACT000002_25,\n'
+                                         'Listeria:BACT000003_16,\n')
+    indexed = list()
+    monkeypatch.setattr(multiprocessing, 'Pool', ThreadPool)
+    monkeypatch.setattr('confindr_src.methods.index_databases',
+                        lambda sample_database: indexed.append(sample_database))
+    monkeypatch.setattr('sys.argv', ['confindr_database_setup', '-o', str(tmpdir), '--prebuild_genera', 'Listeria',
+                                     '-t', '2'])
+    database_setup.main()
+    assert indexed == [str(tmpdir.join('Listeria_db.fasta'))]
+    # Prebuilding works on the existing database folder, so nothing in it is removed
+    assert tmpdir.join('rMLST_combined.fasta').check()
+
+
+def test_gene_allele_map(tmpdir):
+    gene_allele_file = tmpdir.join('gene_allele.txt')
+    gene_allele_file.write('Escherichia:BACT000001_30,BACT000002_25,\n'
+                           'Listeria:BACT000003_16,\n')
+    assert find_genus_specific_allele_list(str(gene_allele_file), 'Listeria') == ['BACT000003_16']
+    assert find_genus_specific_allele_list(str(gene_allele_file), 'Notagenus') == []
+    assert tmpdir.join('gene_allele.txt.pickle').check()
+    # A rewritten gene_allele.txt replaces the cached map
+    gene_allele_file.write('Listeria:BACT000003_16,BACT000004_1,\n')
+    os.utime(str(gene_allele_file), ns=(os.stat(str(gene_allele_file)).st_mtime_ns + 10 ** 9, ) * 2)
+    assert load_gene_allele_map(str(gene_allele_file)) == {'Listeria': ['BACT000003_16', 'BACT000004_1']}
+
+
+def test_database_lock_waits_for_builder(tmpdir):
+    database = str(tmpdir.join('Genus_db.fasta'))
+    events = list()
+
+    def wait_for_lock():
+        with DatabaseLock(database):
+            events.append('locked')
+    with DatabaseLock(database):
+        waiter = threading.Thread(target=wait_for_lock)
+        waiter.start()
+        waiter.join(timeout=0.5)
+        events.append('released')
+    waiter.join()
+    assert events == ['released', 'locked']
+
+
+def test_index_databases_renames_kma_files(tmpdir, monkeypatch):
+    database = str(tmpdir.join('Genus_db.fasta'))
+    shutil.copy('tests/rmlst.fasta', database)
+    commands = list()
+
+    def fake_kma_index(cmd):
+        commands.append(cmd)
+        prefix = cmd.split(' -o ')[1]
+        for extension in ('.name', '.seq.b', '.comp.b', '.length.b'):
+            with open(prefix + extension, 'w') as f:
+                f.write('index')
+        return 'out', 'err'
+    monkeypatch.setattr('confindr_src.methods.run_cmd', fake_kma_index)
+    assert index_databases(database) == str(tmpdir.join('Genus_db_kma'))
+    assert tmpdir.join('Genus_db.fasta.fai').check()
+    assert sorted(f.basename for f in tmpdir.listdir() if 'kma' in f.basename) == \
+        ['Genus_db_kma.comp.b', 'Genus_db_kma.length.b', 'Genus_db_kma.name', 'Genus_db_kma.seq.b']
+    # Already indexed, so KMA isn't run again
+    index_databases(database)
+    assert len(commands) == 1
+
+
+def test_index_databases_kma_failure(tmpdir, monkeypatch):
+    database = str(tmpdir.join('Genus_db.fasta'))
+    shutil.copy('tests/rmlst.fasta', database)
+
+    def failed_kma_index(cmd):
+        with open(cmd.split(' -o ')[1] + '.seq.b', 'w') as f:
+            f.write('half an index')
+        raise subprocess.CalledProcessError(returncode=1, cmd=cmd)
+    monkeypatch.setattr('confindr_src.methods.run_cmd', failed_kma_index)
+    with pytest.raises(subprocess.CalledProcessError):
+        index_databases(database)
+    assert [f.basename for f in tmpdir.listdir() if 'kma' in f.basename] == []
+
+
+def test_index_databases_faidx_failure(tmpdir):
+    database = tmpdir.join('Genus_db.fasta')
+    database.write('not a fasta file')
+    with pytest.raises(subprocess.CalledProcessError):
+        index_databases(str(database))
+
+
+def test_select_sample_database_cgmlst():
+    assert select_sample_database(genus='Escherichia', databases_folder='databases',
+                                  cgmlst_db='tests/rmlst.fasta') == 'tests/rmlst.fasta'
+
+
+def test_read_contig_bam_qualities():
+    allele_records = SeqIO.to_dict(SeqIO.parse('tests/rmlst.fasta', 'fasta'))
+    multibase_dict, to_write = read_contig(contig_name='BACT000001_30',
+                                           bamfile_name='tests/contamination.bam',
+                                           reference_fasta='tests/rmlst.fasta',
+                                           allele_records=allele_records,
+                                           fastq_records=None,
+                                           quality_cutoff=20,
+                                           base_cutoff=2)
+    assert sorted(multibase_dict['BACT000001_30']) == [297, 462, 930, 1147, 1539]
+    assert multibase_dict['BACT000001_30'][462]['congruent'] == {'C': 34}
+    assert multibase_dict['BACT000001_30'][462]['paired'] == {'C': 72}
+
+
+def fastq_qualities_from_bam(bamfile_name):
+    """
+    Builds the FastqQualities that the trimmed FASTQ files of the reads in a BAM file would give, with the qualities of
+    each read in the orientation it was sequenced in.
+    """
+    records = FastqQualities()
+    with pysam.AlignmentFile(bamfile_name, 'rb') as bamfile:
+        for read in bamfile.fetch(until_eof=True):
+            if read.is_secondary or read.is_supplementary:
+                continue
+            qualities = list(read.query_qualities)
+            if read.is_reverse:
+                qualities.reverse()
+            records.add(read.query_name + ('/1' if read.is_read1 else '/2'), bytes(q + 33 for q in qualities))
+    return records
+
+
+def test_read_contig_fastq_and_bam_qualities_agree(monkeypatch):
+    # The compiled kernel is compared with the pileup in test_pileup_kernel_matches_pileup
+    monkeypatch.setattr('confindr_src.methods.pileup_kernel', None)
+    allele_records = SeqIO.to_dict(SeqIO.parse('tests/rmlst.fasta', 'fasta'))
+    fastq_records = fastq_qualities_from_bam('tests/contamination.bam')
+    with pysam.AlignmentFile('tests/contamination.bam', 'rb') as bamfile:
+        contig_names = [contig_name for contig_name in bamfile.references if bamfile.count(contig_name)]
+    for contig_name in contig_names:
+        arguments = dict(contig_name=contig_name,
+                         bamfile_name='tests/contamination.bam',
+                         reference_fasta='tests/rmlst.fasta',
+                         allele_records=allele_records,
+                         quality_cutoff=20)
+        assert read_contig(fastq_records=fastq_records, **arguments) == read_contig(fastq_records=None, **arguments)
+
+
+def test_subsample_read_names():
+    with pysam.AlignmentFile('tests/contamination.bam', 'rb') as bamfile:
+        assert subsample_read_names(bamfile=bamfile, contig_name='BACT000001_30', gene_length=1674,
+                                    max_depth=1000) is None
+        keep_reads = subsample_read_names(bamfile=bamfile, contig_name='BACT000001_30', gene_length=1674,
+                                          max_depth=20)
+        reads = [read for read in bamfile.fetch('BACT000001_30') if not read.flag & PILEUP_SKIP_FLAGS]
+    depth = sum(read.reference_length for read in reads) / 1674
+    kept_depth = sum(read.reference_length for read in reads if read.query_name in keep_reads) / 1674
+    assert depth > 40
+    assert 10 < kept_depth < 30
+
+
+def test_read_contig_max_depth():
+    allele_records = SeqIO.to_dict(SeqIO.parse('tests/rmlst.fasta', 'fasta'))
+    arguments = dict(contig_name='BACT000001_30',
+                     bamfile_name='tests/contamination.bam',
+                     reference_fasta='tests/rmlst.fasta',
+                     allele_records=allele_records,
+                     fastq_records=None,
+                     quality_cutoff=20)
+    # Genes that aren't as deep as the cap are left alone
+    assert read_contig(max_depth=1000, **arguments) == read_contig(**arguments)
+    # The SNVs are still found in the subsampled pileup, and the error estimate follows its depth down
+    full_snvs, full_report = read_contig(**arguments)
+    capped_snvs, capped_report = read_contig(max_depth=40, **arguments)
+    assert 462 in capped_snvs['BACT000001_30'] and 1147 in capped_snvs['BACT000001_30']
+    assert capped_snvs['BACT000001_30'][462]['paired']['C'] < full_snvs['BACT000001_30'][462]['paired']['C']
+    assert float(capped_report.split(',')[-1]) < float(full_report.split(',')[-1])
+
+
+def test_count_contig_bases_reuses_keep_reads(monkeypatch):
+    reference_sequence = str(SeqIO.to_dict(SeqIO.parse('tests/rmlst.fasta', 'fasta'))['BACT000001_30'].seq)
+    calls = list()
+    real_subsample_read_names = subsample_read_names
+
+    def counted_subsample_read_names(**kwargs):
+        calls.append(kwargs['contig_name'])
+        return real_subsample_read_names(**kwargs)
+    monkeypatch.setattr('confindr_src.methods.subsample_read_names', counted_subsample_read_names)
+    monkeypatch.setattr('confindr_src.methods.worker_keep_reads', dict())
+    # Every window of the gene uses the reads picked for the first one
+    for start in range(0, len(reference_sequence), 250):
+        count_contig_bases(contig_name='BACT000001_30',
+                           bamfile_name='tests/contamination.bam',
+                           reference_fasta='tests/rmlst.fasta',
+                           reference_sequence=reference_sequence,
+                           fastq_records=None,
+                           max_depth=40,
+                           start=start,
+                           end=min(start + 250, len(reference_sequence)))
+    assert calls == ['BACT000001_30']
+
+
+def test_pileup_pool_shared_between_samples(tmpdir):
+    allele_records = SeqIO.to_dict(SeqIO.parse('tests/rmlst.fasta', 'fasta'))
+    results = list()
+    with PileupPool(processes=2) as pileup_pool:
+        # Two samples with different settings going through the same pool of workers
+        for base_cutoff in (2, 3):
+            context_file = str(tmpdir.join('{}_pileup_context.pickle'.format(base_cutoff)))
+            pileup_context = dict(bamfile_name='tests/contamination.bam',
+                                  reference_fasta='tests/rmlst.fasta',
+                                  allele_records=allele_records,
+                                  fastq_records=None,
+                                  quality_cutoff=20,
+                                  base_cutoff=base_cutoff)
+            write_pileup_context(context_file=context_file,
+                                 pileup_context=pileup_context)
+            results.append(pileup_pool.read_contigs(context_file=context_file,
+                                                    pileup_context=pileup_context,
+                                                    contig_names=['BACT000001_30']))
+    assert sorted(results[0][0][0]['BACT000001_30']) == [297, 462, 930, 1147, 1539]
+    assert results[1][0] == read_contig(contig_name='BACT000001_30',
+                                        bamfile_name='tests/contamination.bam',
+                                        reference_fasta='tests/rmlst.fasta',
+                                        allele_records=allele_records,
+                                        fastq_records=None,
+                                        quality_cutoff=20,
+                                        base_cutoff=3)
+
+
+def test_load_pileup_context_keeps_one_per_sample(tmpdir, monkeypatch):
+    contexts = dict()
+    monkeypatch.setattr('confindr_src.methods.worker_pileup_contexts', contexts)
+    set_pileup_context_limit(2)
+    try:
+        context_files = list()
+        for sample in range(3):
+            context_files.append(str(tmpdir.join('{}_pileup_context.pickle'.format(sample))))
+            write_pileup_context(context_file=context_files[-1],
+                                 pileup_context=dict(sample=sample))
+        load_pileup_context(context_files[0])
+        load_pileup_context(context_files[1])
+        # Using the first context again keeps it loaded, so the second is dropped when the third is loaded
+        load_pileup_context(context_files[0])
+        assert load_pileup_context(context_files[2]) == dict(sample=2)
+        assert [key[0] for key in contexts] == [context_files[0], context_files[2]]
+    finally:
+        set_pileup_context_limit(4)
+
+
+def test_neighbouring_mismatches():
+    reference_sequence = str(next(SeqIO.parse('tests/rmlst.fasta', 'fasta')).seq)
+    reference_array = np.frombuffer(reference_sequence.encode(), dtype=np.uint8)
+    mismatch_sums = dict()
+    with pysam.AlignmentFile('tests/contamination.bam', 'rb') as bamfile:
+        for column in bamfile.pileup('BACT000001_30', 450, 470, truncate=True):
+            for read in column.pileups:
+                if read.query_position is None:
+                    continue
+                # Compare the neighbours one at a time
+                expected = 0
+                for distance in list(range(-5, 0)) + list(range(1, 6)):
+                    contig_pos = column.pos + distance
+                    read_pos = read.query_position + distance
+                    if 0 <= contig_pos < len(reference_sequence) - 1 and \
+                            0 <= read_pos < read.alignment.query_alignment_end - 1:
+                        expected += reference_sequence[contig_pos] != read.alignment.query_sequence[read_pos]
+                assert neighbouring_mismatches(alignment=read.alignment,
+                                               query_position=read.query_position,
+                                               reference_position=column.pos,
+                                               reference_array=reference_array,
+                                               mismatch_sums=mismatch_sums) == expected
+
+
+def test_pileup_kernel_matches_pileup():
+    if pileup_kernel is None:
+        pytest.skip('The compiled pileup kernel has not been built')
+    allele_records = SeqIO.to_dict(SeqIO.parse('tests/rmlst.fasta', 'fasta'))
+    fastq_records = fastq_qualities_from_bam('tests/contamination.bam')
+    with pysam.AlignmentFile('tests/contamination.bam', 'rb') as bamfile:
+        contig_names = [contig_name for contig_name in bamfile.references if bamfile.count(contig_name)]
+    for contig_name in contig_names:
+        for options in (dict(), dict(max_depth=20), dict(start=37, end=140), dict(fasta=True),
+                        dict(fastq_records=fastq_records)):
+            arguments = dict(contig_name=contig_name,
+                             bamfile_name='tests/contamination.bam',
+                             reference_fasta='tests/rmlst.fasta',
+                             reference_sequence=str(allele_records[contig_name].seq),
+                             **dict(dict(fastq_records=None), **options))
+            kernel_base_counts, kernel_quality_counts = count_contig_bases(use_kernel=True, **arguments)
+            base_counts, quality_counts = count_contig_bases(use_kernel=False, **arguments)
+            assert np.array_equal(kernel_base_counts, base_counts)
+            assert kernel_quality_counts == quality_counts
+
+
+def test_plan_pileup_windows():
+    # Enough genes for the workers, so genes aren't split
+    assert plan_pileup_windows([('a', 1000), ('b', 500)], workers=1, windows_per_worker=2) == [('a', 0, 1000),
+                                                                                             ('b', 0, 500)]
+    # Too few genes, so they're split into equal windows covering each gene
+    assert plan_pileup_windows([('a', 1000), ('b', 500)], workers=2) == [('a', 0, 250), ('a', 250, 500),
+                                                                        ('a', 500, 750), ('a', 750, 1000),
+                                                                        ('b', 0, 250), ('b', 250, 500)]
+    # But never into windows shorter than the minimum
+    assert len(plan_pileup_windows([('a', 1000)], workers=64)) == 4
+
+
+def test_estimate_window_costs():
+    # BACT000001_30 has 484 reads mapped to it, and BACT000010_24 has 43
+    assert estimate_window_costs(bamfile_name='tests/contamination.bam',
+                                 windows=[('BACT000010_24', 0, 312),
+                                          ('BACT000001_30', 0, 100),
+                                          ('BACT000001_30', 100, 300)]) == [43 * 312, 484 * 100, 484 * 200]
+
+
+def test_pileup_windows_match_whole_gene(tmpdir):
+    allele_records = SeqIO.to_dict(SeqIO.parse('tests/rmlst.fasta', 'fasta'))
+    contig_names = ['BACT000001_30', 'BACT000002_25', 'BACT000003_16']
+    pileup_context = dict(bamfile_name='tests/contamination.bam',
+                          reference_fasta='tests/rmlst.fasta',
+                          allele_records=allele_records,
+                          fastq_records=None,
+                          quality_cutoff=20,
+                          base_fraction_cutoff=0.05,
+                          max_depth=40)
+    context_file = str(tmpdir.join('pileup_context.pickle'))
+    write_pileup_context(context_file=context_file,
+                         pileup_context=pileup_context)
+    # Enough workers that every gene is split into several windows
+    with PileupPool(processes=8) as pileup_pool:
+        results = pileup_pool.read_contigs(context_file=context_file,
+                                           pileup_context=pileup_context,
+                                           contig_names=contig_names)
+    assert results == [read_contig(contig_name=contig_name, **pileup_context) for contig_name in contig_names]
+
+
+def test_bases_above_threshold_whole_gene():
+    base_counts = np.array([[80, 20, 0, 0, 0],
+                            [99, 1, 0, 0, 0],
+                            [0, 0, 0, 0, 0]])
+    assert list(number_of_bases_above_threshold(base_counts, base_fraction_cutoff=0.05)) == [2, 1, 0]
+
+
+def test_find_multibase_positions_arrays():
+    base_counts = np.zeros((3, len(BASE_CATEGORIES), len(BASES)), dtype=int)
+    # Position 1 has a congruent C SNV supported by both reads of two pairs against a reference A
+    base_counts[1, CONGRUENT_REF, BASE_INDEX['A']] = 20
+    base_counts[1, CONGRUENT_SNV, BASE_INDEX['C']] = 4
+    # Position 2 has a single low quality G, which shouldn't count
+    base_counts[2, CONGRUENT_REF, BASE_INDEX['T']] = 20
+    base_counts[2, FORWARD_QUALITY_FILTERED, BASE_INDEX['G']] = 3
+    passing_snv_counts, multibase_positions, total_coverage = find_multibase_positions(reference_sequence='AAT',
+                                                                                       base_counts=base_counts,
+                                                                                       base_cutoff=2,
+                                                                                       base_fraction_cutoff=0.05)
+    assert list(multibase_positions) == [1]
+    assert list(total_coverage) == [0, 24, 20]
+    assert passing_snv_dict(passing_snv_counts[1]) == {'congruent': {'C': 4}, 'forward': {}, 'reverse': {},
+                                                       'paired': {'C': 4}}
+
+
+class StubRmlstHandler(BaseHTTPRequestHandler):
+    """
+    Serves the list of loci and locus FASTA files like the pubmlst REST API, failing the first request for BACT000002.
+    """
+    requests = list()
+    failed = list()
+
+    def do_GET(self):
+        # The OAuth signature comes in the query string
+        path = self.path.split('?')[0]
+        self.requests.append(path)
+        if path == '/loci':
+            body = json.dumps({'loci': ['http://{}:{}/loci/{}'.format(*self.server.server_address, locus)
+                                        for locus in ('BACT000001', 'BACT000002')]})
+            content_type = 'application/json'
+        elif path == '/loci/BACT000002/alleles_fasta' and not self.failed:
+            self.failed.append(path)
+            self.send_response(500)
+            self.end_headers()
+            return
+        else:
+            body = '>{}_1\nACGT\n'.format(path.split('/')[2])
+            content_type = 'text/plain'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_rmlst_download_loci(tmpdir):
+    secret_file = tmpdir.join('secret.txt')
+    secret_file.write('key\nsecret\n')
+    server = HTTPServer(('127.0.0.1', 0), StubRmlstHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        rmlst_rest = RmlstRest(consumer_secret_file=str(secret_file),
+                               output_folder=str(tmpdir),
+                               download_threads=2,
+                               backoff=0)
+        rmlst_rest.loci = 'http://{}:{}/loci'.format(*server.server_address)
+        rmlst_rest.download_loci()
+        assert tmpdir.join('BACT000001.tfa').read() == '>BACT000001_1\nACGT\n'
+        assert tmpdir.join('BACT000002.tfa').read() == '>BACT000002_1\nACGT\n'
+        assert StubRmlstHandler.requests.count('/loci/BACT000002/alleles_fasta') == 2
+        # Resuming only downloads the loci that are missing or don't match their checksums
+        tmpdir.join('BACT000002.tfa').write('>BACT000002_1\nAC')
+        del StubRmlstHandler.requests[:]
+        rmlst_rest = RmlstRest(consumer_secret_file=str(secret_file),
+                               output_folder=str(tmpdir),
+                               backoff=0)
+        rmlst_rest.loci = 'http://{}:{}/loci'.format(*server.server_address)
+        rmlst_rest.download_loci()
+        assert StubRmlstHandler.requests == ['/loci', '/loci/BACT000002/alleles_fasta']
+        assert tmpdir.join('BACT000002.tfa').read() == '>BACT000002_1\nACGT\n'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_remove_rmlst_databases(tmpdir):
+    stale_files = ['Bacillus_db.fasta', 'Bacillus_db.fasta.fai', 'Bacillus_db.fasta.lock', 'Bacillus_db_kma.name',
+                   'Bacillus_db_kma.seq.b', 'rMLST_combined.fasta.idx', 'gene_allele.txt.pickle']
+    kept_files = ['Escherichia_db_cgderived.fasta', 'Escherichia_db_cgderived.fasta.fai',
+                  'Escherichia_db_cgderived_kma.name', 'BACT000001.tfa', 'loci_checksums.json', 'profiles.txt']
+    for file_name in stale_files + kept_files:
+        tmpdir.join(file_name).write('')
+    database_setup.remove_rmlst_databases(str(tmpdir))
+    assert sorted(os.listdir(str(tmpdir))) == sorted(kept_files)